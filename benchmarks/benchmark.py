@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# End to end benchmark of the proxy against a local fake Data Connect.
+#
+# Many XMPP clients request overlapping periods of load curve and daily
+# data for many usage points. Reports latency percentiles, throughput and
+# the calls that reached upstream.
+#
+# python -m benchmarks.benchmark --clients 20 --usage-points 50 --requests 500
+
+import argparse
+import asyncio
+import datetime as dt
+import logging
+import random
+import statistics
+import time
+
+from slixmpp import JID
+from slixmpp.exceptions import XMPPError
+
+from dataconnect import DataConnect, DataConnectError
+from main import DataConnectProxy
+from metering_cache import MeteringCache
+from rate_limiter import RateLimiter
+from series_store import SeriesStore
+from xmpp_interface import XmppInterface
+from benchmarks.fake_data_connect import FakeDataConnect
+
+FIRST_USAGE_POINT = 22516914714270
+
+class Benchmark:
+
+    def __init__(self, args, base_url):
+        self.args = args
+        self.random = random.Random(args.seed)
+
+        data_connect = DataConnect('client-id', 'client-secret', 'https://example.com/redirect', sandbox=False)
+        data_connect.api_endpoint = base_url
+        data_connect.rate_limiter = RateLimiter(rate=args.rate, burst=args.rate,
+                                                max_concurrency=DataConnect.MAX_CONNECTIONS)
+
+        self.proxy = DataConnectProxy(data_connect, data_connect, 'https://example.com',
+                                      state_path=':memory:', legacy_state_path=None)
+        self.proxy.metering_cache = MeteringCache(max_days=args.cache_days,
+                                                  store=SeriesStore(args.series_path) if args.series_path else None)
+
+        self.xmpp = XmppInterface('proxy@example.com/proxy', 'password',
+                                  self.proxy.register_authorize_description,
+                                  self.proxy.get_load_curve,
+                                  self.proxy.get_daily)
+
+        self.jids = [f'client-{i}@example.com' for i in range(args.clients)]
+        self.usage_points = {jid: [] for jid in self.jids}
+        for i in range(args.usage_points):
+            jid = self.jids[i % len(self.jids)]
+            usage_point_id = str(FIRST_USAGE_POINT + i)
+            token_id = self.proxy.tokens.set(f'access-{i}', f'refresh-{i}', 12600, False)
+            self.proxy.usage_points.set(jid, usage_point_id, token_id)
+            self.usage_points[jid].append(usage_point_id)
+
+    def make_request(self):
+        """ A random (endpoint, jid, usage point, start, end) within the available history """
+        jid = self.random.choice([jid for jid in self.jids if self.usage_points[jid]])
+        usage_point_id = self.random.choice(self.usage_points[jid])
+        today = DataConnect.today()
+        if self.random.random() < self.args.daily_ratio:
+            endpoint = 'daily'
+            days = self.random.randint(1, 365)
+        else:
+            endpoint = 'load_curve'
+            days = self.random.randint(1, self.args.max_load_curve_days)
+        # Periods are drawn from a small set of start days so that they overlap
+        start = today - dt.timedelta(days=self.random.randrange(days + 1, days + 1 + self.args.history_days, 7))
+        return endpoint, jid, usage_point_id, start, min(start + dt.timedelta(days=days), today)
+
+    async def call_proxy(self, endpoint, jid, usage_point_id, start, end):
+        get = self.proxy.get_daily if endpoint == 'daily' else self.proxy.get_load_curve
+        data = await get('consumption', jid, usage_point_id, start.isoformat(), end.isoformat())
+        return len(data['meter_reading']['interval_reading'])
+
+    async def call_xmpp(self, endpoint, jid, usage_point_id, start, end):
+        handler = self.xmpp.daily_handler if endpoint == 'daily' else self.xmpp.load_curve_handler
+        payload = self.xmpp.plugin['xep_0004'].make_form(ftype='submit')
+        for var, value in [('usage_point_id', usage_point_id), ('direction', 'consumption'),
+                           ('start_date', start.isoformat()), ('end_date', end.isoformat())]:
+            payload.add_field(var=var, value=value)
+        session = await handler.handle_submit(payload, {'from': JID(f'{jid}/benchmark')})
+        return sum(len(str(item)) for item in session['payload'])
+
+    async def run(self):
+        call = self.call_xmpp if self.args.scenario == 'xmpp' else self.call_proxy
+        requests = [self.make_request() for _ in range(self.args.requests)]
+        pending = iter(requests)
+        latencies = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for request in pending:
+                start = time.monotonic()
+                try:
+                    await call(*request)
+                except (DataConnectError, XMPPError) as e:
+                    errors += 1
+                    logging.debug(f'{request}: {e}')
+                latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(self.args.concurrency)])
+        duration = time.monotonic() - start
+
+        await self.proxy.close()
+
+        return latencies, errors, duration
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def main(args):
+
+    fake = FakeDataConnect(args.latency, args.jitter, args.error_rate, args.quota, seed=args.seed)
+    base_url = await fake.start()
+
+    try:
+        benchmark = Benchmark(args, base_url)
+        latencies, errors, duration = await benchmark.run()
+    finally:
+        await fake.stop()
+
+    print(f"Scenario     {args.scenario}, {args.requests} requests, {args.concurrency} concurrent")
+    print(f"Duration     {duration:.2f} s")
+    print(f"Throughput   {len(latencies) / duration:.1f} requests/s")
+    print(f"Latency      mean {statistics.mean(latencies) * 1000:.0f} ms, "
+          f"p50 {percentile(latencies, 50) * 1000:.0f} ms, "
+          f"p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"Errors       {errors}")
+    print(f"Upstream     {sum(fake.calls.values())} calls")
+    for path, count in sorted(fake.calls.items()):
+        print(f"    {path:40} {count}")
+    for status, count in sorted(fake.statuses.items()):
+        print(f"    HTTP {status:<35} {count}")
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=['proxy', 'xmpp'], default='xmpp',
+                        help="Call the proxy directly, or through the ad-hoc command handlers")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20, help="Requests in flight")
+    parser.add_argument('--clients', type=int, default=10, help="Number of client JIDs")
+    parser.add_argument('--usage-points', type=int, default=50)
+    parser.add_argument('--daily-ratio', type=float, default=0.3, help="Ratio of daily requests")
+    parser.add_argument('--max-load-curve-days', type=int, default=14)
+    parser.add_argument('--history-days', type=int, default=60, help="Span of requested periods")
+    parser.add_argument('--cache-days', type=int, default=MeteringCache.MAX_DAYS, help="0 disables the cache")
+    parser.add_argument('--series-path', default=None, help="Directory of a series store backing the cache")
+    parser.add_argument('--rate', type=float, default=DataConnect.MAX_REQUESTS_PER_SECOND,
+                        help="Upstream requests per second allowed by the proxy")
+    parser.add_argument('--latency', type=float, default=0.1, help="Mean upstream latency (s)")
+    parser.add_argument('--jitter', type=float, default=0.05, help="Upstream latency standard deviation (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Ratio of upstream 500 responses")
+    parser.add_argument('--quota', type=float, default=None, help="Upstream requests per second before 429")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(levelname)-8s %(message)s')
+
+    asyncio.run(main(args))
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Local stand-in for Enedis Data Connect, to measure the proxy without
+# using any quota.
+#
+# Implements the token and metering data endpoints with payloads shaped
+# like the real ones, plus configurable latency, error rate and quota.
+#
+# Can be launched alone with
+# python -m benchmarks.fake_data_connect
+
+import asyncio
+import collections
+import datetime as dt
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+class FakeDataConnect:
+
+    LOAD_CURVE_MAX_DAYS = 7
+    TOKEN_EXPIRES_IN = 12600 # s
+
+    def __init__(self, latency=0.1, jitter=0.05, error_rate=0.0, max_requests_per_second=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.random = random.Random(seed)
+
+        self.calls = collections.Counter()
+        self.statuses = collections.Counter()
+
+        self.quota_tokens = max_requests_per_second
+        self.quota_updated_at = time.monotonic()
+
+        self.app = web.Application(middlewares=[self.middleware])
+        self.app.add_routes([web.post('/v1/oauth2/token', self.handle_token),
+                             web.get('/v4/metering_data/{direction}_load_curve', self.handle_load_curve),
+                             web.get('/v4/metering_data/daily_{direction}', self.handle_daily)])
+        self.runner = None
+
+    async def start(self, host='localhost', port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port=port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def over_quota(self):
+        if self.max_requests_per_second is None:
+            return False
+        now = time.monotonic()
+        self.quota_tokens = min(self.max_requests_per_second,
+                                self.quota_tokens + (now - self.quota_updated_at) * self.max_requests_per_second)
+        self.quota_updated_at = now
+        if self.quota_tokens < 1:
+            return True
+        self.quota_tokens -= 1
+        return False
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.calls[request.path] += 1
+
+        if self.over_quota():
+            response = self.error(429, 'too_many_requests', 'Quota exceeded')
+        else:
+            await asyncio.sleep(max(0, self.random.gauss(self.latency, self.jitter)))
+            if self.random.random() < self.error_rate:
+                response = self.error(500, 'server_error', 'Internal server error')
+            else:
+                response = await handler(request)
+
+        self.statuses[response.status] += 1
+        return response
+
+    @staticmethod
+    def error(status, error, description):
+        return web.json_response({'error': error, 'error_description': description}, status=status)
+
+    async def handle_token(self, request):
+        data = await request.post()
+        if data.get('grant_type') not in ('authorization_code', 'refresh_token'):
+            return self.error(400, 'invalid_request', 'Unsupported grant type')
+        return web.json_response({
+            'access_token': uuid.uuid4().hex,
+            'token_type': 'Bearer',
+            'expires_in': str(self.TOKEN_EXPIRES_IN),
+            'refresh_token': uuid.uuid4().hex,
+            'scope': 'am_application_scope default',
+            'refresh_token_issued_at': str(int(time.time() * 1000)),
+            'issued_at': str(int(time.time() * 1000)),
+            'usage_points_id': '22516914714270'
+        })
+
+    @staticmethod
+    def is_authorized(request):
+        return request.headers.get('Authorization', '').startswith('Bearer ')
+
+    @staticmethod
+    def parse_metering_request(request):
+        try:
+            usage_point_id = request.query['usage_point_id']
+            start = dt.date.fromisoformat(request.query['start'])
+            end = dt.date.fromisoformat(request.query['end'])
+        except (KeyError, ValueError):
+            return None
+        if start >= end:
+            return None
+        return usage_point_id, start, end
+
+    def meter_reading(self, usage_point_id, start, end, interval_reading, reading_type):
+        return {
+            'meter_reading': {
+                'usage_point_id': usage_point_id,
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+                'quality': 'BRUT',
+                'reading_type': reading_type,
+                'interval_reading': interval_reading
+            }
+        }
+
+    async def handle_load_curve(self, request):
+        if not self.is_authorized(request):
+            return self.error(401, 'invalid_token', 'Invalid access token')
+        parsed = self.parse_metering_request(request)
+        if parsed is None:
+            return self.error(400, 'ADAM-ERR0125', 'The requested period is not valid')
+        usage_point_id, start, end = parsed
+        if (end - start).days > self.LOAD_CURVE_MAX_DAYS:
+            return self.error(400, 'ADAM-ERR0125', 'The requested period cannot be greater than 7 days')
+
+        # Readings are dated at the end of their interval
+        interval_reading = []
+        date = dt.datetime.combine(start, dt.time())
+        end = dt.datetime.combine(end, dt.time())
+        while date < end:
+            date += dt.timedelta(minutes=30)
+            interval_reading.append({
+                'value': str(self.random.randint(100, 3000)),
+                'date': date.strftime('%Y-%m-%d %H:%M:%S'),
+                'interval_length': 'PT30M',
+                'measure_type': 'B'
+            })
+
+        return web.json_response(self.meter_reading(usage_point_id, start, end.date(), interval_reading, {
+            'unit': 'W',
+            'measurement_kind': 'power',
+            'aggregate': 'average',
+            'measuring_period': 'PT30M'
+        }))
+
+    async def handle_daily(self, request):
+        if not self.is_authorized(request):
+            return self.error(401, 'invalid_token', 'Invalid access token')
+        parsed = self.parse_metering_request(request)
+        if parsed is None:
+            return self.error(400, 'ADAM-ERR0125', 'The requested period is not valid')
+        usage_point_id, start, end = parsed
+
+        interval_reading = []
+        date = start
+        while date < end:
+            interval_reading.append({
+                'value': str(self.random.randint(2000, 30000)),
+                'date': date.isoformat()
+            })
+            date += dt.timedelta(days=1)
+
+        return web.json_response(self.meter_reading(usage_point_id, start, end, interval_reading, {
+            'unit': 'Wh',
+            'measurement_kind': 'energy',
+            'aggregate': 'sum',
+            'measuring_period': 'P1D'
+        }))
+
+if __name__ == '__main__':
+
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.1, help="Mean response latency (s)")
+    parser.add_argument('--jitter', type=float, default=0.05, help="Latency standard deviation (s)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Ratio of 500 responses")
+    parser.add_argument('--quota', type=float, default=None, help="Requests per second before 429 responses")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)-8s %(message)s')
+
+    async def run():
+        fake = FakeDataConnect(args.latency, args.jitter, args.error_rate, args.quota)
+        url = await fake.start(port=args.port)
+        logging.info(f'Fake Data Connect listening on {url}')
+        while True:
+            await asyncio.sleep(1)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
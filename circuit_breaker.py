@@ -0,0 +1,118 @@
+import logging
+import time
+
+# Fails fast while an upstream endpoint is down.
+#
+# - Closed: calls go through, consecutive failures are counted
+# - Open: after max_failures consecutive failures, calls are refused for
+#   reset_timeout
+# - Half open: then a single probe call goes through, closing the circuit
+#   if it succeeds, opening it again otherwise
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, max_failures=5, reset_timeout=30.0):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        """ Raise CircuitOpenError if the call should not be made """
+
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self.state = self.HALF_OPEN
+            self.probing = False
+
+        if self.state == self.CLOSED:
+            return
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return
+
+        raise CircuitOpenError(f"{self.name} is unavailable, retrying in {self.retry_in():.0f} s")
+
+    def success(self):
+        if self.state != self.CLOSED:
+            logging.warning(f"{self.name} is available again")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != self.OPEN:
+                logging.warning(f"{self.name} is unavailable after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def abort(self):
+        """ Call allowed by allow() that was not made, or that was cancelled """
+        self.probing = False
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestCircuitBreaker(unittest.TestCase):
+
+        def setUp(self):
+            self.circuit = CircuitBreaker('endpoint', max_failures=3, reset_timeout=60)
+
+        def fail(self, times):
+            for _ in range(times):
+                self.circuit.allow()
+                self.circuit.failure()
+
+        def test_opens_after_consecutive_failures(self):
+            self.fail(2)
+            self.circuit.allow()
+            self.circuit.success()
+            self.fail(2)
+            self.assertEqual(self.circuit.state, CircuitBreaker.CLOSED)
+            self.fail(1)
+            self.assertEqual(self.circuit.state, CircuitBreaker.OPEN)
+            with self.assertRaises(CircuitOpenError):
+                self.circuit.allow()
+
+        def test_single_probe_once_reset_timeout_elapsed(self):
+            self.fail(3)
+            self.circuit.opened_at -= 60
+            self.circuit.allow()
+            self.assertEqual(self.circuit.state, CircuitBreaker.HALF_OPEN)
+            with self.assertRaises(CircuitOpenError):
+                self.circuit.allow()
+            self.circuit.success()
+            self.assertEqual(self.circuit.state, CircuitBreaker.CLOSED)
+            self.circuit.allow()
+
+        def test_failed_probe_opens_again(self):
+            self.fail(3)
+            self.circuit.opened_at -= 60
+            self.fail(1)
+            self.assertEqual(self.circuit.state, CircuitBreaker.OPEN)
+            self.assertGreater(self.circuit.retry_in(), 59)
+
+        def test_aborted_probe_can_be_retried(self):
+            self.fail(3)
+            self.circuit.opened_at -= 60
+            self.circuit.allow()
+            self.circuit.abort()
+            self.circuit.allow()
+
+    unittest.main()
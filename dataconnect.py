@@ -1,14 +1,38 @@
-import requests
+import aiohttp
 import urllib
 import json
 
+import asyncio
+import bisect
+import calendar
+import email.utils
+import itertools
+import random
+import time
 import datetime as dt
 import pytz
 
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from rate_limiter import RateLimiter
+from metrics import Counter, Gauge, Histogram
+import tracing
+
+REQUEST_DURATION = Histogram('dataconnect_request_duration_seconds',
+                             "Data Connect calls, status being error when no response was received",
+                             ['environment', 'endpoint', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('dataconnect_requests_in_flight', "Data Connect calls waiting for a response", ['environment'])
+REQUESTS_WAITING = Gauge('dataconnect_requests_waiting', "Data Connect calls delayed by the rate limiter", ['environment'])
+RETRIES = Counter('dataconnect_retries', "Data Connect calls retried after a transient failure", ['environment', 'endpoint'])
+CIRCUIT_OPEN = Gauge('dataconnect_circuit_open', "Data Connect endpoints considered down, calls failing fast",
+                     ['environment', 'endpoint'])
+
 class DataConnectError(Exception):
-    def __init__(self, message, code=None):
+    # status is None when no response was received
+    def __init__(self, message, code=None, status=None, retry_after=None):
         self.message = message
         self.code = code
+        self.status = status
+        self.retry_after = retry_after
 
     def __str__(self):
         if self.code is not None:
@@ -18,6 +42,35 @@ class DataConnectError(Exception):
 
 class DataConnect():
 
+    MAX_CONNECTIONS = 32
+    KEEPALIVE_TIMEOUT = 60 # s
+    REQUEST_TIMEOUT = 60 # s
+
+    # A single metering data call can cover at most MAX_DAYS, starting no
+    # earlier than HISTORY (months, days) before the call date
+    LOAD_CURVE_MAX_DAYS = 7
+    LOAD_CURVE_HISTORY = (24, 15)
+    DAILY_MAX_DAYS = 365
+    DAILY_HISTORY = (36, 15)
+
+    # Calls made concurrently for a single long period
+    MAX_PARALLEL_CALLS = 4
+
+    # Quota of the application, shared by all calls to an endpoint
+    MAX_REQUESTS_PER_SECOND = 5
+
+    # Transient failures are retried after a capped exponential backoff with
+    # jitter, or the delay given by Retry-After if it is not too long
+    MAX_ATTEMPTS = 3
+    RETRY_BASE_DELAY = 0.5 # s
+    RETRY_MAX_DELAY = 8 # s
+    RETRY_AFTER_MAX = 30 # s
+
+    # Endpoints failing CIRCUIT_MAX_FAILURES times in a row are considered
+    # down, calls fail fast until one is probed after CIRCUIT_RESET_TIMEOUT
+    CIRCUIT_MAX_FAILURES = 5
+    CIRCUIT_RESET_TIMEOUT = 30 # s
+
     def __init__(self, client_id, client_secret, redirect_uri, sandbox=False):
 
         self.client_id = client_id
@@ -25,12 +78,38 @@ class DataConnect():
         self.redirect_uri = redirect_uri
 
         if sandbox:
+            self.environment = 'sandbox'
             self.authorize_endpoint = "https://gw.hml.api.enedis.fr"
             self.api_endpoint = "https://gw.hml.api.enedis.fr"
         else:
+            self.environment = 'production'
             self.authorize_endpoint = "https://mon-compte-particulier.enedis.fr"
             self.api_endpoint = "https://gw.prd.api.enedis.fr"
 
+        self._session = None
+        self.circuits = {}
+        self.rate_limiter = RateLimiter(rate=self.MAX_REQUESTS_PER_SECOND,
+                                        burst=self.MAX_REQUESTS_PER_SECOND,
+                                        max_concurrency=self.MAX_CONNECTIONS)
+
+    # A single session is kept per endpoint, its connector keeps connections
+    # alive so that concurrent calls do not each pay for a TLS handshake.
+    # It is created lazily since it has to be bound to the running loop.
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS,
+                                             keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     def make_authorize_url(self, duration, state=None):
 
         params = {
@@ -46,7 +125,7 @@ class DataConnect():
 
         return self.authorize_endpoint + '/dataconnect/v1/oauth2/authorize?' + params
 
-    def get_access_token(self, code = None, refresh_token = None):
+    async def get_access_token(self, code = None, refresh_token = None, requester = None):
 
         params = {'redirect_uri': self.redirect_uri }
         payload = {'client_id': self.client_id, 'client_secret': self.client_secret }
@@ -60,71 +139,230 @@ class DataConnect():
         else:
             raise ValueError("Either code or refresh_token has to be provided")
 
-        r = requests.post(self.api_endpoint + "/v1/oauth2/token", params=params, data=payload)
-        if r.status_code == 200:
-            return r.json()
-        else:
-            try:
-                error = r.json()
-                raise DataConnectError(error['error_description'], code=error['error'])
-            except (KeyError, json.decoder.JSONDecodeError) as e:
-                raise DataConnectError(r.text)
+        # Codes and refresh tokens can only be used once
+        return await self.request('POST', "/v1/oauth2/token", requester, idempotent=False, params=params, data=payload)
 
-    def get_load_curve(self, direction, usage_point_id, start_date, end_date, access_token):
+    async def get_load_curve(self, direction, usage_point_id, start_date, end_date, access_token, requester=None):
 
         if not direction in ['consumption', 'production']:
             raise ValueError(f'Unexpected load curve direction: {direction}')
 
-        start_date = self.date_to_isostring(start_date)
-        end_date = self.date_to_isostring(end_date)
-
-        params = {
-            'usage_point_id': usage_point_id,
-            'start': start_date,
-            'end': end_date
-        }
-        hed = {'Authorization': 'Bearer ' + access_token}
-
-        r = requests.get(f"{self.api_endpoint}/v4/metering_data/{direction}_load_curve", params=params, headers=hed)
-
-        if r.status_code == 200:
-            return r.json()
-        else:
-            try:
-                error = r.json()
-                raise DataConnectError(error['error_description'], code=error['error'])
-            except (KeyError, json.decoder.JSONDecodeError) as e:
-                raise DataConnectError(r.text)
+        return await self.get_metering_data(f"/v4/metering_data/{direction}_load_curve",
+                                            usage_point_id, start_date, end_date, access_token, requester,
+                                            self.LOAD_CURVE_MAX_DAYS, self.LOAD_CURVE_HISTORY)
 
     # Cette sous ressource renvoie les valeurs correspondant à la consommation quotidienne (en Wh)
     # sur chaque jour de la période demandée. Chaque valeur est daté. Un appel peut porter sur des
     # données datant au maximum de 36 mois et 15 jours avant la date d’appel.
 
-    def get_daily(self, direction, usage_point_id, start_date, end_date, access_token):
+    async def get_daily(self, direction, usage_point_id, start_date, end_date, access_token, requester=None):
 
         if not direction in ['consumption', 'production']:
             raise ValueError(f'Unexpected load curve direction: {direction}')
 
-        start_date = self.date_to_isostring(start_date)
-        end_date = self.date_to_isostring(end_date)
+        return await self.get_metering_data(f"/v4/metering_data/daily_{direction}",
+                                            usage_point_id, start_date, end_date, access_token, requester,
+                                            self.DAILY_MAX_DAYS, self.DAILY_HISTORY)
+
+    async def get_metering_data(self, path, usage_point_id, start_date, end_date, access_token, requester, max_days, history):
+
+        ranges = self.plan_ranges(start_date, end_date, max_days, history)
+        semaphore = asyncio.Semaphore(self.MAX_PARALLEL_CALLS)
+
+        async def get_range(start, end):
+            params = {
+                'usage_point_id': usage_point_id,
+                'start': self.date_to_isostring(start),
+                'end': self.date_to_isostring(end)
+            }
+            async with semaphore:
+                return await self.get(path, params, access_token, requester)
+
+        results = await asyncio.gather(*[get_range(start, end) for start, end in ranges])
+
+        # Stitch results back as if a single call was made
+        meter_reading = dict(results[0]['meter_reading']) if results else {'usage_point_id': usage_point_id}
+        meter_reading['start'] = self.date_to_isostring(start_date)
+        meter_reading['end'] = self.date_to_isostring(end_date)
+        meter_reading['interval_reading'] = [reading
+                                             for result in results
+                                             for reading in result['meter_reading'].get('interval_reading', [])]
+        return {'meter_reading': meter_reading}
+
+    @classmethod
+    def plan_ranges(cls, start_date, end_date, max_days, history):
+        """ Split [start_date, end_date) in ranges that can be requested to Data Connect """
+
+        start, end = cls.available_range(start_date, end_date, history)
+
+        ranges = []
+        while start < end:
+            range_end = min(start + dt.timedelta(days=max_days), end)
+            ranges.append((start, range_end))
+            start = range_end
+        return ranges
+
+    @classmethod
+    def available_range(cls, start_date, end_date, history):
+        """ [start_date, end_date) as dates, clamped to the history available upstream """
+
+        try:
+            start = dt.date.fromisoformat(cls.date_to_isostring(start_date))
+            end = dt.date.fromisoformat(cls.date_to_isostring(end_date))
+        except ValueError as e:
+            raise DataConnectError(f'Invalid date: {e}')
+
+        today = cls.today()
+        months, days = history
+        oldest = cls.months_before(today, months) - dt.timedelta(days=days)
+
+        if end <= oldest:
+            raise DataConnectError(f'The requested period cannot be anterior to {oldest}')
+
+        # Data of a given day is published the next day at the earliest
+        return max(start, oldest), min(end, today)
+
+    @staticmethod
+    def today():
+        return dt.datetime.now(pytz.timezone('Europe/Paris')).date()
+
+    @staticmethod
+    def months_before(day, months):
+        month = day.month - 1 - months
+        year = day.year + month // 12
+        month = month % 12 + 1
+        return dt.date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+    async def get(self, path, params, access_token, requester=None):
 
-        params = {
-            'usage_point_id': usage_point_id,
-            'start': start_date,
-            'end': end_date
-        }
         hed = {'Authorization': 'Bearer ' + access_token}
+        return await self.request('GET', path, requester, params=params, headers=hed)
+
+    def circuit(self, path):
+        circuit = self.circuits.get(path)
+        if circuit is None:
+            circuit = self.circuits[path] = CircuitBreaker(f'Data Connect {self.environment} {path}',
+                                                           self.CIRCUIT_MAX_FAILURES, self.CIRCUIT_RESET_TIMEOUT)
+        return circuit
+
+    def retry_delay(self, error, attempt, idempotent):
+        """ Seconds to wait before retrying a failed call, None if it should not be retried """
+
+        if attempt + 1 >= self.MAX_ATTEMPTS:
+            return None
+
+        if error.status == 429:
+            pass
+        elif not idempotent:
+            # Only retried if it could not have been processed
+            if not isinstance(error.__cause__, aiohttp.ClientConnectorError):
+                return None
+        elif error.status is not None and error.status < 500:
+            return None
+
+        delay = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if error.retry_after is not None:
+            if error.retry_after > self.RETRY_AFTER_MAX:
+                return None
+            delay = max(delay, error.retry_after)
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value):
+        """ Seconds of a Retry-After header, given as seconds or as an HTTP date """
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def request(self, method, path, requester, idempotent=True, **kwargs):
+
+        circuit = self.circuit(path)
+
+        for attempt in itertools.count():
+            try:
+                circuit.allow()
+            except CircuitOpenError as e:
+                raise DataConnectError(str(e))
 
-        r = requests.get(f"{self.api_endpoint}/v4/metering_data/daily_{direction}", params=params, headers=hed)
+            try:
+                result = await self.send(method, path, requester, **kwargs)
+            except DataConnectError as e:
+                if e.status is None or e.status >= 500:
+                    circuit.failure()
+                else:
+                    circuit.success()
+                CIRCUIT_OPEN.set(int(circuit.state == CircuitBreaker.OPEN), environment=self.environment, endpoint=path)
+                delay = self.retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise
+                RETRIES.inc(environment=self.environment, endpoint=path)
+                await asyncio.sleep(delay)
+            except BaseException:
+                circuit.abort()
+                raise
+            else:
+                circuit.success()
+                CIRCUIT_OPEN.set(0, environment=self.environment, endpoint=path)
+                return result
+
+    async def send(self, method, path, requester, **kwargs):
+
+        REQUESTS_WAITING.inc(environment=self.environment)
+        try:
+            with tracing.span('rate_limit'):
+                await self.rate_limiter.acquire(requester)
+        finally:
+            REQUESTS_WAITING.dec(environment=self.environment)
+
+        REQUESTS_IN_FLIGHT.inc(environment=self.environment)
+        started_at = time.monotonic()
+        status = None
+
+        try:
+            with tracing.span('http'):
+                async with self.session.request(method, self.api_endpoint + path, **kwargs) as r:
+                    status = r.status
+                    try:
+                        return await self.parse_response(r)
+                    except DataConnectError as e:
+                        e.retry_after = self.parse_retry_after(r.headers.get('Retry-After'))
+                        raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise DataConnectError(f"Unable to reach Data Connect: {e!r}") from e
+        except asyncio.CancelledError:
+            # The requester went away, this says nothing about the API
+            status = 'cancelled'
+            raise
+        finally:
+            latency = time.monotonic() - started_at
+            if status == 'cancelled':
+                self.rate_limiter.cancel()
+            else:
+                self.rate_limiter.release(status, latency)
+            REQUESTS_IN_FLIGHT.dec(environment=self.environment)
+            REQUEST_DURATION.observe(latency, environment=self.environment, endpoint=path,
+                                     status='error' if status is None else status)
 
-        if r.status_code == 200:
-            return r.json()
+    @staticmethod
+    async def parse_response(r):
+        text = await r.text()
+        if r.status == 200:
+            with tracing.span('json_decode'):
+                return json.loads(text)
         else:
             try:
-                error = r.json()
-                raise DataConnectError(error['error_description'], code=error['error'])
-            except (KeyError, json.decoder.JSONDecodeError) as e:
-                raise DataConnectError(r.text)
+                error = json.loads(text)
+                raise DataConnectError(error['error_description'], code=error['error'], status=r.status)
+            except (KeyError, TypeError, json.decoder.JSONDecodeError) as e:
+                raise DataConnectError(text, status=r.status)
 
     @staticmethod
     def date_to_isostring(date):
@@ -157,6 +395,75 @@ class DataConnect():
 
         #print(paris_tz.localize(date).astimezone(pytz.utc).strftime("%s"))
 
+    @staticmethod
+    def timestamps(dates):
+        """ UTC timestamps of YYYY-MM-DD or YYYY-MM-DD HH:MM:SS Paris dates, same as datetime() or date() """
+        with tracing.span('timestamps'):
+            return PARIS_TIME.timestamps(dates)
+
+class LocalTime:
+
+    # Converting a whole load curve with strptime and localize is slow.
+    # Local times are converted with arithmetic instead, looking up the UTC
+    # offset in a table of the local times at which it changes. The table
+    # is built from pytz once per year, with the same is_dst=False choice
+    # as localize() for ambiguous and non-existent local times.
+
+    EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+    PROBE_STEP = dt.timedelta(minutes=15)
+
+    def __init__(self, tz):
+        self.tz = tz
+        self.years = {}
+
+    def offset(self, naive):
+        return int(self.tz.localize(naive).utcoffset().total_seconds())
+
+    def local_timestamp(self, naive):
+        return (naive.toordinal() - self.EPOCH_ORDINAL) * 86400 + naive.hour * 3600 + naive.minute * 60 + naive.second
+
+    def year_table(self, year):
+        table = self.years.get(year)
+        if table is None:
+            table = self.years[year] = self.build_year_table(year)
+        return table
+
+    def build_year_table(self, year):
+        start = dt.datetime(year, 1, 1)
+        starts = [self.local_timestamp(start)]
+        offsets = [self.offset(start)]
+
+        # Look for offset changes from one day at noon to the next, then
+        # find out when it happened
+        noon = start + dt.timedelta(hours=12)
+        while noon.year == year:
+            next_noon = noon + dt.timedelta(days=1)
+            if self.offset(next_noon) != offsets[-1]:
+                probe = noon
+                while self.offset(probe) == offsets[-1]:
+                    probe += self.PROBE_STEP
+                starts.append(self.local_timestamp(probe))
+                offsets.append(self.offset(probe))
+            noon = next_noon
+
+        return starts, offsets
+
+    def timestamps(self, dates):
+        result = []
+        days = {}
+        for date in dates:
+            day = date[:10]
+            local = days.get(day)
+            if local is None:
+                local = days[day] = (dt.date.fromisoformat(day).toordinal() - self.EPOCH_ORDINAL) * 86400
+            if len(date) > 10:
+                local += int(date[11:13]) * 3600 + int(date[14:16]) * 60 + int(date[17:19])
+            starts, offsets = self.year_table(int(day[:4]))
+            result.append(local - offsets[bisect.bisect_right(starts, local) - 1])
+        return result
+
+PARIS_TIME = LocalTime(pytz.timezone('Europe/Paris'))
+
 TEST_CLIENTS = {
     "0": "Client qui ne possède qu’un seul point de livraison de consommation pour lequel il a activé la courbe de charge. Ses données sont remontées de manière exacte (sans « trou » de données) et son compteur a été mis en service au début du déploiement Linky.",
     "1": "Client qui ne possède qu’un seul point de livraison de consommation pour lequel il a activé la courbe de charge. Ses données sont remontées de manière exacte (sans « trou » de données) et son compteur a été mis en service le 27 août 2019.",
@@ -172,6 +479,7 @@ TEST_CLIENTS = {
 
 if __name__ == '__main__':
 
+    import contextlib
     import unittest
 
     class TestDataConnect(unittest.TestCase):
@@ -209,4 +517,178 @@ if __name__ == '__main__':
             date = DataConnect.date_to_isostring(dt.datetime(2020, 5, 22, 0, 0))
             self.assertEqual(date, '2020-05-22')
 
+        def test_months_before(self):
+            self.assertEqual(DataConnect.months_before(dt.date(2020, 5, 22), 36), dt.date(2017, 5, 22))
+            self.assertEqual(DataConnect.months_before(dt.date(2020, 1, 15), 1), dt.date(2019, 12, 15))
+            self.assertEqual(DataConnect.months_before(dt.date(2020, 3, 31), 1), dt.date(2020, 2, 29))
+
+    class TestTimestamps(unittest.TestCase):
+
+        def assertSameAsLocalize(self, start, end):
+            dates = []
+            date = start
+            while date < end:
+                dates.append(date.strftime('%Y-%m-%d %H:%M:%S'))
+                date += dt.timedelta(minutes=30)
+            expected = [int(DataConnect.datetime(date).astimezone(pytz.utc).timestamp()) for date in dates]
+            self.assertEqual(DataConnect.timestamps(dates), expected)
+
+        def test_daylight_saving_time_start(self):
+            self.assertSameAsLocalize(dt.datetime(2020, 3, 28), dt.datetime(2020, 3, 31))
+            self.assertSameAsLocalize(dt.datetime(2021, 3, 27), dt.datetime(2021, 3, 30))
+
+        def test_daylight_saving_time_end(self):
+            self.assertSameAsLocalize(dt.datetime(2020, 10, 24), dt.datetime(2020, 10, 27))
+            self.assertSameAsLocalize(dt.datetime(2021, 10, 30), dt.datetime(2021, 11, 2))
+
+        def test_whole_year(self):
+            self.assertSameAsLocalize(dt.datetime(2019, 12, 31), dt.datetime(2021, 1, 2))
+
+        def test_dates(self):
+            dates = ['2020-03-29', '2020-03-30', '2020-10-25', '2020-10-26', '2021-01-01']
+            expected = [int(DataConnect.date(date).astimezone(pytz.utc).timestamp()) for date in dates]
+            self.assertEqual(DataConnect.timestamps(dates), expected)
+
+    class TestRangePlanner(unittest.TestCase):
+
+        def setUp(self):
+            self.today = DataConnect.today
+            DataConnect.today = staticmethod(lambda: dt.date(2020, 6, 30))
+
+        def tearDown(self):
+            DataConnect.today = self.today
+
+        def test_long_period_is_split(self):
+            ranges = DataConnect.plan_ranges('2020-06-01', '2020-06-20', 7, (24, 15))
+            self.assertEqual(ranges, [(dt.date(2020, 6, 1), dt.date(2020, 6, 8)),
+                                      (dt.date(2020, 6, 8), dt.date(2020, 6, 15)),
+                                      (dt.date(2020, 6, 15), dt.date(2020, 6, 20))])
+
+        def test_period_is_clamped_to_history(self):
+            ranges = DataConnect.plan_ranges('2010-01-01', '2018-06-20', 365, (24, 15))
+            self.assertEqual(ranges, [(dt.date(2018, 6, 15), dt.date(2018, 6, 20))])
+
+        def test_period_is_clamped_to_today(self):
+            ranges = DataConnect.plan_ranges('2020-06-28', '2020-07-10', 7, (24, 15))
+            self.assertEqual(ranges, [(dt.date(2020, 6, 28), dt.date(2020, 6, 30))])
+            self.assertEqual(DataConnect.plan_ranges('2020-07-01', '2020-07-10', 7, (24, 15)), [])
+
+        def test_period_older_than_history_fails(self):
+            with self.assertRaises(DataConnectError):
+                DataConnect.plan_ranges('2010-01-01', '2011-01-01', 7, (24, 15))
+
+        def test_invalid_date_fails(self):
+            with self.assertRaises(DataConnectError):
+                DataConnect.plan_ranges('2020-13-01', '2020-06-20', 7, (24, 15))
+
+    class TestDataConnectResponses(unittest.IsolatedAsyncioTestCase):
+
+        class Response:
+
+            def __init__(self, status, text):
+                self.status = status
+                self._text = text
+
+            async def text(self):
+                return self._text
+
+        async def test_json_is_returned_on_success(self):
+            r = self.Response(200, '{"meter_reading": {}}')
+            self.assertEqual(await DataConnect.parse_response(r), {'meter_reading': {}})
+
+        async def test_upstream_error_is_raised(self):
+            r = self.Response(403, '{"error": "ADAM-ERR0069", "error_description": "No consent"}')
+            with self.assertRaises(DataConnectError) as cm:
+                await DataConnect.parse_response(r)
+            self.assertEqual(cm.exception.code, 'ADAM-ERR0069')
+            self.assertEqual(cm.exception.message, 'No consent')
+
+        async def test_unexpected_error_body_is_raised_as_text(self):
+            r = self.Response(502, 'Bad Gateway')
+            with self.assertRaises(DataConnectError) as cm:
+                await DataConnect.parse_response(r)
+            self.assertEqual(cm.exception.message, 'Bad Gateway')
+
+    class TestRetries(unittest.IsolatedAsyncioTestCase):
+
+        class DataConnect(DataConnect):
+
+            RETRY_BASE_DELAY = 0.001
+            CIRCUIT_MAX_FAILURES = 3
+
+            def __init__(self, errors):
+                super().__init__('client-id', 'client-secret', 'https://example.com/redirect')
+                self.errors = errors
+                self.calls = 0
+
+            async def send(self, method, path, requester, **kwargs):
+                self.calls += 1
+                if self.errors:
+                    raise self.errors.pop(0)
+                return {'meter_reading': {}}
+
+        async def test_transient_errors_are_retried(self):
+            data_connect = self.DataConnect([DataConnectError('Bad Gateway', status=502),
+                                             DataConnectError('Too many requests', status=429, retry_after=0.01)])
+            self.assertEqual(await data_connect.get('/v4/metering_data/daily_consumption', {}, 'token'), {'meter_reading': {}})
+            self.assertEqual(data_connect.calls, 3)
+
+        async def test_business_errors_are_not_retried(self):
+            data_connect = self.DataConnect([DataConnectError('No consent', code='ADAM-ERR0069', status=403)])
+            with self.assertRaises(DataConnectError):
+                await data_connect.get('/v4/metering_data/daily_consumption', {}, 'token')
+            self.assertEqual(data_connect.calls, 1)
+
+        async def test_refreshes_are_only_retried_when_not_processed(self):
+            data_connect = self.DataConnect([DataConnectError('Internal error', status=500)])
+            with self.assertRaises(DataConnectError):
+                await data_connect.get_access_token(refresh_token='refresh')
+            self.assertEqual(data_connect.calls, 1)
+            data_connect = self.DataConnect([DataConnectError('Too many requests', status=429)])
+            await data_connect.get_access_token(refresh_token='refresh')
+            self.assertEqual(data_connect.calls, 2)
+
+        async def test_long_retry_after_is_not_waited(self):
+            data_connect = self.DataConnect([DataConnectError('Too many requests', status=429, retry_after=3600)])
+            with self.assertRaises(DataConnectError):
+                await data_connect.get('/v4/metering_data/daily_consumption', {}, 'token')
+            self.assertEqual(data_connect.calls, 1)
+
+        async def test_calls_fail_fast_while_circuit_is_open(self):
+            data_connect = self.DataConnect([DataConnectError('Unavailable', status=503) for _ in range(3)])
+            with self.assertRaises(DataConnectError):
+                await data_connect.get('/v4/metering_data/daily_consumption', {}, 'token')
+            with self.assertRaises(DataConnectError):
+                await data_connect.get('/v4/metering_data/daily_consumption', {}, 'token')
+            self.assertEqual(data_connect.calls, 3)
+            # Other endpoints are not affected
+            await data_connect.get('/v4/metering_data/consumption_load_curve', {}, 'token')
+
+        async def test_cancelled_calls_do_not_decrease_concurrency(self):
+
+            class Session:
+                closed = False
+
+                @contextlib.asynccontextmanager
+                async def request(self, method, url, **kwargs):
+                    await asyncio.sleep(3600)
+                    yield
+
+            data_connect = DataConnect('client-id', 'client-secret', 'https://example.com/redirect')
+            data_connect._session = Session()
+            concurrency = data_connect.rate_limiter.concurrency
+            task = asyncio.create_task(data_connect.send('GET', '/v4/metering_data/daily_consumption', 'requester'))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(data_connect.rate_limiter.in_flight, 0)
+            self.assertEqual(data_connect.rate_limiter.concurrency, concurrency)
+
+        def test_retry_after_date(self):
+            date = email.utils.formatdate(time.time() + 120, usegmt=True)
+            self.assertAlmostEqual(DataConnect.parse_retry_after(date), 120, delta=2)
+            self.assertEqual(DataConnect.parse_retry_after('5'), 5)
+            self.assertIsNone(DataConnect.parse_retry_after('soon'))
+
     unittest.main()
@@ -0,0 +1,197 @@
+import asyncio
+import datetime as dt
+import logging
+import random
+import time
+
+import pytz
+
+from dataconnect import DataConnect, DataConnectError
+from metrics import Counter
+from rate_limiter import RateLimiter
+
+# Fetches recently published metering data of every usage point during the
+# night, so that requests for recent days are served from the metering
+# cache instead of waiting for Data Connect.
+#
+# - Runs once a day at start_time (Paris time), delayed by a random part of
+#   jitter, usage points being visited in random order
+# - Calls are paced to rate requests per second, well below the quota,
+#   and are paused while interactive calls are waiting for the Data Connect
+#   rate limiter
+# - Harvested recent days are kept in the metering cache for recent_ttl
+# - Processes sharing the state database may all run a harvester, a lease
+#   taken for the day lets a single one of them harvest
+
+HARVESTS = Counter('dataconnect_proxy_harvests', "Metering data fetched in background", ['endpoint', 'result'])
+
+class Harvester:
+
+    START_TIME = '04:00'
+    JITTER = 2 * 3600 # s
+    DAYS = 2
+    RATE = 1.0 # requests per second
+    CONCURRENCY = 4
+    ENDPOINTS = ('daily', 'load_curve')
+    DIRECTIONS = ('consumption',)
+    RECENT_TTL = 20 * 3600 # s
+    BUSY_DELAY = 1 # s
+    # Kept once the harvest is done, so that it is not run again that day
+    LEASE_TTL = 24 * 3600 # s
+
+    def __init__(self, proxy, start_time=START_TIME, jitter=JITTER, days=DAYS, rate=RATE, concurrency=CONCURRENCY,
+                 endpoints=ENDPOINTS, directions=DIRECTIONS, recent_ttl=RECENT_TTL):
+        self.proxy = proxy
+        self.start_time = dt.time.fromisoformat(start_time)
+        self.jitter = jitter
+        self.days = days
+        self.concurrency = concurrency
+        self.endpoints = list(endpoints)
+        self.directions = list(directions)
+        self.limiter = RateLimiter(rate=rate, burst=1, max_concurrency=concurrency)
+        self.tz = pytz.timezone('Europe/Paris')
+
+        # Days harvested during the night are served until the next one
+        proxy.metering_cache.recent_ttl = dt.timedelta(seconds=recent_ttl)
+
+    def next_run_delay(self, now=None):
+        """ Seconds until the next start_time, jitter excluded """
+        if now is None:
+            now = dt.datetime.now(self.tz)
+        start = self.tz.localize(dt.datetime.combine(now.date(), self.start_time))
+        if start <= now:
+            start = self.tz.localize(dt.datetime.combine(now.date() + dt.timedelta(days=1), self.start_time))
+        return (start - now).total_seconds()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.next_run_delay() + random.uniform(0, self.jitter))
+            try:
+                if self.claim():
+                    await self.harvest()
+                else:
+                    logging.info("Harvest run by another process")
+            except Exception:
+                logging.exception("Harvest failed")
+
+    def claim(self):
+        """ Whether this process harvests today """
+        today = dt.datetime.now(self.tz).date()
+        return self.proxy.state_store.acquire_lock(f'harvest:{today}', self.proxy.owner, self.LEASE_TTL)
+
+    def jobs(self):
+        """ (endpoint, direction, jid, usage_point_id) to fetch, each usage point once, in random order """
+
+        usage_points = {usage_point_id: next(iter(subscribers))
+                        for usage_point_id, subscribers in self.proxy.usage_points.by_usage_point.items()}
+
+        jobs = [(endpoint, direction, jid, usage_point_id)
+                for usage_point_id, jid in usage_points.items()
+                for endpoint in self.endpoints
+                for direction in self.directions]
+        random.shuffle(jobs)
+        return jobs
+
+    def interactive_calls_waiting(self):
+        return any(data_connect.rate_limiter.waiting() > 0
+                   for data_connect in [self.proxy.data_connect_prod, self.proxy.data_connect_sandbox])
+
+    async def harvest(self):
+
+        end = DataConnect.today()
+        start = end - dt.timedelta(days=self.days)
+        jobs = iter(self.jobs())
+        failures = 0
+        count = 0
+        started_at = time.monotonic()
+
+        async def worker():
+            nonlocal failures, count
+            for endpoint, direction, jid, usage_point_id in jobs:
+                while self.interactive_calls_waiting():
+                    await asyncio.sleep(self.BUSY_DELAY)
+                await self.limiter.acquire()
+                call_started_at = time.monotonic()
+                count += 1
+                try:
+                    await self.proxy.get_metering_data(endpoint, direction, jid, usage_point_id, start, end)
+                    HARVESTS.inc(endpoint=endpoint, result='success')
+                except DataConnectError as e:
+                    failures += 1
+                    HARVESTS.inc(endpoint=endpoint, result='failure')
+                    logging.debug(f"Unable to harvest {endpoint} {direction} of {usage_point_id}: {e}")
+                finally:
+                    self.limiter.release(200, time.monotonic() - call_started_at)
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+        logging.info(f"Harvested {count - failures}/{count} in {time.monotonic() - started_at:.0f} s, from {start} to {end}")
+
+        return count, failures
+
+if __name__ == '__main__':
+
+    import unittest
+    from metering_cache import MeteringCache
+
+    class TestHarvester(unittest.IsolatedAsyncioTestCase):
+
+        class FakeDataConnect:
+
+            def __init__(self):
+                self.rate_limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=10)
+
+        class FakeProxy:
+
+            def __init__(self):
+                self.usage_points = type('UsagePoints', (), {})()
+                self.usage_points.by_usage_point = {
+                    '22516914714270': {'a@example.com': '0', 'b@example.com': '0'},
+                    '22516914714271': {'a@example.com': '1'}
+                }
+                self.metering_cache = MeteringCache()
+                self.data_connect_prod = TestHarvester.FakeDataConnect()
+                self.data_connect_sandbox = TestHarvester.FakeDataConnect()
+                self.calls = []
+
+            async def get_metering_data(self, endpoint, direction, jid, usage_point_id, start_date, end_date):
+                self.calls.append((endpoint, usage_point_id, start_date, end_date))
+                if usage_point_id == '22516914714271':
+                    raise DataConnectError('No consent', code='ADAM-ERR0069')
+
+        def setUp(self):
+            self.proxy = self.FakeProxy()
+            self.harvester = Harvester(self.proxy, rate=1000)
+
+        async def test_each_usage_point_is_harvested_once(self):
+            count, failures = await self.harvester.harvest()
+            self.assertEqual((count, failures), (4, 2))
+            self.assertEqual(sorted((endpoint, usage_point_id) for endpoint, usage_point_id, _, _ in self.proxy.calls),
+                             [('daily', '22516914714270'), ('daily', '22516914714271'),
+                              ('load_curve', '22516914714270'), ('load_curve', '22516914714271')])
+            _, _, start, end = self.proxy.calls[0]
+            self.assertEqual(end - start, dt.timedelta(days=Harvester.DAYS))
+
+        def test_a_single_process_harvests(self):
+            from state_store import StateStore
+            self.proxy.state_store = StateStore(':memory:')
+            self.proxy.owner = 'a'
+            other = self.FakeProxy()
+            other.state_store = self.proxy.state_store
+            other.owner = 'b'
+            self.assertTrue(self.harvester.claim())
+            self.assertTrue(self.harvester.claim())
+            self.assertFalse(Harvester(other).claim())
+            self.proxy.state_store.close()
+
+        def test_recent_days_are_cached(self):
+            self.assertEqual(self.proxy.metering_cache.recent_ttl, dt.timedelta(seconds=Harvester.RECENT_TTL))
+
+        def test_next_run(self):
+            tz = self.harvester.tz
+            self.assertEqual(self.harvester.next_run_delay(tz.localize(dt.datetime(2020, 6, 1, 3, 0))), 3600)
+            self.assertEqual(self.harvester.next_run_delay(tz.localize(dt.datetime(2020, 6, 1, 5, 0))), 23 * 3600)
+            # Night of the change to summer time
+            self.assertEqual(self.harvester.next_run_delay(tz.localize(dt.datetime(2020, 3, 28, 5, 0))), 22 * 3600)
+
+    unittest.main()
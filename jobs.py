@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics import Counter, Gauge, Histogram
+import tracing
+
+# Background jobs of data commands run in job mode.
+#
+# The command responds at once with the job id, the job then makes its
+# requests and pushes the results as messages. A job counts its requests
+# done and failed, its status is kept for STATUS_TTL once it is finished:
+#
+# - running
+# - completed: all requests done, some of them may have failed
+# - failed: all requests failed, or the job itself did
+
+JOBS = Counter('xmpp_jobs', "Data command jobs finished", ['node', 'status'])
+JOBS_RUNNING = Gauge('xmpp_jobs_running', "Data command jobs being processed", ['node'])
+JOB_DURATION = Histogram('xmpp_job_duration_seconds', "Data command jobs durations", ['node', 'status'])
+
+class Job:
+
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+    def __init__(self, id, jid, node, total):
+        self.id = id
+        self.jid = jid
+        self.node = node
+        self.total = total
+        self.done = 0
+        self.failures = 0
+        self.messages = 0
+        self.status = self.RUNNING
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+    def progress(self):
+        return f'{self.done}/{self.total}'
+
+class Jobs:
+
+    MAX_RUNNING_PER_JID = 10
+    STATUS_TTL = 24 * 3600 # s
+    MAX_SIZE = 10000
+
+    def __init__(self, on_finished=None):
+        # Called with each job once it is finished
+        self.on_finished = on_finished
+        self.data = OrderedDict()
+
+    def running(self, jid):
+        return sum(1 for job in self.data.values() if job.status == Job.RUNNING and job.jid.bare == jid.bare)
+
+    def start(self, jid, node, total, run):
+        """ Job running the coroutine function run(job) in the background, for the full JID jid """
+
+        self.sweep()
+
+        job = Job(uuid.uuid4().hex[:12], jid, node, total)
+        self.data[job.id] = job
+        JOBS_RUNNING.inc(node=node)
+        job.task = asyncio.ensure_future(self.run(job, run))
+        return job
+
+    async def run(self, job, run):
+        # Traced apart from the command that started it
+        tracing.start(job.node, job.id)
+        try:
+            await run(job)
+            job.status = Job.FAILED if job.total and job.failures == job.total else Job.COMPLETED
+        except asyncio.CancelledError:
+            job.status = Job.FAILED
+            job.error = 'Cancelled'
+            raise
+        except Exception as e:
+            logging.exception(f'Job {job.id} failed')
+            job.status = Job.FAILED
+            job.error = str(e)
+        finally:
+            tracing.finish()
+            job.finished_at = time.time()
+            JOBS_RUNNING.dec(node=job.node)
+            JOBS.inc(node=job.node, status=job.status)
+            JOB_DURATION.observe(job.finished_at - job.created_at, node=job.node, status=job.status)
+            if self.on_finished is not None:
+                self.on_finished(job)
+
+    def get(self, jid, job_id):
+        """ Job of the bare JID of jid, None if unknown """
+        job = self.data.get(job_id)
+        if job is None or job.jid.bare != jid.bare:
+            return None
+        return job
+
+    def sweep(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.data.items()
+                       if job.finished_at is not None and job.finished_at + self.STATUS_TTL < now]:
+            del self.data[job_id]
+        # Oldest finished jobs first
+        for job_id in [job_id for job_id, job in self.data.items() if job.finished_at is not None]:
+            if len(self.data) <= self.MAX_SIZE:
+                break
+            del self.data[job_id]
+
+    async def close(self):
+        tasks = [job.task for job in self.data.values() if job.status == Job.RUNNING]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+if __name__ == '__main__':
+
+    import unittest
+
+    from slixmpp import JID
+
+    class TestJobs(unittest.IsolatedAsyncioTestCase):
+
+        def setUp(self):
+            self.finished = []
+            self.jobs = Jobs(on_finished=self.finished.append)
+
+        async def test_job_is_run_in_background(self):
+            release = asyncio.Event()
+
+            async def run(job):
+                job.done += 1
+                await release.wait()
+                job.failures += 1
+                job.done += 1
+
+            job = self.jobs.start(JID('a@example.com/res'), 'get_daily_batch', 2, run)
+            await asyncio.sleep(0)
+            self.assertEqual((job.status, job.progress()), (Job.RUNNING, '1/2'))
+            self.assertEqual(self.jobs.running(JID('a@example.com/other')), 1)
+            release.set()
+            await job.task
+            self.assertEqual((job.status, job.progress(), job.failures), (Job.COMPLETED, '2/2', 1))
+            self.assertEqual(self.finished, [job])
+
+        async def test_failed_jobs(self):
+            async def fail(job):
+                job.done = job.failures = 1
+
+            async def crash(job):
+                raise RuntimeError('Unexpected')
+
+            failed = self.jobs.start(JID('a@example.com/res'), 'get_daily', 1, fail)
+            crashed = self.jobs.start(JID('a@example.com/res'), 'get_daily', 1, crash)
+            await asyncio.gather(failed.task, crashed.task)
+            self.assertEqual(failed.status, Job.FAILED)
+            self.assertEqual((crashed.status, crashed.error), (Job.FAILED, 'Unexpected'))
+
+        async def test_jobs_are_only_visible_to_their_owner(self):
+            async def run(job):
+                pass
+
+            job = self.jobs.start(JID('a@example.com/res'), 'get_daily', 1, run)
+            self.assertIs(self.jobs.get(JID('a@example.com'), job.id), job)
+            self.assertIsNone(self.jobs.get(JID('b@example.com/res'), job.id))
+            self.assertIsNone(self.jobs.get(JID('a@example.com'), 'unknown'))
+            await job.task
+
+        async def test_finished_jobs_expire(self):
+            async def run(job):
+                pass
+
+            job = self.jobs.start(JID('a@example.com/res'), 'get_daily', 1, run)
+            await job.task
+            job.finished_at -= Jobs.STATUS_TTL + 1
+            self.jobs.sweep()
+            self.assertEqual(len(self.jobs.data), 0)
+
+    unittest.main()
@@ -6,41 +6,142 @@ import json
 import os
 import asyncio
 import bleach
+import random
+import signal
+import socket
+import sqlite3
+import tempfile
+import time
+import itertools
 import unittest
 
 import threading
 import datetime as dt
 
 from dataconnect import DataConnect, DataConnectError
+from harvester import Harvester
+from metering_cache import MeteringCache
+from metrics import Counter, Gauge
+from series_store import SeriesStore
+from state_store import StateStore
+from usage_point_facts import UsagePointFacts
+import tracing
 from xmpp_interface import XmppInterface
 
 import web_interface.app
 
+TOKEN_REFRESHES = Counter('dataconnect_token_refreshes', "Access token refreshes", ['environment', 'trigger'])
+TOKEN_REFRESH_FAILURES = Counter('dataconnect_token_refresh_failures', "Access token refreshes that failed", ['environment', 'trigger'])
+REGISTRY_SIZE = Gauge('dataconnect_proxy_registry_size', "Entries of the proxy registries", ['registry'])
+COALESCED_FETCHES = Counter('dataconnect_proxy_coalesced_fetches',
+                            "Metering data fetches served by an identical call already in progress", ['endpoint'])
+CACHE_DAYS = Counter('dataconnect_proxy_cache_days',
+                     "Requested days of metering data, found in cache (hit) or fetched (miss)", ['endpoint', 'result'])
+
+class Record:
+
+    # Registries hold many small records, slots keep them compact.
+    # Item access is kept for code written against the former dicts.
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+class AuthorizeDescription(Record):
+
+    __slots__ = ('jid', 'name', 'service', 'logo_url', 'created_at', 'accessed_at')
+
+    def __init__(self, jid, name, service, logo_url, created_at, accessed_at):
+        self.jid = jid
+        self.name = name
+        self.service = service
+        self.logo_url = logo_url
+        self.created_at = created_at
+        self.accessed_at = accessed_at
+
+    @classmethod
+    def from_dict(cls, description):
+        # Not tracked before, considered as accessed now
+        return cls(description['jid'], description['name'], description['service'], description['logo_url'],
+                   description.get('created_at') or 0, description.get('accessed_at') or time.time())
+
 class AuthorizeDescriptions:
 
-    def __init__(self):
+    # Each get_authorize_uri command adds a description, backing an
+    # authorize link that is given to end users. Descriptions expire once
+    # unused for TTL, and at most MAX_SIZE are kept, least recently used
+    # first. Accesses are persisted at most every ACCESS_RESOLUTION.
+    TTL = 365 * 24 * 3600 # s
+    ACCESS_RESOLUTION = 24 * 3600 # s
+    MAX_SIZE = 1000000
+
+    def __init__(self, store=None):
         self.data = {}
+        self.store = store
+
+    def load(self, data):
+        self.data = {}
+        for uid, description in sorted(data.items(), key=lambda item: item[1].get('accessed_at') or time.time()):
+            self.data[uid] = AuthorizeDescription.from_dict(description)
 
     # TODO rename service to desciption when switching to database
-    def add(self, jid, name, service, logo_url):
+    def add(self, jid, name, service, logo_url=None):
         while True:
             uid = str(uuid.uuid4())[:8]
             if not uid in self.data:
                 break
 
-        service = bleach.clean(service, bleach.sanitizer.ALLOWED_TAGS + ['p', 'br'])
+        service = bleach.clean(service, list(bleach.sanitizer.ALLOWED_TAGS) + ['p', 'br'])
 
-        self.data[uid] = {
-            'jid': jid,
-            'name': name,
-            'service': service,
-            'logo_url': logo_url
-        }
+        now = time.time()
+        self.data[uid] = AuthorizeDescription(jid, name, service, logo_url, now, now)
+
+        if self.store is not None:
+            self.store.set_authorize_description(uid, self.data[uid])
+
+        if len(self.data) > self.MAX_SIZE:
+            self.remove(list(itertools.islice(self.data, len(self.data) - self.MAX_SIZE)))
 
         return uid
 
+    def remove(self, uids):
+        for uid in uids:
+            del self.data[uid]
+        if self.store is not None:
+            self.store.delete_authorize_descriptions(uids)
+
+    def sweep(self):
+        # Descriptions reloaded from other processes are not in access order
+        expired_before = time.time() - self.TTL
+        expired = [uid for uid, description in self.data.items() if description.accessed_at < expired_before]
+        if expired:
+            self.remove(expired)
+        return len(expired)
+
     def get(self, uid):
-        return self.data.get(uid)
+        description = self.data.get(uid)
+        if description is None:
+            return None
+        now = time.time()
+        if description.accessed_at < now - self.TTL:
+            return None
+        if description.accessed_at < now - self.ACCESS_RESOLUTION:
+            description.accessed_at = now
+            # Most recently used last
+            self.data[uid] = self.data.pop(uid)
+            if self.store is not None:
+                self.store.set_authorize_description(uid, description)
+        return description
+
+    def reload(self, uid):
+        description = self.store.get_authorize_description(uid)
+        self.data.pop(uid, None)
+        if description is not None:
+            self.data[uid] = AuthorizeDescription.from_dict(description)
 
 class AuthorizeDescriptionsTest(unittest.TestCase):
 
@@ -61,10 +162,54 @@ class AuthorizeDescriptionsTest(unittest.TestCase):
         uid = self.authorize_descriptions.add(self.DEFAULT_JID, self.DEFAULT_NAME, html_desc)
         self.assertEqual(self.authorize_descriptions.get(uid)['service'], html_desc)
 
+    def test_unused_descriptions_expire(self):
+        uids = [self.authorize_descriptions.add(self.DEFAULT_JID, self.DEFAULT_NAME, 'desc') for _ in range(60)]
+        self.authorize_descriptions.data[uids[0]].accessed_at -= AuthorizeDescriptions.TTL + 1
+        self.authorize_descriptions.data[uids[1]].accessed_at -= AuthorizeDescriptions.TTL - 1
+        self.assertIsNone(self.authorize_descriptions.get(uids[0]))
+        # Used again
+        self.assertIsNotNone(self.authorize_descriptions.get(uids[1]))
+        self.assertGreater(self.authorize_descriptions.data[uids[1]].accessed_at, time.time() - 1)
+        self.assertEqual(self.authorize_descriptions.sweep(), 1)
+        self.assertEqual(set(self.authorize_descriptions.data), set(uids[1:]))
+
+    def test_least_recently_used_descriptions_are_evicted(self):
+        self.authorize_descriptions.MAX_SIZE = 2
+        uids = [self.authorize_descriptions.add(self.DEFAULT_JID, self.DEFAULT_NAME, 'desc') for _ in range(2)]
+        self.authorize_descriptions.data[uids[0]].accessed_at -= AuthorizeDescriptions.ACCESS_RESOLUTION + 1
+        self.authorize_descriptions.get(uids[0])
+        other_uid = self.authorize_descriptions.add('other@example.com', self.DEFAULT_NAME, 'desc')
+        self.assertEqual(list(self.authorize_descriptions.data), [uids[0], other_uid])
+
+class AuthorizeRequest(Record):
+
+    __slots__ = ('jid', 'state', 'redirect_uri', 'is_sandbox', 'created_at')
+
+    def __init__(self, jid, state, redirect_uri, is_sandbox, created_at):
+        self.jid = jid
+        self.state = state
+        self.redirect_uri = redirect_uri
+        self.is_sandbox = is_sandbox
+        self.created_at = created_at
+
 class AuthorizeRequests:
 
-    def __init__(self):
+    # Each visit of an authorize page adds a request, most of them are
+    # never completed. Requests expire after TTL and at most MAX_SIZE
+    # are kept, oldest first.
+    TTL = 24 * 3600 # s
+    MAX_SIZE = 100000
+
+    def __init__(self, store=None):
+        self.data = {}
+        self.store = store
+
+    def load(self, data):
         self.data = {}
+        now = time.time()
+        for state, request in sorted(data.items(), key=lambda item: item[1].get('created_at') or now):
+            self.data[state] = AuthorizeRequest(request['jid'], request['state'], request['redirect_uri'],
+                                                request['is_sandbox'], request.get('created_at') or now)
 
     def add(self, jid, user_state, redirect_uri, test_client_id=None):
 
@@ -79,85 +224,334 @@ class AuthorizeRequests:
             if not state in self.data:
                 break
 
-        self.data[state] = {
-            'jid': jid,
-            'state': user_state,
-            'redirect_uri': redirect_uri,
-            'is_sandbox': test_client_id is not None
-        }
+        self.data[state] = AuthorizeRequest(jid, user_state, redirect_uri, test_client_id is not None, time.time())
+
+        if self.store is not None:
+            self.store.set_authorize_request(state, self.data[state])
+
+        if len(self.data) > self.MAX_SIZE:
+            self.remove(list(itertools.islice(self.data, len(self.data) - self.MAX_SIZE)))
 
         return state
 
+    def remove(self, states):
+        for state in states:
+            del self.data[state]
+        if self.store is not None:
+            self.store.delete_authorize_requests(states)
+
+    def sweep(self):
+        # Requests are ordered by creation time
+        expired_before = time.time() - self.TTL
+        expired = []
+        for state, request in self.data.items():
+            if request.created_at >= expired_before:
+                break
+            expired.append(state)
+        if expired:
+            self.remove(expired)
+        return len(expired)
+
     def get(self, state):
-        return self.data.get(state)
+        request = self.data.get(state)
+        if request is not None and request.created_at < time.time() - self.TTL:
+            return None
+        return request
+
+    def reload(self, state):
+        request = self.store.get_authorize_request(state)
+        if request is None:
+            self.data.pop(state, None)
+        elif state not in self.data:
+            self.data[state] = AuthorizeRequest(request['jid'], request['state'], request['redirect_uri'],
+                                                request['is_sandbox'], request['created_at'] or time.time())
+
+class AuthorizeRequestsTest(unittest.TestCase):
+
+    DEFAULT_JID = 'proxy-client@elec-expert.net'
+
+    def setUp(self):
+        self.authorize_requests = AuthorizeRequests()
+
+    def test_requests_expire(self):
+        state = self.authorize_requests.add(self.DEFAULT_JID, None, None)
+        self.assertIsNotNone(self.authorize_requests.get(state))
+        self.authorize_requests.data[state].created_at -= AuthorizeRequests.TTL + 1
+        self.assertIsNone(self.authorize_requests.get(state))
+        self.assertEqual(self.authorize_requests.sweep(), 1)
+        self.assertEqual(self.authorize_requests.data, {})
+
+    def test_oldest_requests_are_evicted(self):
+        self.authorize_requests.MAX_SIZE = 2
+        states = [self.authorize_requests.add(self.DEFAULT_JID, None, None) for _ in range(3)]
+        self.assertEqual(list(self.authorize_requests.data.keys()), states[1:])
+
+class Token(Record):
+
+    __slots__ = ('access_token', 'refresh_token', 'expires_at', 'is_sandbox')
+
+    def __init__(self, access_token, refresh_token, expires_at, is_sandbox):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at # timestamp
+        self.is_sandbox = is_sandbox
+
+    @staticmethod
+    def parse_expires_at(expires_at):
+        # Formerly stored as a local date string
+        try:
+            return float(expires_at)
+        except ValueError:
+            return dt.datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S').timestamp()
 
 class Tokens:
 
-    def __init__(self):
+    # Ids are never reused, a removed token id could still be referred to
+    # by facts or by other processes.
+
+    def __init__(self, store=None):
         self.data = {}
+        self.next_idx = 0
+        self.store = store
+
+    def load(self, data):
+        self.data = {idx: Token(token['access_token'], token['refresh_token'],
+                                Token.parse_expires_at(token['expires_at']), token['is_sandbox'])
+                     for idx, token in data.items()}
+        self.next_idx = max((int(idx) + 1 for idx in self.data if idx.isdigit()), default=0)
 
     def set(self, access_token, refresh_token, expires_in, is_sandbox, idx=None):
-        if idx is None:
-            idx = str(len(self.data))
-        expires_at = dt.datetime.now() + dt.timedelta(seconds=int(expires_in))
-        expires_at = expires_at.strftime('%Y-%m-%d %H:%M:%S')
-        self.data[idx] = {
-            'access_token': access_token,
-            'refresh_token': refresh_token,
-            'expires_at': expires_at,
-            'is_sandbox': is_sandbox
-        }
+        token = Token(access_token, refresh_token, time.time() + int(expires_in), is_sandbox)
+        if self.store is None:
+            if idx is None:
+                idx = str(self.next_idx)
+                self.next_idx += 1
+        elif idx is None:
+            # Other processes may add tokens too
+            idx = self.store.add_token(token)
+        else:
+            self.store.set_token(idx, token)
+        self.data[idx] = token
         return idx
 
+    def remove(self, idx):
+        """ Remove a token, the store also removes usage points accesses depending on it """
+        self.data.pop(idx, None)
+        if self.store is not None:
+            self.store.delete_token(idx)
+
     def get(self, idx):
-        value = self.data.get(idx).copy()
-        if value is not None:
-            value['expires_at'] = dt.datetime.strptime(value['expires_at'], '%Y-%m-%d %H:%M:%S')
-        return value
+        return self.data.get(idx)
+
+    def reload(self, idx):
+        token = self.store.get_token(idx)
+        if token is None:
+            self.data.pop(idx, None)
+        else:
+            self.data[idx] = Token(token['access_token'], token['refresh_token'],
+                                   Token.parse_expires_at(token['expires_at']), token['is_sandbox'])
 
 class UsagePoints:
 
-    def __init__(self):
+    # Accesses are indexed both ways, so that the subscribers of a usage
+    # point and the accesses depending on a token are found without a scan:
+    #
+    #     data            jid -> usage point -> token id
+    #     by_usage_point  usage point -> jid -> token id
+    #     by_token        token id -> {(jid, usage point)}
+
+    def __init__(self, store=None):
+        self.data = {}
+        self.by_usage_point = {}
+        self.by_token = {}
+        self.store = store
+
+    def load(self, data):
         self.data = {}
+        self.by_usage_point = {}
+        self.by_token = {}
+        for jid, usage_points in data.items():
+            for usage_point, token_id in usage_points.items():
+                self.add(jid, usage_point, token_id)
+
+    def add(self, jid, usage_point, token_id):
+        if usage_point in self.data.get(jid, {}):
+            self.discard(jid, usage_point)
+        self.data.setdefault(jid, {})[usage_point] = token_id
+        self.by_usage_point.setdefault(usage_point, {})[jid] = token_id
+        self.by_token.setdefault(token_id, set()).add((jid, usage_point))
+
+    def discard(self, jid, usage_point):
+        usage_points = self.data.get(jid, {})
+        if usage_point not in usage_points:
+            return
+        token_id = usage_points.pop(usage_point)
+        if not usage_points:
+            del self.data[jid]
+        subscribers = self.by_usage_point[usage_point]
+        del subscribers[jid]
+        if not subscribers:
+            del self.by_usage_point[usage_point]
+        accesses = self.by_token[token_id]
+        accesses.discard((jid, usage_point))
+        if not accesses:
+            del self.by_token[token_id]
 
     def set(self, jid, usage_point, token_id):
-        if not jid in self.data:
-            self.data[jid] = {}
-        self.data[jid][usage_point] = token_id
+        self.add(jid, usage_point, token_id)
+        if self.store is not None:
+            self.store.set_usage_point(jid, usage_point, token_id)
 
     def get(self, jid):
         return self.data.get(jid)
 
+    def subscribers(self, usage_point):
+        """ {jid: token id} of the users allowed to access usage_point """
+        return dict(self.by_usage_point.get(usage_point, {}))
+
+    def remove_token(self, token_id):
+        """ Forget accesses given by a token, the store removes them with the token """
+        accesses = sorted(self.by_token.get(token_id, ()))
+        for jid, usage_point in accesses:
+            self.discard(jid, usage_point)
+        return accesses
+
+    def reload(self, jid):
+        for usage_point in list(self.data.get(jid, {})):
+            self.discard(jid, usage_point)
+        for usage_point, token_id in (self.store.get_usage_points(jid) or {}).items():
+            self.add(jid, usage_point, token_id)
+
+class UsagePointsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.usage_points = UsagePoints()
+        self.usage_points.set('a@example.com', '22516914714270', '0')
+        self.usage_points.set('b@example.com', '22516914714270', '0')
+        self.usage_points.set('b@example.com', '22516914714271', '1')
+
+    def test_subscribers_are_indexed(self):
+        self.assertEqual(self.usage_points.subscribers('22516914714270'), {'a@example.com': '0', 'b@example.com': '0'})
+        self.usage_points.set('a@example.com', '22516914714270', '2')
+        self.assertEqual(self.usage_points.subscribers('22516914714270'), {'a@example.com': '2', 'b@example.com': '0'})
+        self.assertEqual(self.usage_points.by_token['0'], {('b@example.com', '22516914714270')})
+
+    def test_accesses_of_a_token_are_removed(self):
+        self.assertEqual(self.usage_points.remove_token('0'),
+                         [('a@example.com', '22516914714270'), ('b@example.com', '22516914714270')])
+        self.assertEqual(self.usage_points.subscribers('22516914714270'), {})
+        self.assertIsNone(self.usage_points.get('a@example.com'))
+        self.assertEqual(self.usage_points.get('b@example.com'), {'22516914714271': '1'})
+
 class DataConnectProxy:
 
-    def __init__(self, data_connect_prod, data_connect_sandbox, web_interface_base_uri):
+    # Access tokens are refreshed in background when they expire in less
+    # than REFRESH_MARGIN, plus a random part up to REFRESH_JITTER so that
+    # refreshes do not happen all at once.
+    REFRESH_MARGIN = 10 * 60 # s
+    REFRESH_JITTER = 5 * 60 # s
+    REFRESH_CHECK_PERIOD = 60 # s
+    REFRESH_RETRY_DELAY = 15 * 60 # s
+
+    SWEEP_PERIOD = 10 * 60 # s
+
+    # Processes sharing the state database apply changes of the others every
+    # SYNC_PERIOD, or at once when a record is missing. A lease on each
+    # refresh token ensures it is rotated by a single process.
+    SYNC_PERIOD = 1 # s
+    CHANGES_TTL = 3600 # s
+    REFRESH_LOCK_TTL = 120 # s
+    REFRESH_LOCK_POLL = 0.2 # s
+    STORE_RETRY_DELAY = 0.1 # s
+
+    def __init__(self, data_connect_prod, data_connect_sandbox, web_interface_base_uri,
+                 state_path='state.db', legacy_state_path='state.json', series_path=None):
         self.data_connect_prod = data_connect_prod
         self.data_connect_sandbox = data_connect_sandbox
         self.web_interface_base_uri = web_interface_base_uri
-        self.tokens = Tokens()
-        self.usage_points = UsagePoints()
-        self.authorize_descriptions = AuthorizeDescriptions()
-        self.authorize_requests = AuthorizeRequests()
+        self.state_store = StateStore(state_path)
+        self.legacy_state_path = legacy_state_path
+        self.tokens = Tokens(self.state_store)
+        self.usage_points = UsagePoints(self.state_store)
+        self.authorize_descriptions = AuthorizeDescriptions(self.state_store)
+        self.authorize_requests = AuthorizeRequests(self.state_store)
+        self.metering_cache = MeteringCache(store=SeriesStore(series_path) if series_path else None,
+                                            shared=self.state_store)
+        self.usage_point_facts = UsagePointFacts()
+        self.refreshes = {}
+        self.refresh_retry_at = {}
+        self.fetches = {}
+        self.harvester = None
+        self.xmpp_interface = None
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.tasks = []
         self.load_state()
+        REGISTRY_SIZE.set_function(self.registry_sizes)
 
-    def save_state(self):
-        state = {
-            'tokens': self.tokens.data,
-            'usage_points': self.usage_points.data,
-            'authorize_descriptions': self.authorize_descriptions.data,
-            'authorize_requests': self.authorize_requests.data
-        }
-        with open('state.json', 'w') as f:
-            json.dump(state, f)
+    # Every change is persisted as it is made, see StateStore
 
     def load_state(self):
-        if os.path.exists('state.json'):
-            with open('state.json') as f:
-                state = json.load(f)
-            self.tokens.data = state.get('tokens', {})
-            self.usage_points.data = state.get('usage_points', {})
-            self.authorize_descriptions.data = state.get('authorize_descriptions', {})
-            self.authorize_requests.data = state.get('authorize_requests', {})
+        if self.state_store.is_empty() and self.legacy_state_path and os.path.exists(self.legacy_state_path):
+            logging.info(f"Importing {self.legacy_state_path}")
+            with open(self.legacy_state_path) as f:
+                self.state_store.import_state(json.load(f))
+
+        self.last_change = self.state_store.last_change()
+        state = self.state_store.load()
+        self.tokens.load(state.get('tokens', {}))
+        self.usage_points.load(state.get('usage_points', {}))
+        self.authorize_descriptions.load(state.get('authorize_descriptions', {}))
+        self.authorize_requests.load(state.get('authorize_requests', {}))
+
+    def sync_state(self):
+        """ Apply changes made by other processes, and send their notifications """
+
+        changes = self.state_store.changes_since(self.last_change)
+        if changes is None:
+            logging.warning("Some state changes were missed, reloading")
+            self.load_state()
+        elif changes:
+            self.last_change = changes[-1][0]
+            registries = {
+                'tokens': self.tokens,
+                'usage_points': self.usage_points,
+                'authorize_descriptions': self.authorize_descriptions,
+                'authorize_requests': self.authorize_requests
+            }
+            for registry, key in dict.fromkeys((registry, key) for _, registry, key in changes):
+                registries[registry].reload(key)
+
+        if self.xmpp_interface is not None:
+            for jid, usage_points, state in self.state_store.pop_notifications():
+                self.xmpp_interface.notify_authorize_complete(jid, usage_points, state)
+
+    async def sync_periodically(self):
+        while True:
+            await asyncio.sleep(self.SYNC_PERIOD)
+            try:
+                self.sync_state()
+            except Exception:
+                logging.exception("State sync failed")
+
+    def revoke_token(self, token_id):
+        """ Remove a token and the accesses depending on it, returns the (jid, usage point) removed """
+        accesses = self.usage_points.remove_token(token_id)
+        self.tokens.remove(token_id)
+        self.refresh_retry_at.pop(token_id, None)
+        logging.info(f"Token {token_id} revoked, removed accesses: {accesses}")
+        return accesses
+
+    def get_subscribers(self, usage_point_id):
+        return self.usage_points.subscribers(usage_point_id)
+
+    def registry_sizes(self):
+        return {
+            ('tokens',): len(self.tokens.data),
+            ('usage_points',): sum(len(usage_points) for usage_points in self.usage_points.data.values()),
+            ('authorize_descriptions',): len(self.authorize_descriptions.data),
+            ('authorize_requests',): len(self.authorize_requests.data),
+            ('metering_cache_days',): len(self.metering_cache.days)
+        }
 
     def get_data_connect(self, sandbox):
         if sandbox:
@@ -165,30 +559,58 @@ class DataConnectProxy:
         else:
             return self.data_connect_prod
 
+    def start(self, refresh=True):
+        if refresh:
+            self.tasks.append(asyncio.ensure_future(self.refresh_tokens_periodically()))
+        self.tasks.append(asyncio.ensure_future(self.sweep_periodically()))
+        self.tasks.append(asyncio.ensure_future(self.sync_periodically()))
+        if self.harvester is not None:
+            self.tasks.append(asyncio.ensure_future(self.harvester.run()))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await self.data_connect_prod.close()
+        await self.data_connect_sandbox.close()
+        self.state_store.close()
+        if self.metering_cache.store is not None:
+            self.metering_cache.store.close()
 
     def register_authorize_description(self, jid, name, service, logo_url):
 
         uid = self.authorize_descriptions.add(jid, name, service, logo_url)
         return os.path.join(self.web_interface_base_uri, f'authorize?id={uid}')
 
+    def get_authorize_description(self, uid):
+        description = self.authorize_descriptions.get(uid)
+        if description is None:
+            # Might have been added by another process
+            self.sync_state()
+            description = self.authorize_descriptions.get(uid)
+        return description
+
     def register_authorize_request(self, redirect_uri, duration, user_bare_jid, user_state, test_client_id=None):
 
         state = self.authorize_requests.add(user_bare_jid, user_state, redirect_uri, test_client_id)
         is_sandbox = test_client_id is not None
         return self.get_data_connect(is_sandbox).make_authorize_url('P1Y', state=state)
 
-    def authorize_request_callback(self, code, state):
+    async def authorize_request_callback(self, code, state):
 
         authorize_request = self.authorize_requests.get(state)
 
+        if authorize_request is None:
+            self.sync_state()
+            authorize_request = self.authorize_requests.get(state)
+
         if authorize_request is None:
             return None
 
-        is_sandbox = authorize_request['is_sandbox']
+        is_sandbox = authorize_request.is_sandbox
 
-        res = self.get_data_connect(is_sandbox).get_access_token(code=code)
+        res = await self.get_data_connect(is_sandbox).get_access_token(code=code)
 
-        jid = authorize_request['jid']
+        jid = authorize_request.jid
         token_id = self.tokens.set(res['access_token'], res['refresh_token'], res['expires_in'], is_sandbox)
 
         logging.info(f"New refresh token: {res['usage_points_id']}, {res['refresh_token']}")
@@ -198,49 +620,504 @@ class DataConnectProxy:
         for usage_point in usage_points:
             self.usage_points.set(jid, usage_point, token_id)
 
-        self.xmpp_interface.notify_authorize_complete(jid, usage_points, authorize_request['state'])
+        if self.xmpp_interface is None:
+            # Sent by an XMPP worker
+            self.state_store.add_notification(jid, usage_points, authorize_request.state)
+        else:
+            self.xmpp_interface.notify_authorize_complete(jid, usage_points, authorize_request.state)
 
         return {
             'user': jid,
-            'redirect_uri': authorize_request['redirect_uri'],
+            'redirect_uri': authorize_request.redirect_uri,
             'usage_points': usage_points
         }
 
     # TODO throw DataConnectProxyErrors
-    def get_access_token(self, jid, usage_point_id):
+    def get_token_id(self, jid, usage_point_id):
 
-        user_usage_points = self.usage_points.get(jid)
-        if not user_usage_points:
-            raise DataConnectError(f'User {jid} is not allowed to access {usage_point_id}')
+        with tracing.span('token_lookup'):
+            token_id = (self.usage_points.get(jid) or {}).get(usage_point_id)
+            if not token_id:
+                # Might have been granted through another process
+                self.sync_state()
+                token_id = (self.usage_points.get(jid) or {}).get(usage_point_id)
 
-        token_id = user_usage_points.get(usage_point_id)
         if not token_id:
             raise DataConnectError(f'User {jid} is not allowed to access {usage_point_id}')
 
+        return token_id
+
+    async def get_access_token(self, jid, usage_point_id):
+
+        token_id = self.get_token_id(jid, usage_point_id)
         token = self.tokens.get(token_id)
-        is_sandbox = token['is_sandbox']
+        if token is None:
+            # Revoked, possibly by another process, since the lookup
+            raise DataConnectError(f'No consent for {usage_point_id} anymore')
 
-        # TODO time margin
-        if dt.datetime.now() > token['expires_at']:
+        # Should have been refreshed in background
+        if time.time() > token.expires_at:
             logging.info(f"A refresh token is needed")
-            res = self.get_data_connect(is_sandbox).get_access_token(refresh_token=token['refresh_token'])
-            logging.info(f"Update refresh token: {usage_point_id}, {token['refresh_token']} -> {res['refresh_token']}")
-            self.tokens.set(res['access_token'], res['refresh_token'], res['expires_in'], is_sandbox, token_id)
-            access_token = res['access_token']
-        else:
-            access_token = token['access_token']
+            with tracing.span('token_refresh'):
+                token = await self.refresh_token(token_id, requester=jid)
+
+        return token.access_token, token.is_sandbox
+
+    async def refresh_token(self, token_id, requester=None):
+
+        # A refresh token can only be used once, concurrent refreshes of the
+        # same token wait for a single call.
+        if token_id not in self.refreshes:
+            self.refreshes[token_id] = asyncio.ensure_future(self._refresh_token(token_id, requester))
+            self.refreshes[token_id].add_done_callback(lambda _: self.refreshes.pop(token_id, None))
+
+        return await asyncio.shield(self.refreshes[token_id])
+
+    async def _refresh_token(self, token_id, requester):
+
+        lock = f'refresh:{token_id}'
+        while not self.state_store.acquire_lock(lock, self.owner, self.REFRESH_LOCK_TTL):
+            await asyncio.sleep(self.REFRESH_LOCK_POLL)
+        try:
+            self.tokens.reload(token_id)
+            token = self.tokens.get(token_id)
+            if token is None:
+                raise DataConnectError(f'Token {token_id} does not exist anymore')
+            if token.expires_at - self.REFRESH_MARGIN - self.REFRESH_JITTER > time.time():
+                # Rotated by another process meanwhile
+                return token
+            return await self._rotate_token(token_id, token, requester)
+        finally:
+            self.state_store.release_lock(lock, self.owner)
+
+    async def _rotate_token(self, token_id, token, requester):
+
+        is_sandbox = token.is_sandbox
+        data_connect = self.get_data_connect(is_sandbox)
+        labels = {'environment': data_connect.environment, 'trigger': 'background' if requester is None else 'request'}
+        TOKEN_REFRESHES.inc(**labels)
+        try:
+            res = await data_connect.get_access_token(refresh_token=token.refresh_token, requester=requester)
+        except DataConnectError as e:
+            TOKEN_REFRESH_FAILURES.inc(**labels)
+            if e.code == 'invalid_grant':
+                # Consent revoked or expired
+                self.revoke_token(token_id)
+            raise
+        logging.info(f"Update refresh token: {token_id}, {token.refresh_token} -> {res['refresh_token']}")
+        # The former refresh token is not valid anymore, the new one must
+        # be stored even if the database is busy for a while
+        while True:
+            try:
+                self.tokens.set(res['access_token'], res['refresh_token'], res['expires_in'], is_sandbox, token_id)
+                break
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Unable to store token {token_id}, retrying: {e}")
+                await asyncio.sleep(self.STORE_RETRY_DELAY)
+        return self.tokens.get(token_id)
 
-        return access_token, is_sandbox
+    async def refresh_tokens_periodically(self):
+        while True:
+            await self.refresh_expiring_tokens()
+            await asyncio.sleep(self.REFRESH_CHECK_PERIOD)
+
+    async def refresh_expiring_tokens(self):
+
+        now = time.time()
+        expiring = []
+
+        for token_id, token in list(self.tokens.data.items()):
+            if self.refresh_retry_at.get(token_id, now) > now:
+                continue
+            margin = self.REFRESH_MARGIN + self.REFRESH_JITTER * random.random()
+            if token.expires_at - margin < now:
+                expiring.append(token_id)
+
+        async def refresh(token_id):
+            try:
+                await self.refresh_token(token_id)
+                self.refresh_retry_at.pop(token_id, None)
+            except DataConnectError as e:
+                logging.warning(f"Unable to refresh token {token_id}: {e}")
+                self.refresh_retry_at[token_id] = now + self.REFRESH_RETRY_DELAY
+            except Exception:
+                # Must not stop refreshes of other tokens
+                logging.exception(f"Unable to refresh token {token_id}")
+                self.refresh_retry_at[token_id] = now + self.REFRESH_RETRY_DELAY
+
+        await asyncio.gather(*[refresh(token_id) for token_id in expiring])
+
+    async def sweep_periodically(self):
+        while True:
+            await asyncio.sleep(self.SWEEP_PERIOD)
+            expired = self.authorize_requests.sweep()
+            if expired:
+                logging.info(f"{expired} expired authorize requests removed")
+            expired = self.authorize_descriptions.sweep()
+            if expired:
+                logging.info(f"{expired} unused authorize descriptions removed")
+            self.metering_cache.sweep()
+            self.usage_point_facts.sweep()
+            self.state_store.sweep_changes(time.time() - self.CHANGES_TTL)
+
+    async def get_load_curve(self, direction, jid, usage_point_id, start_date, end_date):
+        return await self.get_metering_data('load_curve', direction, jid, usage_point_id, start_date, end_date)
+
+    async def get_daily(self, direction, jid, usage_point_id, start_date, end_date):
+        return await self.get_metering_data('daily', direction, jid, usage_point_id, start_date, end_date)
+
+    async def get_metering_data(self, endpoint, direction, jid, usage_point_id, start_date, end_date):
+
+        # Checks access even when everything is cached
+        token_id = self.get_token_id(jid, usage_point_id)
+
+        try:
+            start = dt.date.fromisoformat(DataConnect.date_to_isostring(start_date))
+            end = dt.date.fromisoformat(DataConnect.date_to_isostring(end_date))
+        except ValueError as e:
+            raise DataConnectError(f'Invalid date: {e}')
+
+        if start >= end:
+            raise DataConnectError(f'Start date {start} should be before end date {end}')
+
+        # Fails fast if Data Connect is known to reject it
+        start, end = self.usage_point_facts.check(token_id, usage_point_id, direction, endpoint, start, end)
+
+        key = (usage_point_id, direction, endpoint)
+        with tracing.span('cache'):
+            days = self.metering_cache.get_days(key, start, end)
+            missing = MeteringCache.missing_ranges(days, start, end)
+        CACHE_DAYS.inc(len(days), endpoint=endpoint, result='hit')
+        CACHE_DAYS.inc((end - start).days - len(days), endpoint=endpoint, result='miss')
+
+        results = await asyncio.gather(*[self.fetch_metering_data(endpoint, direction, jid, usage_point_id, range_start, range_end)
+                                         for range_start, range_end in missing])
+        for fetched_days in results:
+            days.update(fetched_days)
+
+        with tracing.span('cache'):
+            return self.metering_cache.assemble(key, days, start, end)
+
+    @staticmethod
+    def is_token_error(error):
+        """ Whether a Data Connect error is due to the token of the call rather than to the request """
+        return error.code == UsagePointFacts.NO_CONSENT or error.status in (401, 403)
+
+    async def fetch_metering_data(self, endpoint, direction, jid, usage_point_id, start, end):
+
+        # Identical concurrent fetches wait for a single upstream call, made
+        # with the token of the first one. They can come from different JIDs
+        # allowed to access the same usage point with their own tokens: when
+        # the call fails because of its token, the others retry with theirs.
+        token_id = self.get_token_id(jid, usage_point_id)
+        access_token, is_sandbox = await self.get_access_token(jid, usage_point_id)
+
+        key = (usage_point_id, direction, endpoint, start, end)
+        fetch = self.fetches.get(key)
+        if fetch is None:
+            fetch = self.fetches[key] = (token_id, asyncio.ensure_future(self._fetch_metering_data(
+                endpoint, direction, jid, token_id, access_token, is_sandbox, usage_point_id, start, end)))
+            fetch[1].add_done_callback(lambda _: self.fetches.pop(key, None))
+        else:
+            COALESCED_FETCHES.inc(endpoint=endpoint)
+
+        leader_token_id, future = fetch
+        try:
+            return await asyncio.shield(future)
+        except DataConnectError as e:
+            if leader_token_id == token_id or not self.is_token_error(e):
+                raise
+        return await self._fetch_metering_data(endpoint, direction, jid, token_id, access_token, is_sandbox,
+                                               usage_point_id, start, end)
+
+    async def _fetch_metering_data(self, endpoint, direction, jid, token_id, access_token, is_sandbox,
+                                   usage_point_id, start, end):
+
+        data_connect = self.get_data_connect(is_sandbox)
+        if endpoint == 'load_curve':
+            fetch = data_connect.get_load_curve
+        else:
+            fetch = data_connect.get_daily
+
+        try:
+            data = await fetch(direction, usage_point_id, start, end, access_token, requester=jid)
+        except DataConnectError as e:
+            # Learnt for the token the call was made with
+            self.usage_point_facts.learn_error(token_id, usage_point_id, direction, endpoint, start, e)
+            raise
+        self.usage_point_facts.learn_success(usage_point_id, start)
+        # Days out of the upstream history were not requested
+        history = DataConnect.LOAD_CURVE_HISTORY if endpoint == 'load_curve' else DataConnect.DAILY_HISTORY
+        requested = DataConnect.available_range(start, end, history)
+        return self.metering_cache.set_days((usage_point_id, direction, endpoint), data['meter_reading'], start, end, requested)
+
+class DataConnectProxyTest(unittest.IsolatedAsyncioTestCase):
+
+    class FakeDataConnect:
+
+        def __init__(self):
+            self.environment = 'production'
+            self.refreshes = 0
+            self.metering_calls = 0
+
+        async def get_access_token(self, code=None, refresh_token=None, requester=None):
+            self.refreshes += 1
+            await asyncio.sleep(0.01)
+            return {'access_token': f'access-{self.refreshes}',
+                    'refresh_token': f'refresh-{self.refreshes}',
+                    'expires_in': '12600'}
+
+        async def get_daily(self, direction, usage_point_id, start, end, access_token, requester=None):
+            self.metering_calls += 1
+            await asyncio.sleep(0.01)
+            return {'meter_reading': {'usage_point_id': usage_point_id,
+                                      'interval_reading': [{'value': '1000', 'date': day.isoformat()}
+                                                           for day in MeteringCache.day_range(start, end)]}}
+
+        async def close(self):
+            pass
 
-    def get_load_curve(self, direction, jid, usage_point_id, start_date, end_date):
-        access_token, is_sandbox = self.get_access_token(jid, usage_point_id)
-        data = self.get_data_connect(is_sandbox).get_load_curve(direction, usage_point_id, start_date, end_date, access_token)
-        return data
+    def setUp(self):
+        self.data_connect = self.FakeDataConnect()
+        self.proxy = DataConnectProxy(self.data_connect, self.data_connect, 'https://example.com',
+                                      state_path=':memory:', legacy_state_path=None)
+
+    def add_token(self, expires_in, jid='proxy-client@elec-expert.net', usage_point='22516914714270'):
+        token_id = self.proxy.tokens.set('access-0', 'refresh-0', expires_in, False)
+        self.proxy.usage_points.set(jid, usage_point, token_id)
+        return token_id
+
+    async def test_concurrent_refreshes_are_deduplicated(self):
+        token_id = self.add_token(-60, jid='a@example.com')
+        self.proxy.usage_points.set('b@example.com', '22516914714270', token_id)
+        tokens = await asyncio.gather(self.proxy.get_access_token('a@example.com', '22516914714270'),
+                                      self.proxy.get_access_token('b@example.com', '22516914714270'))
+        self.assertEqual(self.data_connect.refreshes, 1)
+        self.assertEqual(tokens, [('access-1', False), ('access-1', False)])
+
+    async def test_valid_token_is_not_refreshed(self):
+        self.add_token(3600)
+        token = await self.proxy.get_access_token('proxy-client@elec-expert.net', '22516914714270')
+        self.assertEqual(token, ('access-0', False))
+        self.assertEqual(self.data_connect.refreshes, 0)
+
+    async def test_identical_fetches_are_coalesced(self):
+        # Each JID has its own token
+        self.add_token(3600, jid='a@example.com')
+        self.add_token(3600, jid='b@example.com')
+        start = (dt.date.today() - dt.timedelta(days=3)).isoformat()
+        end = dt.date.today().isoformat()
+        results = await asyncio.gather(self.proxy.get_daily('consumption', 'a@example.com', '22516914714270', start, end),
+                                       self.proxy.get_daily('consumption', 'b@example.com', '22516914714270', start, end))
+        self.assertEqual(self.data_connect.metering_calls, 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0]['meter_reading']['interval_reading']), 3)
+
+    async def test_token_errors_of_coalesced_fetches_are_retried_with_own_token(self):
+        token_id = self.add_token(3600, jid='a@example.com')
+        self.add_token(3600, jid='b@example.com')
+        get_daily = self.data_connect.get_daily
+
+        async def get_daily_without_consent(direction, usage_point_id, start, end, access_token, requester=None):
+            if requester == 'a@example.com':
+                self.data_connect.metering_calls += 1
+                await asyncio.sleep(0.01)
+                raise DataConnectError('No consent', code=UsagePointFacts.NO_CONSENT)
+            return await get_daily(direction, usage_point_id, start, end, access_token, requester)
+        self.data_connect.get_daily = get_daily_without_consent
+
+        start = (dt.date.today() - dt.timedelta(days=3)).isoformat()
+        end = dt.date.today().isoformat()
+        results = await asyncio.gather(self.proxy.get_daily('consumption', 'a@example.com', '22516914714270', start, end),
+                                       self.proxy.get_daily('consumption', 'b@example.com', '22516914714270', start, end),
+                                       return_exceptions=True)
+        self.assertIsInstance(results[0], DataConnectError)
+        self.assertEqual(len(results[1]['meter_reading']['interval_reading']), 3)
+        self.assertEqual(self.data_connect.metering_calls, 2)
+        # Only the token of the failed call has no consent
+        self.assertEqual(list(self.proxy.usage_point_facts.errors), [('consent', token_id)])
+
+    async def test_other_errors_of_coalesced_fetches_are_shared(self):
+        self.add_token(3600, jid='a@example.com')
+        self.add_token(3600, jid='b@example.com')
+
+        async def get_daily(*args, **kwargs):
+            self.data_connect.metering_calls += 1
+            await asyncio.sleep(0.01)
+            raise DataConnectError('Bad gateway', status=502)
+        self.data_connect.get_daily = get_daily
+
+        start = (dt.date.today() - dt.timedelta(days=3)).isoformat()
+        end = dt.date.today().isoformat()
+        results = await asyncio.gather(self.proxy.get_daily('consumption', 'a@example.com', '22516914714270', start, end),
+                                       self.proxy.get_daily('consumption', 'b@example.com', '22516914714270', start, end),
+                                       return_exceptions=True)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(self.data_connect.metering_calls, 1)
+
+    async def test_coalesced_fetches_are_still_authorized(self):
+        self.add_token(3600, jid='a@example.com')
+        start = (dt.date.today() - dt.timedelta(days=3)).isoformat()
+        end = dt.date.today().isoformat()
+        results = await asyncio.gather(self.proxy.get_daily('consumption', 'a@example.com', '22516914714270', start, end),
+                                       self.proxy.get_daily('consumption', 'c@example.com', '22516914714270', start, end),
+                                       return_exceptions=True)
+        self.assertEqual(len(results[0]['meter_reading']['interval_reading']), 3)
+        self.assertIsInstance(results[1], DataConnectError)
+
+    async def test_known_errors_fail_fast(self):
+        self.add_token(3600)
+        error = DataConnectError('No consent', code=UsagePointFacts.NO_CONSENT)
+
+        async def get_daily(*args, **kwargs):
+            self.data_connect.metering_calls += 1
+            raise error
+        self.data_connect.get_daily = get_daily
+
+        start = (dt.date.today() - dt.timedelta(days=3)).isoformat()
+        end = dt.date.today().isoformat()
+        for _ in range(2):
+            with self.assertRaises(DataConnectError) as cm:
+                await self.proxy.get_daily('consumption', 'proxy-client@elec-expert.net', '22516914714270', start, end)
+            self.assertIs(cm.exception, error)
+        self.assertEqual(self.data_connect.metering_calls, 1)
+
+    async def test_revoked_token_accesses_are_removed(self):
+        token_id = self.add_token(-60, jid='a@example.com')
+        self.proxy.usage_points.set('b@example.com', '22516914714270', token_id)
+        other_token_id = self.add_token(3600, jid='b@example.com', usage_point='22516914714271')
+
+        async def get_access_token(**kwargs):
+            raise DataConnectError('Refresh token revoked', code='invalid_grant', status=400)
+        self.data_connect.get_access_token = get_access_token
+
+        with self.assertRaises(DataConnectError):
+            await self.proxy.get_access_token('a@example.com', '22516914714270')
+        self.assertIsNone(self.proxy.tokens.get(token_id))
+        self.assertEqual(self.proxy.get_subscribers('22516914714270'), {})
+        self.assertEqual(self.proxy.usage_points.get('b@example.com'), {'22516914714271': other_token_id})
+        self.assertIsNone(self.proxy.state_store.get_token(token_id))
+
+    async def test_rotated_token_is_stored_when_the_database_is_busy(self):
+        token_id = self.add_token(-60)
+        set_token = self.proxy.state_store.set_token
+        calls = []
+
+        def set_token_or_fail(idx, token):
+            calls.append(idx)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            set_token(idx, token)
+        self.proxy.state_store.set_token = set_token_or_fail
+
+        with self.assertLogs(level='WARNING'):
+            token = await self.proxy.get_access_token('proxy-client@elec-expert.net', '22516914714270')
+        self.assertEqual(token, ('access-1', False))
+        self.assertEqual(self.proxy.state_store.get_token(token_id)['refresh_token'], 'refresh-1')
+
+    async def test_removed_token_has_no_consent(self):
+        token_id = self.add_token(3600)
+        self.proxy.tokens.remove(token_id)
+        with self.assertRaises(DataConnectError):
+            await self.proxy.get_access_token('proxy-client@elec-expert.net', '22516914714270')
+
+    async def test_expiring_tokens_are_refreshed_in_background(self):
+        expiring = self.add_token(60)
+        valid = self.add_token(3600, usage_point='22516914714271')
+        await self.proxy.refresh_expiring_tokens()
+        self.assertEqual(self.data_connect.refreshes, 1)
+        self.assertEqual(self.proxy.tokens.get(expiring)['refresh_token'], 'refresh-1')
+        self.assertEqual(self.proxy.tokens.get(valid)['refresh_token'], 'refresh-0')
+
+    async def test_unexpected_refresh_errors_are_logged(self):
+        tokens = [self.add_token(60), self.add_token(60, usage_point='22516914714271')]
+        get_access_token = self.data_connect.get_access_token
+        calls = []
+
+        async def get_access_token_or_fail(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                # Malformed response
+                raise KeyError('access_token')
+            return await get_access_token(**kwargs)
+        self.data_connect.get_access_token = get_access_token_or_fail
+
+        with self.assertLogs(level='ERROR'):
+            await self.proxy.refresh_expiring_tokens()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.proxy.refresh_retry_at), 1)
+        self.assertEqual(sorted(self.proxy.tokens.get(token_id)['refresh_token'] for token_id in tokens), ['refresh-0', 'refresh-1'])
+
+class DataConnectProxyStateTest(unittest.TestCase):
 
-    def get_daily(self, direction, jid, usage_point_id, start_date, end_date):
-        access_token, is_sandbox = self.get_access_token(jid, usage_point_id)
-        data = self.get_data_connect(is_sandbox).get_daily(direction, usage_point_id, start_date, end_date, access_token)
-        return data
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.dir.name, 'state.db')
+        self.legacy_state_path = os.path.join(self.dir.name, 'state.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make_proxy(self):
+        return DataConnectProxy(None, None, 'https://example.com', self.state_path, self.legacy_state_path)
+
+    def test_legacy_state_is_imported(self):
+        with open(self.legacy_state_path, 'w') as f:
+            json.dump({'usage_points': {'proxy-client@elec-expert.net': {'22516914714270': '0'}}}, f)
+        proxy = self.make_proxy()
+        self.assertEqual(proxy.usage_points.get('proxy-client@elec-expert.net'), {'22516914714270': '0'})
+        proxy.state_store.close()
+
+    def test_changes_are_persisted(self):
+        proxy = self.make_proxy()
+        token_id = proxy.tokens.set('access', 'refresh', 12600, False)
+        proxy.usage_points.set('proxy-client@elec-expert.net', '22516914714270', token_id)
+        proxy.state_store.close()
+
+        proxy = self.make_proxy()
+        self.assertEqual(proxy.tokens.get(token_id)['refresh_token'], 'refresh')
+        self.assertEqual(proxy.usage_points.get('proxy-client@elec-expert.net'), {'22516914714270': token_id})
+        proxy.state_store.close()
+
+    def test_changes_of_other_processes_are_applied(self):
+        web, worker = self.make_proxy(), self.make_proxy()
+        notifications = []
+        worker.xmpp_interface = type('XmppInterface', (), {'notify_authorize_complete': lambda *args: notifications.append(args[1:])})()
+
+        token_id = web.tokens.set('access', 'refresh', 12600, False)
+        web.usage_points.set('proxy-client@elec-expert.net', '22516914714270', token_id)
+        self.assertEqual(worker.get_token_id('proxy-client@elec-expert.net', '22516914714270'), token_id)
+        self.assertEqual(worker.tokens.get(token_id)['access_token'], 'access')
+        self.assertNotEqual(worker.tokens.set('access', 'refresh', 12600, False), token_id)
+
+        uid = worker.authorize_descriptions.add('proxy-client@elec-expert.net', 'Elec Expert', 'desc')
+        self.assertEqual(web.get_authorize_description(uid)['name'], 'Elec Expert')
+        worker.authorize_descriptions.remove([uid])
+        web.sync_state()
+        self.assertIsNone(web.authorize_descriptions.get(uid))
+
+        web.state_store.add_notification('proxy-client@elec-expert.net', ['22516914714270'], None)
+        worker.sync_state()
+        self.assertEqual(notifications, [('proxy-client@elec-expert.net', ['22516914714270'], None)])
+
+        web.state_store.close()
+        worker.state_store.close()
+
+    def test_token_is_rotated_by_a_single_process(self):
+        data_connect = DataConnectProxyTest.FakeDataConnect()
+        proxies = [DataConnectProxy(data_connect, data_connect, 'https://example.com', self.state_path, None)
+                   for _ in range(3)]
+        token_id = proxies[0].tokens.set('access-0', 'refresh-0', -60, False)
+        proxies[0].usage_points.set('proxy-client@elec-expert.net', '22516914714270', token_id)
+
+        async def get_access_tokens():
+            return await asyncio.gather(*[proxy.get_access_token('proxy-client@elec-expert.net', '22516914714270')
+                                          for proxy in proxies])
+
+        self.assertEqual(asyncio.run(get_access_tokens()), [('access-1', False)] * 3)
+        self.assertEqual(data_connect.refreshes, 1)
+        for proxy in proxies:
+            proxy.state_store.close()
 
 if __name__ == '__main__':
 
@@ -250,6 +1127,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('conf', help="Configuration file (typically private/*.conf.json)")
     parser.add_argument('--unittest', action='store_true', help="Run unit tests (for this file only)")
+    parser.add_argument('--role', choices=['all', 'web', 'xmpp'], default='all',
+                        help="Run the web interface, an XMPP worker, or both. Processes of the same host share state.db")
+    parser.add_argument('--resource', help="XMPP resource of this worker, instead of the one of full_jid")
     args = parser.parse_args()
 
     if args.unittest:
@@ -270,7 +1150,12 @@ if __name__ == '__main__':
                                        CONF['data_connect']['sandbox']['redirect_uri'],
                                        sandbox=True)
 
-    proxy = DataConnectProxy(data_connect, data_connect_sandbox, CONF['web_interface']['base_uri'])
+    proxy = DataConnectProxy(data_connect, data_connect_sandbox, CONF['web_interface']['base_uri'],
+                             series_path=CONF.get('series_store', {}).get('path'))
+
+    # XMPP workers take turns, see Harvester.claim
+    if CONF.get('harvester', {}).get('enabled', False) and args.role != 'web':
+        proxy.harvester = Harvester(proxy, **{k: v for k, v in CONF['harvester'].items() if k != 'enabled'})
 
     # Ideally use optparse or argparse to get JID,
     # password, and log level.
@@ -278,28 +1163,51 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG,
                         format='%(levelname)-8s %(message)s')
 
-    xmpp = XmppInterface(CONF['xmpp']['full_jid'], CONF['xmpp']['password'],
-                         proxy.register_authorize_description,
-                         proxy.get_load_curve,
-                         proxy.get_daily)
+    loop = asyncio.get_event_loop()
 
-    proxy.xmpp_interface = xmpp # TODO this is ugly
-    web_interface.app.data_connect_proxy = proxy # TODO this is ugly
+    tracing.SLOW_REQUEST_THRESHOLD = CONF.get('tracing', {}).get('slow_request_threshold', tracing.SLOW_REQUEST_THRESHOLD)
+    tracing.PROFILES_PATH = CONF.get('tracing', {}).get('profiles_path', tracing.PROFILES_PATH)
+    # kill -USR2 <pid> starts the profiler, and stops it the next time
+    loop.add_signal_handler(signal.SIGUSR2, tracing.toggle_profiler)
+
+    if args.role in ['all', 'web']:
+        web_interface.app.data_connect_proxy = proxy # TODO this is ugly
+        web_interface.app.api_keys = CONF['web_interface'].get('api_keys', {})
+        loop.run_until_complete(
+            web_interface.app.start(port=CONF['web_interface'].get('port', 3000), reuse_port=args.role == 'web'),
+        )
+
+    xmpp = None
+    if args.role in ['all', 'xmpp']:
+        full_jid = CONF['xmpp']['full_jid']
+        if args.resource:
+            full_jid = full_jid.split('/')[0] + '/' + args.resource
+        xmpp = XmppInterface(full_jid, CONF['xmpp']['password'],
+                             proxy.register_authorize_description,
+                             proxy.get_load_curve,
+                             proxy.get_daily,
+                             proxy.get_subscribers,
+                             admins=CONF['xmpp'].get('admins', []))
+        proxy.xmpp_interface = xmpp # TODO this is ugly
+
+    # Tokens are refreshed in background by XMPP workers
+    proxy.start(refresh=args.role != 'web')
 
     # I don't really understand what is going on with asyncio
     # Got web + xmpp example on
     # https://gitlab.collabora.com/sysadmin/csp-reports-bot/-/blob/master/csp.py
 
-    loop = asyncio.get_event_loop()
-    http = loop.run_until_complete(
-        web_interface.app.start(),
-    )
-
-    xmpp.connect()
     try:
-        xmpp.process()
+        if xmpp is not None:
+            xmpp.connect()
+            xmpp.process()
+        else:
+            loop.run_forever()
     except KeyboardInterrupt:
-        xmpp.disconnect()
-        xmpp.process(forever=False)
+        if xmpp is not None:
+            # Owners are told that their running jobs are cancelled
+            loop.run_until_complete(xmpp.jobs.close())
+            xmpp.disconnect()
+            xmpp.process(forever=False)
     finally:
-        proxy.save_state()
+        loop.run_until_complete(proxy.close())
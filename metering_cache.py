@@ -0,0 +1,273 @@
+from collections import OrderedDict
+import datetime as dt
+import time
+
+import pytz
+
+# Readings of a given day are stored once they are old enough, Enedis
+# publishes metering data the next day but can still consolidate it shortly
+# after. Recent days are always fetched again.
+#
+# Keys are (usage_point_id, direction, endpoint), endpoint being either
+# 'load_curve' or 'daily'. Each cached day is an entry of a LRU, eviction
+# is done day by day.
+#
+# When recent_ttl is set, recent days that have readings are also kept,
+# for recent_ttl only. This lets data harvested overnight be served locally
+# the next day. With a shared store, such as the StateStore, they are also
+# served to the other processes of the host.
+#
+# With a SeriesStore, trusted days are also written to disk, and read back
+# from there once evicted from the LRU or after a restart.
+
+class MeteringCache:
+
+    MAX_DAYS = 10000
+    TRUST_DELAY = dt.timedelta(days=2)
+
+    def __init__(self, max_days=MAX_DAYS, trust_delay=TRUST_DELAY, recent_ttl=None, store=None, shared=None):
+        self.max_days = max_days
+        self.trust_delay = trust_delay
+        self.recent_ttl = recent_ttl
+        self.store = store
+        self.shared = shared
+        self.days = OrderedDict()
+        self.recent_days = {}
+        self.meta = {}
+
+    @staticmethod
+    def today():
+        # Same as Data Connect
+        return dt.datetime.now(pytz.timezone('Europe/Paris')).date()
+
+    def is_trusted(self, day):
+        return day <= self.today() - self.trust_delay
+
+    def get_days(self, key, start, end):
+        """ Cached readings for each day in [start, end), as a {day: readings} dict """
+        days = {}
+        for day in self.day_range(start, end):
+            readings = self.days.get(key + (day,))
+            if readings is not None:
+                self.days.move_to_end(key + (day,))
+                days[day] = readings
+            elif key + (day,) in self.recent_days:
+                readings, expires_at = self.recent_days[key + (day,)]
+                if expires_at > time.monotonic():
+                    days[day] = readings
+                else:
+                    del self.recent_days[key + (day,)]
+            elif self.store is not None and self.store.is_synced(key, day):
+                days[day] = self.store.readings(key, day)
+            elif self.shared is not None and not self.is_trusted(day):
+                readings = self.shared.get_recent_day(key, day)
+                if readings is not None:
+                    days[day] = readings
+        return days
+
+    def set_days(self, key, meter_reading, start, end, requested=None):
+        """ Split upstream readings of [start, end) by day, caching the trusted ones
+
+        requested is the (start, end) range actually requested upstream, if
+        narrower. Days out of it are only cached if they have readings.
+        """
+        days = {day: [] for day in self.day_range(start, end)}
+        for reading in meter_reading['interval_reading']:
+            day = self.reading_day(reading['date'])
+            if day in days:
+                days[day].append(reading)
+
+        requested_start, requested_end = requested or (start, end)
+        recent_days = {}
+
+        for day, readings in days.items():
+            if not readings and not requested_start <= day < requested_end:
+                continue
+            if self.is_trusted(day):
+                self.days[key + (day,)] = readings
+                self.days.move_to_end(key + (day,))
+                self.recent_days.pop(key + (day,), None)
+                if self.store is not None:
+                    self.store.write_day(key, day, readings)
+            elif self.recent_ttl is not None and readings:
+                self.recent_days[key + (day,)] = (readings, time.monotonic() + self.recent_ttl.total_seconds())
+                recent_days[day] = readings
+
+        while len(self.days) > self.max_days:
+            self.days.popitem(last=False)
+
+        if self.shared is not None and recent_days:
+            self.shared.set_recent_days(key, recent_days, time.time() + self.recent_ttl.total_seconds())
+
+        self.meta[key] = {k: v for k, v in meter_reading.items() if k != 'interval_reading'}
+
+        return days
+
+    def sweep(self):
+        """ Remove expired recent days, returns how many were removed """
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self.recent_days.items() if expires_at <= now]
+        for key in expired:
+            del self.recent_days[key]
+        if self.shared is not None:
+            self.shared.sweep_recent_days()
+        return len(expired)
+
+    def assemble(self, key, days, start, end):
+        """ Build a Data Connect like meter_reading for [start, end) from days readings """
+        meter_reading = dict(self.meta.get(key, {}))
+        meter_reading['start'] = start.isoformat()
+        meter_reading['end'] = end.isoformat()
+        meter_reading['interval_reading'] = [reading
+                                             for day in self.day_range(start, end)
+                                             for reading in days.get(day, [])]
+        return {'meter_reading': meter_reading}
+
+    @staticmethod
+    def missing_ranges(days, start, end):
+        """ Contiguous [start, end) ranges of days that are not in days """
+        ranges = []
+        range_start = None
+        for day in MeteringCache.day_range(start, end):
+            if day in days:
+                if range_start is not None:
+                    ranges.append((range_start, day))
+                    range_start = None
+            elif range_start is None:
+                range_start = day
+        if range_start is not None:
+            ranges.append((range_start, end))
+        return ranges
+
+    @staticmethod
+    def day_range(start, end):
+        day = start
+        while day < end:
+            yield day
+            day += dt.timedelta(days=1)
+
+    @staticmethod
+    def reading_day(date):
+        # Daily readings are dated YYYY-MM-DD, load curve readings are dated
+        # YYYY-MM-DD HH:MM:SS at the end of their interval, so a reading at
+        # midnight belongs to the previous day.
+        day = dt.date.fromisoformat(date[:10])
+        if len(date) > 10 and date[11:] == '00:00:00':
+            day -= dt.timedelta(days=1)
+        return day
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestMeteringCache(unittest.TestCase):
+
+        KEY = ('22516914714270', 'consumption', 'load_curve')
+
+        def setUp(self):
+            self.cache = MeteringCache(max_days=3)
+            self.cache.today = lambda: dt.date(2020, 6, 30)
+
+        @staticmethod
+        def meter_reading(start, end):
+            readings = []
+            date = dt.datetime.combine(start, dt.time())
+            while date < dt.datetime.combine(end, dt.time()):
+                date += dt.timedelta(minutes=30)
+                readings.append({'value': '100', 'date': date.strftime('%Y-%m-%d %H:%M:%S'), 'interval_length': 'PT30M'})
+            return {'usage_point_id': '22516914714270', 'start': start.isoformat(), 'end': end.isoformat(), 'interval_reading': readings}
+
+        def test_readings_are_split_by_day(self):
+            start, end = dt.date(2020, 6, 1), dt.date(2020, 6, 3)
+            days = self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            self.assertEqual(len(days[dt.date(2020, 6, 1)]), 48)
+            self.assertEqual(days[dt.date(2020, 6, 1)][-1]['date'], '2020-06-02 00:00:00')
+            self.assertEqual(len(days[dt.date(2020, 6, 2)]), 48)
+
+        def test_daily_readings_are_split_by_day(self):
+            self.assertEqual(MeteringCache.reading_day('2020-06-01'), dt.date(2020, 6, 1))
+
+        def test_only_missing_days_are_requested(self):
+            start, end = dt.date(2020, 6, 2), dt.date(2020, 6, 3)
+            self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            days = self.cache.get_days(self.KEY, dt.date(2020, 6, 1), dt.date(2020, 6, 5))
+            self.assertEqual(list(days.keys()), [dt.date(2020, 6, 2)])
+            self.assertEqual(MeteringCache.missing_ranges(days, dt.date(2020, 6, 1), dt.date(2020, 6, 5)),
+                             [(dt.date(2020, 6, 1), dt.date(2020, 6, 2)), (dt.date(2020, 6, 3), dt.date(2020, 6, 5))])
+
+        def test_recent_days_are_not_cached(self):
+            start, end = dt.date(2020, 6, 27), dt.date(2020, 6, 30)
+            self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            days = self.cache.get_days(self.KEY, start, end)
+            self.assertEqual(list(days.keys()), [dt.date(2020, 6, 27), dt.date(2020, 6, 28)])
+
+        def test_recent_days_are_cached_for_recent_ttl(self):
+            start, end = dt.date(2020, 6, 29), dt.date(2020, 7, 1)
+            self.cache.recent_ttl = dt.timedelta(hours=12)
+            self.cache.set_days(self.KEY, self.meter_reading(start, dt.date(2020, 6, 30)), start, end)
+            days = self.cache.get_days(self.KEY, start, end)
+            self.assertEqual(list(days.keys()), [dt.date(2020, 6, 29)])
+            self.cache.recent_ttl = dt.timedelta(0)
+            self.cache.set_days(self.KEY, self.meter_reading(start, dt.date(2020, 6, 30)), start, end)
+            self.assertEqual(self.cache.get_days(self.KEY, start, end), {})
+
+        def test_recent_days_are_shared(self):
+            from state_store import StateStore
+            shared = StateStore(':memory:')
+            self.cache.shared = shared
+            self.cache.recent_ttl = dt.timedelta(hours=12)
+            start, end = dt.date(2020, 6, 29), dt.date(2020, 6, 30)
+            self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            # Other process
+            cache = MeteringCache(shared=shared)
+            cache.today = self.cache.today
+            self.assertEqual(list(cache.get_days(self.KEY, start, dt.date(2020, 7, 1)).keys()), [start])
+            shared.close()
+
+        def test_days_not_requested_upstream_are_not_cached(self):
+            start, end = dt.date(2020, 6, 1), dt.date(2020, 6, 5)
+            meter_reading = self.meter_reading(dt.date(2020, 6, 3), dt.date(2020, 6, 4))
+            self.cache.set_days(self.KEY, meter_reading, start, end, requested=(dt.date(2020, 6, 2), end))
+            days = self.cache.get_days(self.KEY, start, end)
+            self.assertEqual(sorted(days.keys()), [dt.date(2020, 6, 2), dt.date(2020, 6, 3), dt.date(2020, 6, 4)])
+            self.assertEqual(days[dt.date(2020, 6, 2)], [])
+
+        def test_evicted_days_are_read_from_store(self):
+            from series_store import SeriesStore
+            import tempfile
+            with tempfile.TemporaryDirectory() as path:
+                self.cache.store = SeriesStore(path)
+                start, end = dt.date(2020, 6, 1), dt.date(2020, 6, 5)
+                self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+                days = self.cache.get_days(self.KEY, start, end)
+                self.assertEqual(len(self.cache.days), 3)
+                self.assertEqual(list(days.keys()), [dt.date(2020, 6, 1), dt.date(2020, 6, 2), dt.date(2020, 6, 3), dt.date(2020, 6, 4)])
+                self.assertEqual(days[dt.date(2020, 6, 1)], self.cache.store.readings(self.KEY, dt.date(2020, 6, 1)))
+                self.assertEqual(len(days[dt.date(2020, 6, 1)]), 48)
+                self.cache.store.close()
+
+        def test_least_recently_used_days_are_evicted(self):
+            start, end = dt.date(2020, 6, 1), dt.date(2020, 6, 4)
+            self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            self.cache.get_days(self.KEY, start, start + dt.timedelta(days=1))
+            start, end = dt.date(2020, 6, 4), dt.date(2020, 6, 5)
+            self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            days = self.cache.get_days(self.KEY, dt.date(2020, 6, 1), dt.date(2020, 6, 5))
+            self.assertEqual(list(days.keys()), [dt.date(2020, 6, 1), dt.date(2020, 6, 3), dt.date(2020, 6, 4)])
+
+        def test_assemble_merges_cached_and_fetched_days(self):
+            start, end = dt.date(2020, 6, 1), dt.date(2020, 6, 2)
+            self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end)
+            days = self.cache.get_days(self.KEY, start, dt.date(2020, 6, 3))
+            start, end = dt.date(2020, 6, 2), dt.date(2020, 6, 3)
+            days.update(self.cache.set_days(self.KEY, self.meter_reading(start, end), start, end))
+            data = self.cache.assemble(self.KEY, days, dt.date(2020, 6, 1), dt.date(2020, 6, 3))
+            self.assertEqual(data['meter_reading']['start'], '2020-06-01')
+            self.assertEqual(data['meter_reading']['end'], '2020-06-03')
+            self.assertEqual(data['meter_reading']['usage_point_id'], '22516914714270')
+            readings = data['meter_reading']['interval_reading']
+            self.assertEqual(len(readings), 96)
+            self.assertEqual(readings[0]['date'], '2020-06-01 00:30:00')
+            self.assertEqual(readings[-1]['date'], '2020-06-03 00:00:00')
+
+    unittest.main()
@@ -0,0 +1,192 @@
+import bisect
+import math
+
+# Minimal metrics in the OpenMetrics text format, scraped by Prometheus on
+# the /metrics route of the web interface.
+#
+# Metrics are declared once at module level next to the code they
+# describe, and registered in REGISTRY. Label values are given as keyword
+# arguments:
+#
+#     REQUESTS = Counter('requests', "Requests received", ['status'])
+#     REQUESTS.inc(status='200')
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.append(f'# HELP {metric.name} {escape(metric.documentation)}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{format_labels(labels)} {format_value(value)}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def labels(self, key):
+        return list(zip(self.labelnames, key))
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield '_total', self.labels(key), value
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = None
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def set_function(self, function):
+        """ Compute values when collected, function returns {label values tuple: value} """
+        self.function = function
+
+    def samples(self):
+        values = self.values if self.function is None else self.function()
+        for key, value in values.items():
+            yield '', self.labels(key), value
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self.values.get(self.key(labels), ([], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            labels = self.labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield '_bucket', labels + [('le', format_value(bound))], cumulative
+            yield '_count', labels, cumulative
+            yield '_sum', labels, total
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestMetrics(unittest.TestCase):
+
+        def setUp(self):
+            self.registry = Registry()
+
+        def test_counter_is_exposed(self):
+            counter = Counter('calls', 'Calls "made"', ['status'], registry=self.registry)
+            counter.inc(status='200')
+            counter.inc(2, status='500')
+            self.assertEqual(self.registry.expose(),
+                             '# TYPE calls counter\n'
+                             '# HELP calls Calls \\"made\\"\n'
+                             'calls_total{status="200"} 1\n'
+                             'calls_total{status="500"} 2\n'
+                             '# EOF\n')
+
+        def test_histogram_buckets_are_cumulative(self):
+            histogram = Histogram('latency_seconds', 'Latency', buckets=[0.1, 1], registry=self.registry)
+            for value in [0.05, 0.1, 0.5, 2]:
+                histogram.observe(value)
+            self.assertIn('latency_seconds_bucket{le="0.1"} 2\n'
+                          'latency_seconds_bucket{le="1.0"} 3\n'
+                          'latency_seconds_bucket{le="+Inf"} 4\n'
+                          'latency_seconds_count 4\n'
+                          'latency_seconds_sum 2.65\n', self.registry.expose())
+
+        def test_gauge_function_is_called_when_exposed(self):
+            gauge = Gauge('size', 'Size', ['registry'], registry=self.registry)
+            data = {}
+            gauge.set_function(lambda: {('tokens',): len(data)})
+            data['0'] = None
+            self.assertIn('size{registry="tokens"} 1\n', self.registry.expose())
+
+        def test_labels_are_checked(self):
+            counter = Counter('calls', 'Calls', ['status'], registry=self.registry)
+            with self.assertRaises(ValueError):
+                counter.inc(code='200')
+            with self.assertRaises(ValueError):
+                Counter('calls', 'Calls', registry=self.registry)
+
+    unittest.main()
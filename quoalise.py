@@ -0,0 +1,266 @@
+import base64
+import struct
+
+from slixmpp.xmlstream import ElementBase, ET
+
+# <quoalise xmlns="urn:quoalise:0">
+#   <!-- On peut éventuellement mettre plusieurs élements data -->
+#   <data>
+#     <meta>
+#       <device type="electricity-meter">
+#         <identifier authority="enedis" type="prm" value="22516914714270"/>
+#       </device>
+#       <measurement>
+#         <physical quantity="power" type="electrical" unit="W">
+#         <business graph="load-profile" direction="consumption"/>
+#         <aggregate type="average" />
+#         <sampling interval="1800" />
+#       </measurement>
+#     </meta>
+#     <sensml xmlns="urn:ietf:params:xml:ns:senml">
+#       <senml bn="…" bt="1600034400" t="0" v="245" bu="W"/>
+#       <senml t="1800" v="420"/>
+#     </sensml>
+#   </data>
+#   <!-- Ou, sur demande, les mêmes enregistrements en SenML-CBOR (RFC 8428) encodé en base64 -->
+#   <data>
+#     <meta>…</meta>
+#     <senml-cbor xmlns="urn:quoalise:0">n6Qh…</senml-cbor>
+#   </data>
+#   <!-- Ou une erreur, pour une requête portant sur plusieurs PRM -->
+#   <data>
+#     <meta>…</meta>
+#     <upstream-error issuer="enedis-data-connect" code="ADAM-ERR0069">…</upstream-error>
+#   </data>
+# </quoalise>
+
+ENCODINGS = ['xml', 'cbor']
+
+# SenML-CBOR labels (RFC 8428 section 6)
+SENML_BN = -2
+SENML_BT = -3
+SENML_BU = -4
+SENML_V = 2
+SENML_T = 6
+
+class Quoalise(ElementBase):
+    name = 'quoalise'
+    namespace = 'urn:quoalise:0'
+
+def append_data(quoalise, usage_point_id, measurement, bn, bu, bt, times, values, encoding='xml'):
+    """ Append a <data> element to quoalise
+
+    measurement is a list of (tag, attributes) describing <measurement> children,
+    times are UTC timestamps of each value, given as offsets to bt in SenML.
+    encoding is one of ENCODINGS.
+    """
+
+    xmldata = ET.SubElement(quoalise.xml, 'data')
+
+    meta = ET.SubElement(xmldata, 'meta')
+
+    device = ET.SubElement(meta, 'device', attrib={'type': "electricity-meter"})
+    ET.SubElement(device, 'identifier', attrib={'authority': "enedis", 'type': "prm", 'value': usage_point_id})
+
+    measurement_meta = ET.SubElement(meta, 'measurement')
+    for tag, attrib in measurement:
+        ET.SubElement(measurement_meta, tag, attrib=attrib)
+
+    if encoding == 'cbor':
+        senml_cbor = ET.SubElement(xmldata, 'senml-cbor', xmlns="urn:quoalise:0")
+        senml_cbor.text = base64.b64encode(encode_senml_cbor(bn, bu, bt, times, values)).decode('ascii')
+        return xmldata
+
+    sensml = ET.SubElement(xmldata, 'sensml', xmlns="urn:ietf:params:xml:ns:senml")
+
+    if times:
+        ET.SubElement(sensml, 'senml', bn=bn, bt=str(bt), t=str(times[0] - bt), v=str(values[0]), bu=bu)
+    for t, v in zip(times[1:], values[1:]):
+        ET.SubElement(sensml, 'senml', t=str(t - bt), v=str(v))
+
+    return xmldata
+
+def encode_senml_cbor(bn, bu, bt, times, values):
+    """ SenML-CBOR pack with the same records as the XML form """
+
+    records = []
+    for i, (t, v) in enumerate(zip(times, values)):
+        record = {SENML_BN: bn, SENML_BT: bt, SENML_BU: bu} if i == 0 else {}
+        record[SENML_T] = t - bt
+        record[SENML_V] = number(v)
+        records.append(record)
+
+    return encode_cbor(records)
+
+def number(value):
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    return value
+
+def encode_cbor(item):
+    """ Minimal CBOR encoder for SenML: integers, floats, strings, lists and dicts """
+    out = bytearray()
+    _encode_cbor(item, out)
+    return bytes(out)
+
+def _encode_head(major, length, out):
+    if length < 24:
+        out.append(major << 5 | length)
+    elif length < 0x100:
+        out.extend(struct.pack('>BB', major << 5 | 24, length))
+    elif length < 0x10000:
+        out.extend(struct.pack('>BH', major << 5 | 25, length))
+    elif length < 0x100000000:
+        out.extend(struct.pack('>BI', major << 5 | 26, length))
+    else:
+        out.extend(struct.pack('>BQ', major << 5 | 27, length))
+
+def _encode_cbor(item, out):
+    if isinstance(item, bool):
+        out.append(0xf5 if item else 0xf4)
+    elif isinstance(item, int):
+        if item >= 0:
+            _encode_head(0, item, out)
+        else:
+            _encode_head(1, -1 - item, out)
+    elif isinstance(item, float):
+        if item.is_integer() and abs(item) < 2 ** 63:
+            _encode_cbor(int(item), out)
+        elif struct.unpack('>f', struct.pack('>f', item))[0] == item:
+            out.extend(struct.pack('>Bf', 0xfa, item))
+        else:
+            out.extend(struct.pack('>Bd', 0xfb, item))
+    elif isinstance(item, str):
+        data = item.encode('utf-8')
+        _encode_head(3, len(data), out)
+        out.extend(data)
+    elif isinstance(item, (list, tuple)):
+        _encode_head(4, len(item), out)
+        for element in item:
+            _encode_cbor(element, out)
+    elif isinstance(item, dict):
+        _encode_head(5, len(item), out)
+        for key, value in item.items():
+            _encode_cbor(key, out)
+            _encode_cbor(value, out)
+    else:
+        raise TypeError(f'Cannot encode {type(item)} in CBOR')
+
+def append_error(quoalise, usage_point_id, measurement, message, code=None, issuer='enedis-data-connect'):
+    """ Append a <data> element to quoalise, reporting that its values could not be retrieved
+
+    Used when a response holds data of several usage points, the error
+    element is the same as the one of a failed single usage point request.
+    """
+
+    xmldata = ET.SubElement(quoalise.xml, 'data')
+
+    meta = ET.SubElement(xmldata, 'meta')
+
+    device = ET.SubElement(meta, 'device', attrib={'type': "electricity-meter"})
+    ET.SubElement(device, 'identifier', attrib={'authority': "enedis", 'type': "prm", 'value': usage_point_id})
+
+    measurement_meta = ET.SubElement(meta, 'measurement')
+    for tag, attrib in measurement:
+        ET.SubElement(measurement_meta, tag, attrib=attrib)
+
+    attrib = {'issuer': issuer}
+    if code is not None:
+        attrib['code'] = code
+    error = ET.SubElement(xmldata, 'upstream-error', attrib=attrib)
+    error.text = message
+
+    return xmldata
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestQuoalise(unittest.TestCase):
+
+        def test_data_is_appended(self):
+            quoalise = Quoalise()
+            append_data(quoalise, '22516914714270',
+                        [('physical', {'quantity': "energy", 'type': "electrical", 'unit': "Wh"}),
+                         ('sampling', {'interval': "P1D"})],
+                        'urn:dev:prm:22516914714270_daily_consumption', 'Wh',
+                        1590098400, [1590098400, 1590184800], ['1200', '1300'])
+            self.assertEqual(str(quoalise),
+                '<quoalise xmlns="urn:quoalise:0"><data xmlns=""><meta><device type="electricity-meter">'
+                '<identifier authority="enedis" type="prm" value="22516914714270" /></device>'
+                '<measurement><physical quantity="energy" type="electrical" unit="Wh" /><sampling interval="P1D" /></measurement></meta>'
+                '<sensml xmlns="urn:ietf:params:xml:ns:senml">'
+                '<senml bn="urn:dev:prm:22516914714270_daily_consumption" bt="1590098400" t="0" v="1200" bu="Wh" />'
+                '<senml t="86400" v="1300" /></sensml></data></quoalise>')
+
+        def test_empty_data(self):
+            quoalise = Quoalise()
+            append_data(quoalise, '22516914714270', [], 'bn', 'W', 1590098400, [], [])
+            self.assertEqual(len(quoalise.xml.find('data/sensml')), 0)
+
+        @staticmethod
+        def decode_cbor(data):
+            # Enough of CBOR to check encode_cbor output
+            def item(i):
+                major, info = data[i] >> 5, data[i] & 0x1f
+                i += 1
+                if major == 7:
+                    fmt = {25: '>e', 26: '>f', 27: '>d'}[info]
+                    size = struct.calcsize(fmt)
+                    return struct.unpack(fmt, data[i:i + size])[0], i + size
+                if info >= 24:
+                    size = 1 << (info - 24)
+                    info = int.from_bytes(data[i:i + size], 'big')
+                    i += size
+                if major == 0:
+                    return info, i
+                if major == 1:
+                    return -1 - info, i
+                if major == 3:
+                    return data[i:i + info].decode('utf-8'), i + info
+                if major == 4:
+                    items = []
+                    for _ in range(info):
+                        value, i = item(i)
+                        items.append(value)
+                    return items, i
+                if major == 5:
+                    items = {}
+                    for _ in range(info):
+                        key, i = item(i)
+                        items[key], i = item(i)
+                    return items, i
+            return item(0)[0]
+
+        def test_cbor_encoding(self):
+            quoalise = Quoalise()
+            append_data(quoalise, '22516914714270', [], 'urn:dev:prm:22516914714270_daily_consumption', 'Wh',
+                        1590098400, [1590098400, 1590184800, 1590271200], ['1200', '-1300', '12.5'], encoding='cbor')
+            self.assertIsNone(quoalise.xml.find('data/sensml'))
+            encoded = quoalise.xml.find('data/senml-cbor').text
+            self.assertEqual(self.decode_cbor(base64.b64decode(encoded)),
+                             [{-2: 'urn:dev:prm:22516914714270_daily_consumption', -3: 1590098400, -4: 'Wh', 6: 0, 2: 1200},
+                              {6: 86400, 2: -1300},
+                              {6: 172800, 2: 12.5}])
+
+        def test_cbor_integer_sizes(self):
+            for value in [0, 23, 24, 255, 256, 65535, 65536, 2 ** 32, -1, -25, -2 ** 40]:
+                self.assertEqual(self.decode_cbor(encode_cbor(value)), value)
+            self.assertEqual(self.decode_cbor(encode_cbor(0.1)), 0.1)
+
+        def test_error_is_appended(self):
+            quoalise = Quoalise()
+            append_data(quoalise, '22516914714270', [], 'bn', 'W', 1590098400, [1590098400], ['1'])
+            append_error(quoalise, '22516914714271', [('business', {'direction': "consumption"})],
+                         'No consent', code='ADAM-ERR0069')
+            data = quoalise.xml.findall('data')
+            self.assertEqual(len(data), 2)
+            self.assertEqual(data[1].find('meta/device/identifier').get('value'), '22516914714271')
+            error = data[1].find('upstream-error')
+            self.assertEqual((error.get('issuer'), error.get('code'), error.text),
+                             ('enedis-data-connect', 'ADAM-ERR0069', 'No consent'))
+
+    unittest.main()
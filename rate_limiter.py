@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+# Schedules calls to a quota limited API.
+#
+# - A token bucket limits the request rate to the quota, allowing bursts
+# - Concurrency is adjusted with AIMD: increased by one every "round trip"
+#   while the API is responsive, halved when a 429 is returned, a call fails
+#   or is slower than slow_latency
+# - Waiting calls are queued by requester and served round robin, so that a
+#   requester issuing many calls does not starve others
+
+class RateLimiter:
+
+    def __init__(self, rate, burst, max_concurrency, min_concurrency=1, slow_latency=10.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.slow_latency = slow_latency
+
+        self.concurrency = float(min(max_concurrency, burst))
+        self.in_flight = 0
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.decreased_at = 0.0
+        self.queues = OrderedDict()
+        self.timer = None
+
+    async def acquire(self, requester=None):
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(requester, deque()).append(future)
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was granted while being cancelled
+                self.in_flight -= 1
+                self.dispatch()
+            raise
+
+    def release(self, status, latency):
+        """ Release a slot, status being None when no response was received """
+
+        self.in_flight -= 1
+
+        if status == 429 or status is None or status >= 500 or latency > self.slow_latency:
+            self.decrease()
+            if status == 429:
+                self.tokens = 0.0
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+        self.dispatch()
+
+    def cancel(self):
+        """ Release a slot whose call was abandoned, without adjusting concurrency """
+
+        self.in_flight -= 1
+        self.dispatch()
+
+    def decrease(self):
+        # Calls already in flight when the limit was decreased may also fail,
+        # the limit is halved at most once per slow_latency period.
+        now = time.monotonic()
+        if now - self.decreased_at < self.slow_latency:
+            return
+        self.decreased_at = now
+        self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+        logging.warning(f"Data Connect concurrency decreased to {int(self.concurrency)}")
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def dispatch(self):
+        self.refill()
+
+        while self.queues and self.in_flight < int(self.concurrency) and self.tokens >= 1:
+            requester, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(requester)
+            else:
+                del self.queues[requester]
+            if future.done(): # cancelled while waiting
+                continue
+            future.set_result(None)
+            self.in_flight += 1
+            self.tokens -= 1
+
+        if self.queues and self.tokens < 1 and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later((1 - self.tokens) / self.rate, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    def waiting(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+        async def test_requesters_are_served_round_robin(self):
+            limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=1)
+            served = []
+
+            async def call(requester):
+                await limiter.acquire(requester)
+                served.append(requester)
+                await asyncio.sleep(0)
+                limiter.release(200, 0.1)
+
+            limiter.concurrency = 1
+            await limiter.acquire('blocker')
+            tasks = [asyncio.create_task(call(r)) for r in ['a', 'a', 'a', 'b', 'c']]
+            await asyncio.sleep(0)
+            limiter.release(200, 0.1)
+            await asyncio.gather(*tasks)
+            self.assertEqual(served, ['a', 'b', 'c', 'a', 'a'])
+
+        async def test_rate_is_limited(self):
+            limiter = RateLimiter(rate=50, burst=1, max_concurrency=10)
+            start = time.monotonic()
+            for _ in range(6):
+                await limiter.acquire()
+                limiter.release(200, 0.1)
+            self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+        async def test_concurrency_is_halved_on_429(self):
+            limiter = RateLimiter(rate=1000, burst=16, max_concurrency=16)
+            for _ in range(8):
+                await limiter.acquire()
+            for _ in range(8):
+                limiter.release(429, 0.1)
+            self.assertEqual(int(limiter.concurrency), 8)
+
+        async def test_concurrency_increases_when_responsive(self):
+            limiter = RateLimiter(rate=1000, burst=4, max_concurrency=16)
+            for _ in range(20):
+                await limiter.acquire()
+                limiter.release(200, 0.1)
+            self.assertGreater(limiter.concurrency, 4)
+            self.assertLessEqual(limiter.concurrency, 16)
+
+        async def test_cancelled_waiters_are_skipped(self):
+            limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=1)
+            limiter.concurrency = 1
+            await limiter.acquire('a')
+            task = asyncio.create_task(limiter.acquire('b'))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.sleep(0)
+            limiter.release(200, 0.1)
+            await asyncio.wait_for(limiter.acquire('c'), 1)
+            self.assertEqual(limiter.in_flight, 1)
+
+        async def test_cancelled_calls_do_not_decrease_concurrency(self):
+            limiter = RateLimiter(rate=1000, burst=8, max_concurrency=8)
+            await limiter.acquire()
+            limiter.cancel()
+            self.assertEqual(limiter.in_flight, 0)
+            self.assertEqual(limiter.concurrency, 8)
+
+    unittest.main()
@@ -0,0 +1,151 @@
+import bisect
+import datetime as dt
+
+from dataconnect import PARIS_TIME
+
+# Server side resampling of load curves.
+#
+# Readings are grouped in periods starting at Paris local hours, days or
+# months. Times are UTC timestamps of the start of each interval, readings
+# of a period being contiguous, each period is aggregated on a slice with
+# builtin functions.
+#
+# Load curve values are average powers: mean, max and min give powers in W,
+# sum gives the energy in Wh consumed or produced during the period. The
+# mean is weighted by interval lengths, which can change over a period.
+#
+# Periods are dated at their start, as the readings sent without resampling.
+
+PERIODS = ['PT1H', 'P1D', 'P1M']
+
+# Form value: <aggregate type="…"/> value
+AGGREGATES = {
+    'mean': 'average',
+    'sum': 'sum',
+    'max': 'maximum',
+    'min': 'minimum'
+}
+
+INTERVAL_LENGTHS = {
+    'PT5M': 300,
+    'PT10M': 600,
+    'PT15M': 900,
+    'PT30M': 1800,
+    'PT60M': 3600,
+    'PT1H': 3600
+}
+
+def interval_seconds(interval_length):
+    try:
+        return INTERVAL_LENGTHS[interval_length]
+    except KeyError:
+        raise ValueError(f'Unknown interval length {interval_length}')
+
+def period_boundaries(period, start_day, end_day):
+    """ UTC timestamps of the periods starts from start_day, the last one being at or after end_day """
+
+    if period == 'PT1H':
+        # Paris UTC offsets are whole hours
+        first, last = PARIS_TIME.timestamps([start_day.isoformat(), end_day.isoformat()])
+        return list(range(first, last + 3600, 3600))
+
+    if period == 'P1D':
+        days = [start_day + dt.timedelta(days=d) for d in range((end_day - start_day).days + 1)]
+    elif period == 'P1M':
+        days = [start_day.replace(day=1)]
+        while days[-1] < end_day:
+            month = days[-1]
+            days.append(dt.date(month.year + month.month // 12, month.month % 12 + 1, 1))
+    else:
+        raise ValueError(f'Unknown period {period}')
+
+    return PARIS_TIME.timestamps([day.isoformat() for day in days])
+
+def resample(starts, values, durations, boundaries, aggregate):
+    """ Aggregate values of intervals starting at starts (sorted, UTC) in periods given by boundaries
+
+    Returns the start of each period that has readings and the aggregated
+    values. durations are interval lengths in seconds, used by sum to get
+    an energy from powers and to weight the mean.
+    """
+
+    if aggregate not in AGGREGATES:
+        raise ValueError(f'Unknown aggregate {aggregate}')
+
+    if aggregate in ('mean', 'sum'):
+        # Energies in W.s
+        energies = [value * duration for value, duration in zip(values, durations)]
+
+    period_starts = []
+    aggregated = []
+    cuts = [bisect.bisect_left(starts, boundary) for boundary in boundaries]
+    for period_start, lo, hi in zip(boundaries, cuts, cuts[1:]):
+        if lo == hi:
+            continue
+        if aggregate == 'mean':
+            value = sum(energies[lo:hi]) / sum(durations[lo:hi])
+        elif aggregate == 'sum':
+            value = sum(energies[lo:hi]) / 3600
+        elif aggregate == 'max':
+            value = max(values[lo:hi])
+        else:
+            value = min(values[lo:hi])
+        period_starts.append(period_start)
+        aggregated.append(value)
+
+    return period_starts, aggregated
+
+def format_value(value):
+    """ SenML value, integers without decimals """
+    value = round(value, 2)
+    if value == int(value):
+        return str(int(value))
+    return str(value)
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestResampling(unittest.TestCase):
+
+        def test_hours_of_a_summer_time_day(self):
+            boundaries = period_boundaries('PT1H', dt.date(2020, 3, 29), dt.date(2020, 3, 30))
+            self.assertEqual(len(boundaries), 24)
+            self.assertEqual(boundaries[0], 1585436400)
+
+        def test_months(self):
+            boundaries = period_boundaries('P1M', dt.date(2020, 11, 15), dt.date(2021, 1, 2))
+            self.assertEqual(boundaries, PARIS_TIME.timestamps(['2020-11-01', '2020-12-01', '2021-01-01', '2021-02-01']))
+
+        def test_aggregates(self):
+            # Two days of half hours, power doubling on the second day
+            start = PARIS_TIME.timestamps(['2020-06-01'])[0]
+            starts = [start + 1800 * i for i in range(96)]
+            values = [1000] * 48 + [2000] * 48
+            durations = [1800] * 96
+            boundaries = period_boundaries('P1D', dt.date(2020, 6, 1), dt.date(2020, 6, 3))
+            self.assertEqual(resample(starts, values, durations, boundaries, 'mean'), ([start, start + 86400], [1000, 2000]))
+            self.assertEqual(resample(starts, values, durations, boundaries, 'sum')[1], [24000, 48000])
+            values[10] = 3000
+            self.assertEqual(resample(starts, values, durations, boundaries, 'max')[1], [3000, 2000])
+            self.assertEqual(resample(starts, values, durations, boundaries, 'min')[1], [1000, 2000])
+
+        def test_mean_is_weighted_by_interval_lengths(self):
+            # Half an hour at 1000 W then 10 minutes intervals at 4000 W
+            start = PARIS_TIME.timestamps(['2020-06-01'])[0]
+            starts = [start, start + 1800, start + 2400, start + 3000]
+            boundaries = period_boundaries('PT1H', dt.date(2020, 6, 1), dt.date(2020, 6, 2))
+            self.assertEqual(resample(starts, [1000, 4000, 4000, 4000], [1800, 600, 600, 600], boundaries, 'mean'),
+                             ([start], [2500]))
+
+        def test_empty_periods_are_skipped(self):
+            start = PARIS_TIME.timestamps(['2020-06-01'])[0]
+            boundaries = period_boundaries('PT1H', dt.date(2020, 6, 1), dt.date(2020, 6, 2))
+            self.assertEqual(resample([start + 7200, start + 9000], [100, 300], [1800, 1800], boundaries, 'mean'),
+                             ([start + 7200], [200]))
+
+        def test_format_value(self):
+            self.assertEqual(format_value(1000.0), '1000')
+            self.assertEqual(format_value(1234.5678), '1234.57')
+
+    unittest.main()
@@ -0,0 +1,284 @@
+import bisect
+import datetime as dt
+import math
+import mmap
+import os
+from collections import OrderedDict
+
+import pytz
+
+from dataconnect import PARIS_TIME
+
+# Columnar store of metering data, one memory mapped file per usage point,
+# direction, endpoint and year:
+#
+#     <root>/<usage_point_id>/<endpoint>_<direction>_<year>.bin
+#
+# Each file holds a fixed number of slots, 30 minutes for the load curve
+# and one day for daily data, laid out as:
+#
+#     int32 values    | validity bitmap, one bit by slot | synced bitmap, one bit by day
+#
+# Load curve slots are counted in UTC from the local start of the year, so
+# that days changing to and from summer time have 46 and 50 slots. The
+# first slot of each local day is found in a day index computed once per
+# year. A day is synced once all its readings have been written, slots
+# without a reading being left invalid.
+#
+# Readings of a day are read back from the mapped file, in the shape
+# Data Connect returns them.
+
+class YearLayout:
+
+    SLOT = 1800 # s
+
+    def __init__(self, endpoint, year):
+        self.endpoint = endpoint
+        self.year = year
+        self.first_day = dt.date(year, 1, 1)
+        days = (dt.date(year + 1, 1, 1) - self.first_day).days
+        midnights = PARIS_TIME.timestamps([(self.first_day + dt.timedelta(days=d)).isoformat() for d in range(days + 1)])
+        self.midnights = midnights
+        if endpoint == 'load_curve':
+            self.day_index = [(midnight - midnights[0]) // self.SLOT for midnight in midnights]
+        elif endpoint == 'daily':
+            self.day_index = list(range(days + 1))
+        else:
+            raise ValueError(f'Unknown endpoint {endpoint}')
+        self.days = days
+        self.capacity = self.day_index[-1]
+
+        self.values_size = 4 * self.capacity
+        self.valid_size = math.ceil(self.capacity / 8)
+        self.synced_size = math.ceil(days / 8)
+        self.size = self.values_size + self.valid_size + self.synced_size
+
+    def day_slots(self, day):
+        d = (day - self.first_day).days
+        return self.day_index[d], self.day_index[d + 1]
+
+    def slot(self, timestamp):
+        """ Slot of a reading, dated at the end of its interval for the load curve, None if not aligned """
+        if self.endpoint == 'load_curve':
+            offset = timestamp - self.midnights[0] - self.SLOT
+            if offset % self.SLOT:
+                return None
+            return offset // self.SLOT
+        else:
+            d = bisect.bisect_left(self.midnights, timestamp)
+            return d if d < self.days and self.midnights[d] == timestamp else None
+
+    def timestamp(self, slot):
+        if self.endpoint == 'load_curve':
+            return self.midnights[0] + (slot + 1) * self.SLOT
+        else:
+            return self.midnights[slot]
+
+class SeriesFile:
+
+    def __init__(self, path, layout):
+        self.layout = layout
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists or os.path.getsize(path) < layout.size:
+            self.file.truncate(layout.size)
+        self.map = mmap.mmap(self.file.fileno(), layout.size)
+        view = memoryview(self.map)
+        self.values = view[:layout.values_size].cast('i')
+        self.valid = view[layout.values_size:layout.values_size + layout.valid_size]
+        self.synced = view[layout.values_size + layout.valid_size:layout.size]
+
+    def close(self):
+        self.values.release()
+        self.valid.release()
+        self.synced.release()
+        self.map.close()
+        self.file.close()
+
+    def is_valid(self, slot):
+        return bool(self.valid[slot >> 3] & (1 << (slot & 7)))
+
+    def is_synced(self, d):
+        return bool(self.synced[d >> 3] & (1 << (d & 7)))
+
+    def set_bit(self, bitmap, i, value):
+        if value:
+            bitmap[i >> 3] |= 1 << (i & 7)
+        else:
+            bitmap[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+class SeriesStore:
+
+    MAX_OPEN_FILES = 256
+    INT32_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+    def __init__(self, root, tz=pytz.timezone('Europe/Paris')):
+        self.root = root
+        self.tz = tz
+        self.layouts = {}
+        self.files = OrderedDict()
+        os.makedirs(root, exist_ok=True)
+
+    def close(self):
+        while self.files:
+            _, series_file = self.files.popitem()
+            series_file.close()
+
+    def layout(self, endpoint, year):
+        layout = self.layouts.get((endpoint, year))
+        if layout is None:
+            layout = self.layouts[(endpoint, year)] = YearLayout(endpoint, year)
+        return layout
+
+    def file(self, key, year, create):
+        usage_point_id, direction, endpoint = key
+        if not usage_point_id.isdigit() or not direction.isalpha():
+            raise ValueError(f'Invalid key {key}')
+
+        series_file = self.files.get(key + (year,))
+        if series_file is not None:
+            self.files.move_to_end(key + (year,))
+            return series_file
+
+        path = os.path.join(self.root, usage_point_id, f'{endpoint}_{direction}_{year}.bin')
+        if not os.path.exists(path):
+            if not create:
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        series_file = self.files[key + (year,)] = SeriesFile(path, self.layout(endpoint, year))
+        while len(self.files) > self.MAX_OPEN_FILES:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        return series_file
+
+    def is_synced(self, key, day):
+        series_file = self.file(key, day.year, create=False)
+        return series_file is not None and series_file.is_synced((day - series_file.layout.first_day).days)
+
+    def write_day(self, key, day, readings):
+        """ Store Data Connect readings of a day, returns False if they do not fit in slots """
+
+        series_file = self.file(key, day.year, create=True)
+        layout = series_file.layout
+        first, last = layout.day_slots(day)
+
+        slots = {}
+        for timestamp, reading in zip(PARIS_TIME.timestamps([reading['date'] for reading in readings]), readings):
+            slot = layout.slot(timestamp)
+            if slot is None or not first <= slot < last or slot in slots:
+                # Not aligned, other interval length or ambiguous local time
+                return False
+            if reading.get('interval_length', 'PT30M') != 'PT30M' and layout.endpoint == 'load_curve':
+                return False
+            try:
+                value = int(reading['value'])
+            except (KeyError, TypeError, ValueError):
+                return False
+            if not self.INT32_RANGE[0] <= value <= self.INT32_RANGE[1]:
+                return False
+            slots[slot] = value
+
+        for slot in range(first, last):
+            value = slots.get(slot)
+            series_file.values[slot] = 0 if value is None else value
+            series_file.set_bit(series_file.valid, slot, value is not None)
+        series_file.set_bit(series_file.synced, (day - layout.first_day).days, True)
+
+        return True
+
+    def readings(self, key, day):
+        """ Data Connect like readings of a synced day """
+
+        _, _, endpoint = key
+        series_file = self.file(key, day.year, create=False)
+        if series_file is None:
+            return []
+        layout = series_file.layout
+        first, last = layout.day_slots(day)
+
+        readings = []
+        for slot in range(first, last):
+            if not series_file.is_valid(slot):
+                continue
+            value = series_file.values[slot]
+            if endpoint == 'load_curve':
+                date = dt.datetime.fromtimestamp(layout.timestamp(slot), self.tz).strftime('%Y-%m-%d %H:%M:%S')
+                readings.append({'value': str(value), 'date': date, 'interval_length': 'PT30M'})
+            else:
+                readings.append({'value': str(value), 'date': day.isoformat()})
+        return readings
+
+if __name__ == '__main__':
+
+    import tempfile
+    import unittest
+
+    class TestSeriesStore(unittest.TestCase):
+
+        KEY = ('22516914714270', 'consumption', 'load_curve')
+
+        def setUp(self):
+            self.dir = tempfile.TemporaryDirectory()
+            self.store = SeriesStore(self.dir.name)
+
+        def tearDown(self):
+            self.store.close()
+            self.dir.cleanup()
+
+        @staticmethod
+        def load_curve(day):
+            readings = []
+            date = dt.datetime.combine(day, dt.time())
+            while date < dt.datetime.combine(day + dt.timedelta(days=1), dt.time()):
+                date += dt.timedelta(minutes=30)
+                readings.append({'value': str(date.hour * 100 + date.minute), 'date': date.strftime('%Y-%m-%d %H:%M:%S'),
+                                 'interval_length': 'PT30M'})
+            return readings
+
+        def test_day_index_follows_summer_time(self):
+            layout = self.store.layout('load_curve', 2020)
+            self.assertEqual(layout.day_slots(dt.date(2020, 1, 1)), (0, 48))
+            first, last = layout.day_slots(dt.date(2020, 3, 29))
+            self.assertEqual(last - first, 46)
+            first, last = layout.day_slots(dt.date(2020, 10, 25))
+            self.assertEqual(last - first, 50)
+            self.assertEqual(layout.capacity, 366 * 48)
+
+        def test_readings_are_read_back(self):
+            day = dt.date(2020, 6, 1)
+            self.assertFalse(self.store.is_synced(self.KEY, day))
+            self.assertTrue(self.store.write_day(self.KEY, day, self.load_curve(day)))
+            self.assertTrue(self.store.is_synced(self.KEY, day))
+            self.assertEqual(self.store.readings(self.KEY, day), self.load_curve(day))
+
+        def test_holes_are_not_valid(self):
+            day = dt.date(2020, 6, 1)
+            readings = self.load_curve(day)
+            del readings[10:20]
+            self.store.write_day(self.KEY, day, readings)
+            self.assertEqual(self.store.readings(self.KEY, day), readings)
+
+        def test_unaligned_readings_are_not_stored(self):
+            day = dt.date(2020, 6, 1)
+            readings = [{'value': '100', 'date': '2020-06-01 00:10:00', 'interval_length': 'PT10M'}]
+            self.assertFalse(self.store.write_day(self.KEY, day, readings))
+            self.assertFalse(self.store.is_synced(self.KEY, day))
+
+        def test_daily_values_across_years(self):
+            key = ('22516914714270', 'consumption', 'daily')
+            for day in [dt.date(2019, 12, 31), dt.date(2020, 1, 1)]:
+                self.store.write_day(key, day, [{'value': str(day.day), 'date': day.isoformat()}])
+            self.assertEqual(self.store.readings(key, dt.date(2019, 12, 31)), [{'value': '31', 'date': '2019-12-31'}])
+            self.assertEqual(self.store.readings(key, dt.date(2020, 1, 1)), [{'value': '1', 'date': '2020-01-01'}])
+            self.assertEqual(self.store.readings(key, dt.date(2021, 1, 1)), [])
+
+        def test_store_is_persisted(self):
+            day = dt.date(2020, 6, 1)
+            self.store.write_day(self.KEY, day, self.load_curve(day))
+            self.store.close()
+            store = SeriesStore(self.dir.name)
+            self.assertEqual(store.readings(self.KEY, day), self.load_curve(day))
+            store.close()
+
+    unittest.main()
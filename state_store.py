@@ -0,0 +1,461 @@
+import json
+import sqlite3
+import time
+
+# Persists proxy registries in a SQLite database in WAL mode.
+#
+# Registries are kept in memory and each change is written through as its
+# own small transaction, so that nothing is lost if the process is killed,
+# in particular rotated refresh tokens.
+#
+# Several processes of the same host can share the database:
+#
+# - Each change is also appended to the changes table, other processes
+#   reload the changed records from there
+# - Locks are leases held by an owner until they expire, so that a crashed
+#   process does not hold them forever
+# - Notifications are messages for the XMPP workers, popped by one of them
+# - Recent metering days fetched by a process, typically by the harvester,
+#   are shared with the others until they expire
+#
+# Calls block the event loop: a busy database is only waited for
+# BUSY_TIMEOUT, sqlite3.OperationalError being raised after that.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    id TEXT PRIMARY KEY,
+    access_token TEXT NOT NULL,
+    refresh_token TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    is_sandbox INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS token_ids (
+    id INTEGER PRIMARY KEY AUTOINCREMENT
+);
+CREATE TABLE IF NOT EXISTS usage_points (
+    jid TEXT NOT NULL,
+    usage_point TEXT NOT NULL,
+    token_id TEXT NOT NULL,
+    PRIMARY KEY (jid, usage_point)
+);
+CREATE INDEX IF NOT EXISTS usage_points_token_id ON usage_points (token_id);
+CREATE INDEX IF NOT EXISTS usage_points_usage_point ON usage_points (usage_point);
+CREATE TABLE IF NOT EXISTS authorize_descriptions (
+    uid TEXT PRIMARY KEY,
+    jid TEXT NOT NULL,
+    name TEXT,
+    service TEXT,
+    logo_url TEXT,
+    created_at REAL,
+    accessed_at REAL
+);
+CREATE TABLE IF NOT EXISTS authorize_requests (
+    state TEXT PRIMARY KEY,
+    jid TEXT NOT NULL,
+    user_state TEXT,
+    redirect_uri TEXT,
+    is_sandbox INTEGER NOT NULL,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    registry TEXT NOT NULL,
+    key TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS locks (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    jid TEXT NOT NULL,
+    usage_points TEXT NOT NULL,
+    state TEXT
+);
+CREATE TABLE IF NOT EXISTS recent_days (
+    key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    readings TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (key, day)
+);
+"""
+
+class StateStore:
+
+    BUSY_TIMEOUT = 0.2 # s
+
+    def __init__(self, path):
+        # Waits for writes of other processes, which are short transactions
+        self.db = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        for table in ['authorize_descriptions', 'authorize_requests']:
+            columns = [row[1] for row in self.db.execute(f'PRAGMA table_info({table})')]
+            if 'created_at' not in columns:
+                self.db.execute(f'ALTER TABLE {table} ADD COLUMN created_at REAL')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(authorize_descriptions)')]
+        if 'accessed_at' not in columns:
+            self.db.execute('ALTER TABLE authorize_descriptions ADD COLUMN accessed_at REAL')
+
+    def close(self):
+        self.db.close()
+
+    def is_empty(self):
+        for table in ['tokens', 'usage_points', 'authorize_descriptions', 'authorize_requests']:
+            if self.db.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() is not None:
+                return False
+        return True
+
+    def set_token(self, idx, token):
+        with self.db:
+            self._set_token(idx, token)
+
+    def add_token(self, token):
+        """ Store a new token, its id being allocated by the database and never reused """
+        with self.db:
+            while True:
+                idx = str(self.db.execute('INSERT INTO token_ids DEFAULT VALUES').lastrowid)
+                # Imported ids were not allocated from the sequence
+                if self.db.execute('SELECT 1 FROM tokens WHERE id = ?', (idx,)).fetchone() is None:
+                    break
+            self.db.execute('DELETE FROM token_ids')
+            self._set_token(idx, token)
+        return idx
+
+    def delete_token(self, idx):
+        """ Delete a token and the usage points accesses depending on it """
+        with self.db:
+            jids = [jid for jid, in self.db.execute('SELECT DISTINCT jid FROM usage_points WHERE token_id = ?', (idx,))]
+            self.db.execute('DELETE FROM usage_points WHERE token_id = ?', (idx,))
+            self.db.execute('DELETE FROM tokens WHERE id = ?', (idx,))
+            self._changed('tokens', idx)
+            for jid in jids:
+                self._changed('usage_points', jid)
+
+    def set_usage_point(self, jid, usage_point, token_id):
+        with self.db:
+            self._set_usage_point(jid, usage_point, token_id)
+
+    def set_authorize_description(self, uid, description):
+        with self.db:
+            self._set_authorize_description(uid, description)
+
+    def set_authorize_request(self, state, request):
+        with self.db:
+            self._set_authorize_request(state, request)
+
+    def delete_authorize_descriptions(self, uids):
+        with self.db:
+            self.db.executemany('DELETE FROM authorize_descriptions WHERE uid = ?', [(uid,) for uid in uids])
+            for uid in uids:
+                self._changed('authorize_descriptions', uid)
+
+    def delete_authorize_requests(self, states):
+        with self.db:
+            self.db.executemany('DELETE FROM authorize_requests WHERE state = ?', [(state,) for state in states])
+            for state in states:
+                self._changed('authorize_requests', state)
+
+    def _changed(self, registry, key):
+        self.db.execute('INSERT INTO changes (registry, key, created_at) VALUES (?, ?, ?)', (registry, key, time.time()))
+
+    def _set_token(self, idx, token):
+        self.db.execute('INSERT OR REPLACE INTO tokens (id, access_token, refresh_token, expires_at, is_sandbox) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (idx, token['access_token'], token['refresh_token'], token['expires_at'], token['is_sandbox']))
+        self._changed('tokens', idx)
+
+    def _set_usage_point(self, jid, usage_point, token_id):
+        self.db.execute('INSERT OR REPLACE INTO usage_points (jid, usage_point, token_id) VALUES (?, ?, ?)',
+                        (jid, usage_point, token_id))
+        self._changed('usage_points', jid)
+
+    def _set_authorize_description(self, uid, description):
+        self.db.execute('INSERT OR REPLACE INTO authorize_descriptions (uid, jid, name, service, logo_url, created_at, accessed_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (uid, description['jid'], description['name'], description['service'], description['logo_url'],
+                         description['created_at'], description['accessed_at']))
+        self._changed('authorize_descriptions', uid)
+
+    def _set_authorize_request(self, state, request):
+        self.db.execute('INSERT OR REPLACE INTO authorize_requests (state, jid, user_state, redirect_uri, is_sandbox, created_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (state, request['jid'], request['state'], request['redirect_uri'], request['is_sandbox'],
+                         request['created_at']))
+        self._changed('authorize_requests', state)
+
+    def import_state(self, state):
+        """ Import registries in the former state.json format, in a single transaction """
+        with self.db:
+            for idx, token in state.get('tokens', {}).items():
+                self._set_token(idx, token)
+            for jid, usage_points in state.get('usage_points', {}).items():
+                for usage_point, token_id in usage_points.items():
+                    self._set_usage_point(jid, usage_point, token_id)
+            for uid, description in state.get('authorize_descriptions', {}).items():
+                self._set_authorize_description(uid, dict(description, created_at=description.get('created_at'),
+                                                          accessed_at=description.get('accessed_at')))
+            for state_id, request in state.get('authorize_requests', {}).items():
+                self._set_authorize_request(state_id, dict(request, created_at=request.get('created_at')))
+
+    def load(self):
+        """ Registries in the former state.json format """
+
+        state = {
+            'tokens': {},
+            'usage_points': {},
+            'authorize_descriptions': {},
+            'authorize_requests': {}
+        }
+
+        for idx, access_token, refresh_token, expires_at, is_sandbox in self.db.execute(
+                'SELECT id, access_token, refresh_token, expires_at, is_sandbox FROM tokens'):
+            state['tokens'][idx] = {
+                'access_token': access_token,
+                'refresh_token': refresh_token,
+                'expires_at': expires_at,
+                'is_sandbox': bool(is_sandbox)
+            }
+
+        for jid, usage_point, token_id in self.db.execute('SELECT jid, usage_point, token_id FROM usage_points'):
+            state['usage_points'].setdefault(jid, {})[usage_point] = token_id
+
+        for uid, jid, name, service, logo_url, created_at, accessed_at in self.db.execute(
+                'SELECT uid, jid, name, service, logo_url, created_at, accessed_at FROM authorize_descriptions ORDER BY accessed_at'):
+            state['authorize_descriptions'][uid] = {
+                'jid': jid,
+                'name': name,
+                'service': service,
+                'logo_url': logo_url,
+                'created_at': created_at,
+                'accessed_at': accessed_at
+            }
+
+        for state_id, jid, user_state, redirect_uri, is_sandbox, created_at in self.db.execute(
+                'SELECT state, jid, user_state, redirect_uri, is_sandbox, created_at FROM authorize_requests ORDER BY created_at'):
+            state['authorize_requests'][state_id] = {
+                'jid': jid,
+                'state': user_state,
+                'redirect_uri': redirect_uri,
+                'is_sandbox': bool(is_sandbox),
+                'created_at': created_at
+            }
+
+        return state
+
+    # Records, in the former state.json format, None if deleted
+
+    def get_token(self, idx):
+        row = self.db.execute('SELECT access_token, refresh_token, expires_at, is_sandbox FROM tokens WHERE id = ?',
+                              (idx,)).fetchone()
+        if row is None:
+            return None
+        access_token, refresh_token, expires_at, is_sandbox = row
+        return {'access_token': access_token, 'refresh_token': refresh_token, 'expires_at': expires_at,
+                'is_sandbox': bool(is_sandbox)}
+
+    def get_usage_points(self, jid):
+        usage_points = dict(self.db.execute('SELECT usage_point, token_id FROM usage_points WHERE jid = ?', (jid,)))
+        return usage_points or None
+
+    def get_authorize_description(self, uid):
+        row = self.db.execute('SELECT jid, name, service, logo_url, created_at, accessed_at FROM authorize_descriptions WHERE uid = ?',
+                              (uid,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['jid', 'name', 'service', 'logo_url', 'created_at', 'accessed_at'], row))
+
+    def get_authorize_request(self, state):
+        row = self.db.execute('SELECT jid, user_state, redirect_uri, is_sandbox, created_at FROM authorize_requests WHERE state = ?',
+                              (state,)).fetchone()
+        if row is None:
+            return None
+        jid, user_state, redirect_uri, is_sandbox, created_at = row
+        return {'jid': jid, 'state': user_state, 'redirect_uri': redirect_uri, 'is_sandbox': bool(is_sandbox),
+                'created_at': created_at}
+
+    # Changes
+
+    def last_change(self):
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return 0 if row is None else row[0]
+
+    def changes_since(self, seq):
+        """ (seq, registry, key) of changes after seq, None if some of them were swept """
+        first, = self.db.execute('SELECT MIN(seq) FROM changes').fetchone()
+        if first is None:
+            first = self.last_change() + 1
+        if first > seq + 1:
+            return None
+        return self.db.execute('SELECT seq, registry, key FROM changes WHERE seq > ? ORDER BY seq', (seq,)).fetchall()
+
+    def sweep_changes(self, before):
+        with self.db:
+            self.db.execute('DELETE FROM changes WHERE created_at < ?', (before,))
+
+    # Locks
+
+    def acquire_lock(self, name, owner, ttl):
+        """ Take or extend a lease on name, False if another owner holds it """
+        now = time.time()
+        with self.db:
+            self.db.execute('INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) '
+                            'ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                            'WHERE locks.expires_at < ? OR locks.owner = excluded.owner',
+                            (name, owner, now + ttl, now))
+            holder, = self.db.execute('SELECT owner FROM locks WHERE name = ?', (name,)).fetchone()
+        return holder == owner
+
+    def release_lock(self, name, owner):
+        with self.db:
+            self.db.execute('DELETE FROM locks WHERE name = ? AND owner = ?', (name, owner))
+
+    # Notifications
+
+    def add_notification(self, jid, usage_points, state):
+        with self.db:
+            self.db.execute('INSERT INTO notifications (jid, usage_points, state) VALUES (?, ?, ?)',
+                            (jid, ','.join(usage_points), state))
+
+    def pop_notifications(self):
+        """ (jid, usage_points, state) of pending notifications, each one being popped by a single process """
+        with self.db:
+            rows = self.db.execute('DELETE FROM notifications RETURNING id, jid, usage_points, state').fetchall()
+        return [(jid, usage_points.split(','), state) for _, jid, usage_points, state in sorted(rows)]
+
+    # Recent metering days, keyed by (usage_point_id, direction, endpoint)
+
+    def set_recent_days(self, key, days, expires_at):
+        """ Share {day: readings} until expires_at """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO recent_days (key, day, readings, expires_at) VALUES (?, ?, ?, ?)',
+                                [(':'.join(key), day.isoformat(), json.dumps(readings), expires_at)
+                                 for day, readings in days.items()])
+
+    def get_recent_day(self, key, day):
+        """ Shared readings of day, None if unknown or expired """
+        row = self.db.execute('SELECT readings FROM recent_days WHERE key = ? AND day = ? AND expires_at > ?',
+                              (':'.join(key), day.isoformat(), time.time())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def sweep_recent_days(self):
+        with self.db:
+            return self.db.execute('DELETE FROM recent_days WHERE expires_at <= ?', (time.time(),)).rowcount
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestStateStore(unittest.TestCase):
+
+        STATE = {
+            'tokens': {
+                '0': {'access_token': 'a', 'refresh_token': 'r', 'expires_at': '2020-06-01 12:00:00', 'is_sandbox': True}
+            },
+            'usage_points': {
+                'proxy-client@elec-expert.net': {'22516914714270': '0', '22516914714271': '0'}
+            },
+            'authorize_descriptions': {
+                'ad35a140': {'jid': 'proxy-client@elec-expert.net', 'name': 'Elec Expert', 'service': '<p>Hi</p>', 'logo_url': None, 'created_at': 1590000000.0,
+                             'accessed_at': 1590000000.0}
+            },
+            'authorize_requests': {
+                '8f2a11b00': {'jid': 'proxy-client@elec-expert.net', 'state': None, 'redirect_uri': 'https://example.com', 'is_sandbox': True, 'created_at': 1590000000.0}
+            }
+        }
+
+        def setUp(self):
+            self.store = StateStore(':memory:')
+
+        def tearDown(self):
+            self.store.close()
+
+        def test_new_store_is_empty(self):
+            self.assertTrue(self.store.is_empty())
+
+        def test_imported_state_is_loaded(self):
+            self.store.import_state(self.STATE)
+            self.assertFalse(self.store.is_empty())
+            self.assertEqual(self.store.load(), self.STATE)
+
+        def test_changes_are_written_through(self):
+            self.store.import_state(self.STATE)
+            self.store.set_token('0', {'access_token': 'b', 'refresh_token': 's', 'expires_at': '2020-06-01 15:00:00', 'is_sandbox': True})
+            self.store.set_usage_point('other@example.com', '22516914714270', '0')
+            state = self.store.load()
+            self.assertEqual(state['tokens']['0']['refresh_token'], 's')
+            self.assertEqual(state['usage_points']['other@example.com'], {'22516914714270': '0'})
+
+        def test_deleted_requests_are_not_loaded(self):
+            self.store.import_state(self.STATE)
+            self.store.delete_authorize_requests(['8f2a11b00'])
+            self.store.delete_authorize_descriptions(['ad35a140'])
+            state = self.store.load()
+            self.assertEqual(state['authorize_requests'], {})
+            self.assertEqual(state['authorize_descriptions'], {})
+
+        def test_token_ids_are_allocated(self):
+            self.store.import_state(self.STATE)
+            token = self.STATE['tokens']['0']
+            self.assertEqual([self.store.add_token(token), self.store.add_token(token)], ['1', '2'])
+            self.assertEqual(self.store.get_token('2'), token)
+
+        def test_deleted_token_ids_are_not_reused(self):
+            self.store.import_state(self.STATE)
+            token = self.STATE['tokens']['0']
+            idx = self.store.add_token(token)
+            self.store.set_usage_point('other@example.com', '22516914714270', idx)
+            self.store.delete_token(idx)
+            self.assertIsNone(self.store.get_token(idx))
+            self.assertIsNone(self.store.get_usage_points('other@example.com'))
+            self.assertEqual(self.store.get_usage_points('proxy-client@elec-expert.net'),
+                             {'22516914714270': '0', '22516914714271': '0'})
+            self.assertEqual(self.store.add_token(token), str(int(idx) + 1))
+
+        def test_changes_are_listed(self):
+            seq = self.store.last_change()
+            self.store.import_state(self.STATE)
+            self.store.delete_authorize_requests(['8f2a11b00'])
+            changes = self.store.changes_since(seq)
+            self.assertEqual([(registry, key) for _, registry, key in changes],
+                             [('tokens', '0'), ('usage_points', 'proxy-client@elec-expert.net'),
+                              ('usage_points', 'proxy-client@elec-expert.net'), ('authorize_descriptions', 'ad35a140'),
+                              ('authorize_requests', '8f2a11b00'), ('authorize_requests', '8f2a11b00')])
+            self.assertIsNone(self.store.get_authorize_request('8f2a11b00'))
+            self.assertEqual(self.store.changes_since(changes[-1][0]), [])
+            self.store.sweep_changes(time.time() + 1)
+            self.assertIsNone(self.store.changes_since(1))
+
+        def test_lock_is_held_by_one_owner(self):
+            self.assertTrue(self.store.acquire_lock('refresh:0', 'a', 60))
+            self.assertFalse(self.store.acquire_lock('refresh:0', 'b', 60))
+            self.assertTrue(self.store.acquire_lock('refresh:0', 'a', 60))
+            self.store.release_lock('refresh:0', 'a')
+            self.assertTrue(self.store.acquire_lock('refresh:0', 'b', -1))
+            # Expired lease
+            self.assertTrue(self.store.acquire_lock('refresh:0', 'a', 60))
+
+        def test_recent_days_are_shared_until_they_expire(self):
+            import datetime as dt
+            key = ('22516914714270', 'consumption', 'daily')
+            readings = [{'value': '1000', 'date': '2020-06-01'}]
+            self.store.set_recent_days(key, {dt.date(2020, 6, 1): readings}, time.time() + 60)
+            self.store.set_recent_days(key, {dt.date(2020, 6, 2): readings}, time.time() - 1)
+            self.assertEqual(self.store.get_recent_day(key, dt.date(2020, 6, 1)), readings)
+            self.assertIsNone(self.store.get_recent_day(key, dt.date(2020, 6, 2)))
+            self.assertEqual(self.store.sweep_recent_days(), 1)
+
+        def test_notifications_are_popped_once(self):
+            self.store.add_notification('proxy-client@elec-expert.net', ['22516914714270', '22516914714271'], 'user-state')
+            self.assertEqual(self.store.pop_notifications(),
+                             [('proxy-client@elec-expert.net', ['22516914714270', '22516914714271'], 'user-state')])
+            self.assertEqual(self.store.pop_notifications(), [])
+
+    unittest.main()
@@ -0,0 +1,253 @@
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+
+from metrics import Counter
+
+# Lightweight tracing of requests, and an on-demand sampling profiler.
+#
+# A trace is started for each ad-hoc command submission, identified by its
+# node and session id, and follows the request through the tasks it
+# creates. Stages of the request are timed with spans:
+#
+#     with tracing.span('http'):
+#         …
+#
+# Spans are no-ops outside of a trace. Their durations are summed by
+# stage. Spans can be nested or run concurrently, so stages can add up to
+# more than the request duration. A finished trace adds its stages to
+# STAGE_SECONDS. Requests slower than SLOW_REQUEST_THRESHOLD are logged
+# with their breakdown.
+
+# s, set from the configuration
+SLOW_REQUEST_THRESHOLD = 5.0
+
+STAGE_SECONDS = Counter('request_stage_seconds', "Time spent by traced requests in each stage", ['node', 'stage'])
+
+_current = contextvars.ContextVar('trace', default=None)
+
+class Trace:
+
+    def __init__(self, node, id):
+        self.node = node
+        self.id = id
+        self.started_at = time.perf_counter()
+        self.duration = None
+        # stage: [seconds, count]
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        times = self.stages.get(stage)
+        if times is None:
+            times = self.stages[stage] = [0.0, 0]
+        times[0] += seconds
+        times[1] += 1
+
+    def breakdown(self):
+        return ', '.join(f'{stage} {seconds * 1000:.1f} ms' + (f' ({count} spans)' if count > 1 else '')
+                         for stage, (seconds, count) in sorted(self.stages.items(), key=lambda item: -item[1][0]))
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.started_at
+        for stage, (seconds, _) in self.stages.items():
+            STAGE_SECONDS.inc(seconds, node=self.node, stage=stage)
+        if self.duration >= SLOW_REQUEST_THRESHOLD:
+            logging.warning(f"Slow {self.node} {self.id}: {self.duration:.2f} s, {self.breakdown()}")
+
+class span:
+
+    __slots__ = ('stage', 'trace', 'started_at')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.trace = _current.get()
+        if self.trace is not None:
+            self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.add(self.stage, time.perf_counter() - self.started_at)
+
+def start(node, id):
+    """ Trace of the current task, and of the tasks it creates from now on """
+    trace = Trace(node, id)
+    _current.set(trace)
+    return trace
+
+def current():
+    return _current.get()
+
+def finish():
+    trace = _current.get()
+    if trace is not None:
+        _current.set(None)
+        trace.finish()
+
+class SamplingProfiler:
+
+    # Samples the stack of a thread, the event loop one, from a background
+    # thread. Stacks are counted in the collapsed format of flame graph
+    # tools: "outer;…;inner count".
+
+    INTERVAL = 0.005 # s
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.stopping = threading.Event()
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        """ Sample the calling thread """
+
+        if self.running:
+            raise RuntimeError('The profiler is already running')
+
+        self.stacks.clear()
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.sample, args=(threading.get_ident(),), name='profiler', daemon=True)
+        self.thread.start()
+
+    def sample(self, thread_id):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+
+        if not self.running:
+            raise RuntimeError('The profiler is not running')
+
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def top(self, n=20):
+        """ (function, own samples, total samples) of the functions most often on top of the stack """
+
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(';')
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+        return [(function, count, total[function]) for function, count in own.most_common(n)]
+
+    def dump(self, directory):
+        """ Write the collapsed stacks in directory, returns the file path """
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, time.strftime('profile-%Y%m%d-%H%M%S.txt'))
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+# Shared by the admin command and the signal handler
+profiler = SamplingProfiler()
+
+# Set from the configuration
+PROFILES_PATH = 'profiles'
+
+def stop_profiler():
+    """ Stop the profiler and dump its samples, returns the dump path """
+    profiler.stop()
+    path = profiler.dump(PROFILES_PATH)
+    logging.warning(f"Profiler stopped, {profiler.samples} samples written to {path}")
+    return path
+
+def toggle_profiler():
+    """ Start the profiler, or stop it and dump its samples (SIGUSR2) """
+    if profiler.running:
+        stop_profiler()
+    else:
+        profiler.start()
+        logging.warning("Profiler started")
+
+if __name__ == '__main__':
+
+    import asyncio
+    import tempfile
+    import unittest
+
+    class TestTracing(unittest.IsolatedAsyncioTestCase):
+
+        async def test_spans_are_summed_by_stage(self):
+            async def fetch():
+                with span('http'):
+                    await asyncio.sleep(0.01)
+
+            trace = start('get_daily', 'session')
+            with span('token_lookup'):
+                pass
+            await asyncio.gather(fetch(), fetch())
+            finish()
+            self.assertEqual(trace.stages['http'][1], 2)
+            self.assertGreaterEqual(trace.stages['http'][0], 0.02)
+            self.assertEqual(trace.stages['token_lookup'][1], 1)
+            self.assertIsNone(current())
+
+        async def test_spans_outside_of_a_trace_are_ignored(self):
+            with span('http'):
+                pass
+            self.assertIsNone(current())
+
+        async def test_slow_requests_are_logged(self):
+            global SLOW_REQUEST_THRESHOLD
+            threshold, SLOW_REQUEST_THRESHOLD = SLOW_REQUEST_THRESHOLD, 0
+            try:
+                start('get_load_curve', 'session')
+                with span('http'):
+                    pass
+                with self.assertLogs(level='WARNING') as logs:
+                    finish()
+            finally:
+                SLOW_REQUEST_THRESHOLD = threshold
+            self.assertIn('Slow get_load_curve session', logs.output[0])
+            self.assertIn('http', logs.output[0])
+
+    class TestSamplingProfiler(unittest.TestCase):
+
+        def test_busy_function_is_sampled(self):
+            def busy():
+                started_at = time.monotonic()
+                while time.monotonic() - started_at < 0.2:
+                    pass
+
+            profiler = SamplingProfiler(interval=0.001)
+            profiler.start()
+            busy()
+            profiler.stop()
+            self.assertGreater(profiler.samples, 0)
+            self.assertTrue(any(function.startswith('busy ') for function, _, _ in profiler.top()))
+            with tempfile.TemporaryDirectory() as directory:
+                with open(profiler.dump(directory)) as f:
+                    self.assertIn(';busy (tracing.py:', f.readline())
+            with self.assertRaises(RuntimeError):
+                profiler.stop()
+
+    unittest.main()
@@ -0,0 +1,167 @@
+import datetime as dt
+import time
+from collections import OrderedDict
+
+from dataconnect import DataConnectError
+from metrics import Counter
+
+# Facts learnt from deterministic Data Connect errors, so that requests
+# bound to fail are answered locally instead of spending quota.
+#
+# - No consent: the consent of a token was revoked, kept by token so that
+#   a new consent is not affected
+# - Load curve not activated: kept by usage point and direction
+# - Activation date: Data Connect does not tell it, but rejects periods
+#   starting before it. The latest rejected start and the earliest
+#   accepted one bound it, requests starting before it are clamped to the
+#   accepted start if known, or fail.
+#
+# Facts expire after their TTL, the situation of a usage point can change.
+
+KNOWN_ERRORS = Counter('dataconnect_proxy_known_errors',
+                       "Requests failed or clamped from errors learnt for their usage point", ['endpoint', 'result'])
+
+class UsagePointFacts:
+
+    NO_CONSENT = 'ADAM-ERR0069'
+    LOAD_CURVE_NOT_ACTIVATED = 'ADAM-ERR0075'
+    BEFORE_ACTIVATION = 'ADAM-ERR0123'
+
+    NO_CONSENT_TTL = 3600 # s
+    NOT_ACTIVATED_TTL = 24 * 3600 # s
+    ACTIVATION_TTL = 7 * 24 * 3600 # s
+    MAX_SIZE = 100000
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        # key: (error, expires_at), key being ('consent', token_id),
+        # ('load_curve', usage_point_id, direction)
+        self.errors = OrderedDict()
+        # usage_point_id: [rejected start, accepted start, error, expires_at]
+        self.activations = OrderedDict()
+
+    def set(self, registry, key, value):
+        registry[key] = value
+        registry.move_to_end(key)
+        while len(registry) > self.max_size:
+            registry.popitem(last=False)
+
+    def get(self, registry, key):
+        value = registry.get(key)
+        if value is not None and value[-1] < time.time():
+            del registry[key]
+            return None
+        return value
+
+    def learn_error(self, token_id, usage_point_id, direction, endpoint, start, error):
+
+        now = time.time()
+        if error.code == self.NO_CONSENT:
+            self.set(self.errors, ('consent', token_id), (error, now + self.NO_CONSENT_TTL))
+        elif error.code == self.LOAD_CURVE_NOT_ACTIVATED and endpoint == 'load_curve':
+            self.set(self.errors, ('load_curve', usage_point_id, direction), (error, now + self.NOT_ACTIVATED_TTL))
+        elif error.code == self.BEFORE_ACTIVATION:
+            _, accepted, _, _ = self.get(self.activations, usage_point_id) or [None, None, None, None]
+            if accepted is not None and accepted <= start:
+                # Meter activated again since
+                accepted = None
+            self.set(self.activations, usage_point_id, [start, accepted, error, now + self.ACTIVATION_TTL])
+
+    def learn_success(self, usage_point_id, start):
+
+        activation = self.get(self.activations, usage_point_id)
+        if activation is None:
+            return
+        rejected, accepted, _, _ = activation
+        if rejected >= start:
+            # Meter activated again since
+            del self.activations[usage_point_id]
+        elif accepted is None or start < accepted:
+            activation[1] = start
+
+    def check(self, token_id, usage_point_id, direction, endpoint, start, end):
+        """ Period to request, clamped to the activation date, raises a learnt DataConnectError if bound to fail """
+
+        known = self.get(self.errors, ('consent', token_id))
+        if known is None and endpoint == 'load_curve':
+            known = self.get(self.errors, ('load_curve', usage_point_id, direction))
+        if known is not None:
+            KNOWN_ERRORS.inc(endpoint=endpoint, result='failed')
+            raise known[0]
+
+        activation = self.get(self.activations, usage_point_id)
+        if activation is not None:
+            rejected, accepted, error, _ = activation
+            if start <= rejected:
+                if accepted is None or accepted >= end:
+                    KNOWN_ERRORS.inc(endpoint=endpoint, result='failed')
+                    raise error
+                KNOWN_ERRORS.inc(endpoint=endpoint, result='clamped')
+                start = accepted
+
+        return start, end
+
+    def sweep(self):
+        now = time.time()
+        for registry in [self.errors, self.activations]:
+            for key in [key for key, value in registry.items() if value[-1] < now]:
+                del registry[key]
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestUsagePointFacts(unittest.TestCase):
+
+        USAGE_POINT_ID = '22516914714270'
+
+        def setUp(self):
+            self.facts = UsagePointFacts()
+
+        def check(self, start, end, endpoint='daily', token_id='0'):
+            return self.facts.check(token_id, self.USAGE_POINT_ID, 'consumption', endpoint, start, end)
+
+        def test_revoked_consent_fails_fast(self):
+            error = DataConnectError('No consent', code=UsagePointFacts.NO_CONSENT)
+            self.facts.learn_error('0', self.USAGE_POINT_ID, 'consumption', 'daily', dt.date(2020, 6, 1), error)
+            with self.assertRaises(DataConnectError) as cm:
+                self.check(dt.date(2020, 6, 1), dt.date(2020, 6, 2))
+            self.assertIs(cm.exception, error)
+            # New consent
+            self.check(dt.date(2020, 6, 1), dt.date(2020, 6, 2), token_id='1')
+
+        def test_load_curve_not_activated_fails_fast(self):
+            error = DataConnectError('Not activated', code=UsagePointFacts.LOAD_CURVE_NOT_ACTIVATED)
+            self.facts.learn_error('0', self.USAGE_POINT_ID, 'consumption', 'load_curve', dt.date(2020, 6, 1), error)
+            with self.assertRaises(DataConnectError):
+                self.check(dt.date(2020, 6, 1), dt.date(2020, 6, 2), endpoint='load_curve')
+            self.check(dt.date(2020, 6, 1), dt.date(2020, 6, 2), endpoint='daily')
+
+        def test_period_is_clamped_to_activation(self):
+            error = DataConnectError('Before activation', code=UsagePointFacts.BEFORE_ACTIVATION)
+            self.facts.learn_error('0', self.USAGE_POINT_ID, 'consumption', 'daily', dt.date(2020, 1, 1), error)
+            with self.assertRaises(DataConnectError):
+                self.check(dt.date(2019, 6, 1), dt.date(2020, 6, 1))
+            # Unknown between the rejected start and the accepted one
+            self.assertEqual(self.check(dt.date(2020, 1, 2), dt.date(2020, 6, 1)), (dt.date(2020, 1, 2), dt.date(2020, 6, 1)))
+            self.facts.learn_success(self.USAGE_POINT_ID, dt.date(2020, 3, 1))
+            self.assertEqual(self.check(dt.date(2019, 6, 1), dt.date(2020, 6, 1)), (dt.date(2020, 3, 1), dt.date(2020, 6, 1)))
+            with self.assertRaises(DataConnectError):
+                self.check(dt.date(2019, 6, 1), dt.date(2020, 3, 1))
+
+        def test_facts_expire(self):
+            error = DataConnectError('No consent', code=UsagePointFacts.NO_CONSENT)
+            self.facts.learn_error('0', self.USAGE_POINT_ID, 'consumption', 'daily', dt.date(2020, 6, 1), error)
+            self.facts.errors[('consent', '0')] = (error, time.time() - 1)
+            self.check(dt.date(2020, 6, 1), dt.date(2020, 6, 2))
+            self.facts.learn_error('0', self.USAGE_POINT_ID, 'consumption', 'daily', dt.date(2020, 6, 1), error)
+            self.facts.errors[('consent', '0')] = (error, time.time() - 1)
+            self.facts.sweep()
+            self.assertEqual(len(self.facts.errors), 0)
+
+        def test_other_errors_are_not_learnt(self):
+            error = DataConnectError('Bad gateway', status=502)
+            self.facts.learn_error('0', self.USAGE_POINT_ID, 'consumption', 'daily', dt.date(2020, 6, 1), error)
+            self.assertEqual(self.check(dt.date(2020, 6, 1), dt.date(2020, 6, 2)), (dt.date(2020, 6, 1), dt.date(2020, 6, 2)))
+
+    unittest.main()
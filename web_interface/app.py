@@ -5,23 +5,108 @@ import threading
 import logging
 import time
 import asyncio
+import csv
+import datetime as dt
+import functools
+import hashlib
+import hmac
+import io
+import json
+import mimetypes
+from collections import OrderedDict
 from urllib.parse import urlencode
 
 from aiohttp import web
 from jinja2 import Environment, PackageLoader, select_autoescape
+from markupsafe import escape
 
 from dataconnect import DataConnect, DataConnectError, TEST_CLIENTS
+import metrics
 
 MY_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Templates are compiled once at startup, without checking for changes
 jinga = Environment(
     loader=PackageLoader('web_interface', 'templates'),
-    autoescape=select_autoescape(['html', 'xml'])
+    autoescape=select_autoescape(['html', 'xml']),
+    auto_reload=False
 )
 
+class Assets:
+
+    # Files of the assets directory, kept in memory with their ETag and
+    # their precompressed variants (name.br, name.gz) if any. Pages link
+    # them with a version parameter, such URLs are cached forever.
+
+    MAX_AGE = 3600 # s
+    IMMUTABLE_MAX_AGE = 365 * 24 * 3600 # s
+    VARIANTS = [('br', '.br'), ('gzip', '.gz')]
+
+    def __init__(self, root):
+        self.files = {}
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if not os.path.isfile(path) or any(name.endswith(suffix) for _, suffix in self.VARIANTS):
+                continue
+            with open(path, 'rb') as f:
+                body = f.read()
+            variants = {}
+            for encoding, suffix in self.VARIANTS:
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, 'rb') as f:
+                        variants[encoding] = f.read()
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            self.files[name] = (hashlib.sha256(body).hexdigest()[:16], content_type, body, variants)
+
+    def url(self, name):
+        return f'./assets/{name}?v={self.files[name][0]}'
+
+    async def handle(self, request):
+        asset = self.files.get(request.match_info['name'])
+        if asset is None:
+            raise web.HTTPNotFound()
+        version, content_type, body, variants = asset
+
+        encoding = None
+        accepted = request.headers.get('Accept-Encoding', '')
+        for candidate, _ in self.VARIANTS:
+            if candidate in variants and candidate in accepted:
+                encoding = candidate
+                body = variants[candidate]
+                break
+
+        etag = f'"{version}-{encoding}"' if encoding else f'"{version}"'
+        if request.query.get('v') == version:
+            cache_control = f'public, max-age={self.IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            cache_control = f'public, max-age={self.MAX_AGE}'
+        headers = {'ETag': etag, 'Cache-Control': cache_control}
+        if variants:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return web.Response(status=304, headers=headers)
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=body, content_type=content_type, headers=headers)
+
+assets = Assets(os.path.join(MY_DIR, 'assets'))
+jinga.globals['asset_url'] = assets.url
+templates = {name: jinga.get_template(name) for name in jinga.list_templates()}
+
+# Authorize pages only differ by their authorize URI for a given
+# description, they are rendered once around a placeholder
+AUTHORIZE_URI_PLACEHOLDER = '__authorize_uri__'
+AUTHORIZE_PAGES_MAX_SIZE = 1024
+authorize_pages = OrderedDict()
+
 data_connect_proxy = None
 
-def handle_authorize_redirect(request):
+# Keys of the data API, {key: jid}, the JID usage points being readable
+api_keys = {}
+
+async def handle_authorize_redirect(request):
 
     state = request.query.get('state', None)
 
@@ -56,7 +141,7 @@ def handle_authorize_redirect(request):
         return redirect_error(message='Code parameter is missing', go_back=True)
 
     try:
-        ret = data_connect_proxy.authorize_request_callback(code, state)
+        ret = await data_connect_proxy.authorize_request_callback(code, state)
     except DataConnectError as e:
         logging.error(f'Redirect Error: {e}')
         raise web.HTTPInternalServerError(text=str(e))
@@ -78,28 +163,46 @@ def handle_authorize_redirect(request):
         # (maybe that was the cause of the bug in the enedis portal)
         raise web.HTTPFound(redirect_uri)
     else:
-        template = jinga.get_template('redirect_ok.html')
-        html = template.render(usage_points=ret["usage_points"])
+        html = templates['redirect_ok.html'].render(usage_points=ret["usage_points"])
         return web.Response(body=html, content_type='text/html')
 
+@functools.lru_cache(maxsize=256)
+def render_redirect_error(message, go_back):
+    return templates['redirect_error.html'].render(message=message, go_back=go_back).encode()
+
 def redirect_error(message, go_back=False):
-    template = jinga.get_template('redirect_error.html')
-    html = template.render(message=message, go_back=go_back)
-    return web.Response(body=html, content_type='text/html')
+    return web.Response(body=render_redirect_error(message, go_back), content_type='text/html')
+
+@functools.lru_cache(maxsize=1)
+def render_root():
+    return templates['layout.html'].render(the='variables', go='here').encode()
 
 def handle_root(request):
-    template = jinga.get_template('layout.html')
-    html = template.render(the='variables', go='here')
-    return web.Response(body=html, content_type='text/html')
+    return web.Response(body=render_root(), content_type='text/html')
+
+def render_authorize_page(uid, description, test_client_description):
+    """ (before, after) the authorize URI of the page of a description """
+
+    key = (uid, description.created_at, test_client_description)
+    page = authorize_pages.get(key)
+    if page is None:
+        html = templates['authorize.html'].render(description=description, authorize_uri=AUTHORIZE_URI_PLACEHOLDER,
+                                                  test_client_description=test_client_description)
+        before, _, after = html.partition(AUTHORIZE_URI_PLACEHOLDER)
+        page = authorize_pages[key] = (before.encode(), after.encode())
+        while len(authorize_pages) > AUTHORIZE_PAGES_MAX_SIZE:
+            authorize_pages.popitem(last=False)
+    else:
+        authorize_pages.move_to_end(key)
+    return page
 
 def handle_authorize_description(request):
-    template = jinga.get_template('authorize.html')
     if 'id' in request.query:
         uid = request.query['id']
     else:
         raise web.HTTPInternalServerError(text=f"'id' parameter is required")
 
-    description = data_connect_proxy.authorize_descriptions.get(uid)
+    description = data_connect_proxy.get_authorize_description(uid)
     if description is None:
         raise web.HTTPNotFound(text=f"id {uid} not found")
 
@@ -120,23 +223,173 @@ def handle_authorize_description(request):
 
     authorize_uri = data_connect_proxy.register_authorize_request(redirect_uri, duration, description['jid'], user_state, test_client_id)
 
-    html = template.render(description=description, authorize_uri=authorize_uri, test_client_description=test_client_description)
-    return web.Response(body=html, content_type='text/html')
+    before, after = render_authorize_page(uid, description, test_client_description)
+    # Each visit registers its own authorize request
+    return web.Response(body=before + str(escape(authorize_uri)).encode() + after, content_type='text/html',
+                        headers={'Cache-Control': 'no-store'})
+
+# Scraped by Prometheus, should not be exposed by the reverse proxy
+def handle_metrics(request):
+    return web.Response(body=metrics.REGISTRY.expose().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+# Data API, for batch jobs that only need the data
+#
+#     GET /api/load_curve?usage_point_id=…&usage_point_id=…&direction=consumption
+#                        &start_date=2020-06-01&end_date=2020-06-08&format=ndjson
+#     Authorization: Bearer <key>
+#
+# Usage points are fetched a few at a time and their readings written as
+# they come, in chunks of NDJSON or CSV rows. Responses are gzipped when the
+# client accepts it. Access is checked for every usage point before
+# streaming, an error is then reported in place of its readings, the
+# response being already started.
+
+API_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+API_MAX_USAGE_POINTS = 1000
+API_PREFETCH = 4
+API_CHUNK_ROWS = 1000
+
+def api_jid(request):
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and key:
+        for api_key, jid in api_keys.items():
+            if hmac.compare_digest(api_key.encode(), key.encode()):
+                return jid
+    raise web.HTTPUnauthorized(text="A valid API key is required", headers={'WWW-Authenticate': 'Bearer'})
+
+def format_rows(fmt, rows, with_interval_length):
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(row, separators=(',', ':')) + '\n' for row in rows)
+    columns = ['usage_point_id', 'direction', 'date', 'value'] + (['interval_length'] if with_interval_length else []) + ['error']
+    out = io.StringIO()
+    writer = csv.DictWriter(out, columns, extrasaction='ignore', lineterminator='\n')
+    if rows is None:
+        writer.writeheader()
+    else:
+        writer.writerows(rows)
+    return out.getvalue()
+
+def reading_rows(data, usage_point_id, direction, with_interval_length):
+    """ Rows of the readings of a usage point, by chunks of API_CHUNK_ROWS """
+    readings = data['meter_reading'].get('interval_reading', [])
+    for start in range(0, len(readings), API_CHUNK_ROWS):
+        rows = []
+        for reading in readings[start:start + API_CHUNK_ROWS]:
+            row = {'usage_point_id': usage_point_id, 'direction': direction,
+                   'date': reading['date'], 'value': reading['value']}
+            if with_interval_length:
+                row['interval_length'] = reading.get('interval_length')
+            rows.append(row)
+        yield rows
+
+async def handle_api_data(request):
+
+    jid = api_jid(request)
+    endpoint = request.match_info['endpoint']
+
+    usage_point_ids = [usage_point_id
+                       for value in request.query.getall('usage_point_id', [])
+                       for usage_point_id in value.split(',') if usage_point_id]
+    directions = request.query.getall('direction', ['consumption'])
+    fmt = request.query.get('format', 'ndjson')
+    start_date = request.query.get('start_date')
+    end_date = request.query.get('end_date')
+
+    if not usage_point_ids or not start_date or not end_date:
+        raise web.HTTPBadRequest(text="usage_point_id, start_date and end_date are required")
+    if len(usage_point_ids) > API_MAX_USAGE_POINTS:
+        raise web.HTTPBadRequest(text=f"At most {API_MAX_USAGE_POINTS} usage points can be requested at once")
+    if fmt not in API_FORMATS:
+        raise web.HTTPBadRequest(text=f"format should be one of {', '.join(API_FORMATS)}")
+    if not set(directions) <= {'consumption', 'production'}:
+        raise web.HTTPBadRequest(text="direction should be consumption or production")
+    try:
+        if dt.date.fromisoformat(start_date) >= dt.date.fromisoformat(end_date):
+            raise web.HTTPBadRequest(text="start_date should be before end_date")
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=f"Invalid date: {e}")
+
+    for usage_point_id in usage_point_ids:
+        try:
+            data_connect_proxy.get_token_id(jid, usage_point_id)
+        except DataConnectError as e:
+            raise web.HTTPForbidden(text=str(e))
+
+    get_data = data_connect_proxy.get_load_curve if endpoint == 'load_curve' else data_connect_proxy.get_daily
+    requests = [(usage_point_id, direction) for usage_point_id in usage_point_ids for direction in directions]
+
+    async def fetch(usage_point_id, direction):
+        try:
+            return await get_data(direction, jid, usage_point_id, start_date, end_date)
+        except DataConnectError as e:
+            return e
+        except Exception as e:
+            logging.exception(f"Unable to get {endpoint} of {usage_point_id} for {jid}")
+            return e
+
+    pending = [asyncio.ensure_future(fetch(*request)) for request in requests[:API_PREFETCH]]
+
+    response = web.StreamResponse(headers={'Content-Type': f'{API_FORMATS[fmt]}; charset=utf-8'})
+    response.enable_chunked_encoding()
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.enable_compression(web.ContentCoding.gzip)
+    await response.prepare(request)
+
+    with_interval_length = endpoint == 'load_curve'
+    if fmt == 'csv':
+        await response.write(format_rows(fmt, None, with_interval_length).encode())
+
+    try:
+        for i, (usage_point_id, direction) in enumerate(requests):
+            data = await pending[i]
+            pending[i] = None
+            if i + API_PREFETCH < len(requests):
+                pending.append(asyncio.ensure_future(fetch(*requests[i + API_PREFETCH])))
+
+            error = data if isinstance(data, Exception) else None
+            chunks = reading_rows(data, usage_point_id, direction, with_interval_length) if error is None else iter([])
+            while error is None:
+                try:
+                    rows = next(chunks, None)
+                except Exception as e:
+                    logging.exception(f"Unable to format {endpoint} of {usage_point_id}")
+                    error = e
+                    break
+                if rows is None:
+                    break
+                await response.write(format_rows(fmt, rows, with_interval_length).encode())
+
+            if error is not None:
+                message = str(error) if isinstance(error, DataConnectError) else "Internal error"
+                rows = [{'usage_point_id': usage_point_id, 'direction': direction, 'error': message}]
+                await response.write(format_rows(fmt, rows, with_interval_length).encode())
+    finally:
+        for task in pending:
+            if task is not None:
+                task.cancel()
+
+    await response.write_eof()
+    return response
 
 app = web.Application()
 app.add_routes([web.get('/redirect', handle_authorize_redirect)])
 app.add_routes([web.get('/authorize', handle_authorize_description)])
 app.add_routes([web.get('/', handle_root)])
+app.add_routes([web.get('/metrics', handle_metrics)])
+app.add_routes([web.get('/api/{endpoint:load_curve|daily}', handle_api_data)])
 
-# TODO use a reverse proxy
-app.add_routes([web.static('/assets', os.path.join(MY_DIR, "assets"))])
+app.add_routes([web.get('/assets/{name}', assets.handle)])
 
-async def start(run=False):
+async def start(run=False, port=3000, reuse_port=False):
 
     runner = web.AppRunner(app)
 
     await runner.setup()
-    site = web.TCPSite(runner, 'localhost', port=3000)
+    # With reuse_port, several processes listen on the same port
+    site = web.TCPSite(runner, 'localhost', port=port, reuse_port=reuse_port)
     await site.start()
 
     while run:
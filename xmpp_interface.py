@@ -3,15 +3,27 @@
 import logging
 import asyncio
 import datetime as dt
-import pytz
+import functools
+import inspect
+import time
 
-from slixmpp import ClientXMPP
+from slixmpp import ClientXMPP, Iq
 from slixmpp.exceptions import XMPPError
-from slixmpp.xmlstream import ElementBase, ET, register_stanza_plugin
+from slixmpp.xmlstream import ET, register_stanza_plugin
+from slixmpp.plugins.xep_0050 import Command
+from slixmpp.plugins.xep_0059 import Set
 
 from dataconnect import DataConnect, DataConnectError
+from quoalise import Quoalise, append_data, append_error, ENCODINGS
+from metrics import Gauge, Histogram
+from jobs import Jobs
+import tracing
+import resampling
 import json
 
+COMMAND_DURATION = Histogram('xmpp_command_duration_seconds', "Ad-hoc command submissions (XEP-0050)", ['node', 'status'])
+COMMANDS_IN_FLIGHT = Gauge('xmpp_commands_in_flight', "Ad-hoc command submissions being processed", ['node'])
+
 def fail_with(message, code):
 
     args = {'issuer': 'enedis-data-connect'} # TODO directly use a xml ns?
@@ -24,20 +36,115 @@ def fail_with(message, code):
                     text=message,
                     etype="cancel")
 
+def timed_command(handle_submit):
+    """ Record durations of a command handler submissions, by node, and trace them """
+
+    @functools.wraps(handle_submit)
+    async def wrapper(self, payload, session):
+        COMMANDS_IN_FLIGHT.inc(node=self.node)
+        started_at = time.monotonic()
+        status = 'error'
+        # Finished once the response is sent, see XmppInterface.send
+        tracing.start(self.node, session.get('id'))
+        try:
+            session = handle_submit(self, payload, session)
+            if inspect.isawaitable(session):
+                session = await session
+            status = 'completed'
+            return session
+        finally:
+            COMMANDS_IN_FLIGHT.dec(node=self.node)
+            COMMAND_DURATION.observe(time.monotonic() - started_at, node=self.node, status=status)
+            if status == 'error' or 'id' not in session:
+                tracing.finish()
+
+    return wrapper
+
+def add_encoding_field(form):
+    form.addField(var='encoding',
+                  ftype='list-single',
+                  label='Encoding',
+                  desc='SenML XML, or SenML-CBOR in base64',
+                  options=[{'label': 'XML', 'value': 'xml'},
+                           {'label': 'CBOR', 'value': 'cbor'}],
+                  required=False,
+                  value='xml')
+
+def get_encoding(form):
+    encoding = form['values'].get('encoding') or 'xml'
+    if encoding not in ENCODINGS:
+        raise XMPPError('bad-request', text=f'encoding should be one of {", ".join(ENCODINGS)}')
+    return encoding
+
+# Data is embedded in the command response, or pushed as messages by a job
+DELIVERIES = ['iq', 'message']
+
+def add_delivery_field(form):
+    form.addField(var='delivery',
+                  ftype='list-single',
+                  label='Delivery',
+                  desc='In the response, or as messages sent by a background job',
+                  options=[{'label': 'Response', 'value': 'iq'},
+                           {'label': 'Messages', 'value': 'message'}],
+                  required=False,
+                  value='iq')
+
+def get_delivery(form):
+    delivery = form['values'].get('delivery') or 'iq'
+    if delivery not in DELIVERIES:
+        raise XMPPError('bad-request', text=f'delivery should be one of {", ".join(DELIVERIES)}')
+    return delivery
+
+def split_payload(payload):
+    """ Form and optional XEP-0059 <set/> from a command payload """
+
+    if not isinstance(payload, list):
+        payload = [payload]
+
+    form = None
+    rsm = None
+    for item in payload:
+        if isinstance(item, Set):
+            rsm = item
+        elif item.plugin_attrib == 'form':
+            form = item
+
+    return form, rsm
+
 class XmppInterface(ClientXMPP):
 
-    def __init__(self, jid, password, make_authorize_uri, get_load_curve, get_daily):
+    # Readings by job message
+    JOB_MESSAGE_MAX_READINGS = 5000
+
+    def __init__(self, jid, password, make_authorize_uri, get_load_curve, get_daily, get_subscribers=None, admins=()):
         ClientXMPP.__init__(self, jid, password)
 
+        # Bare JIDs allowed to run administration commands
+        self.admins = set(admins)
+
         self.add_event_handler("session_start", self.session_start)
 
         self.register_plugin('xep_0004')
         self.register_plugin('xep_0050')
+        self.register_plugin('xep_0059')
         self.register_plugin('xep_0199', {'keepalive': True, 'frequency':15})
 
         self.authorize_uri_handler = AuthorizeUriCommandHandler(self, make_authorize_uri)
         self.load_curve_handler = LoadCurveCommandHandler(self, get_load_curve)
         self.daily_handler = DailyCommandHandler(self, get_daily)
+        self.load_curve_batch_handler = BatchCommandHandler(self, 'get_load_curve_batch', 'Get load curve data',
+                                                            get_load_curve, LoadCurveCommandHandler.make_pages)
+        self.daily_batch_handler = BatchCommandHandler(self, 'get_daily_batch', 'Get daily data',
+                                                       get_daily, DailyCommandHandler.make_pages)
+        self.subscribers_handler = SubscribersCommandHandler(self, get_subscribers) if get_subscribers else None
+
+        self.jobs = Jobs(on_finished=self.notify_job_finished)
+        self.job_status_handler = JobStatusCommandHandler(self)
+        self.profiler_handler = ProfilerCommandHandler(self)
+
+        # Data commands can be paged
+        register_stanza_plugin(Command, Set, iterable=True)
+        self.add_event_handler('command_complete', self.command_complete)
 
     def session_start(self, event):
         self.send_presence()
@@ -54,18 +161,62 @@ class XmppInterface(ClientXMPP):
 
         # TODO only list commands available to a particular user
         # TODO respond 403 when not authorized
-        self['xep_0050'].add_command(node='get_authorize_uri',
+        self['xep_0050'].add_command(node=self.authorize_uri_handler.node,
                                      name='Request authorize URI',
                                      handler=self.authorize_uri_handler.handle_request)
 
-        self['xep_0050'].add_command(node='get_load_curve',
+        self['xep_0050'].add_command(node=self.load_curve_handler.node,
                                      name='Get load curve',
                                      handler=self.load_curve_handler.handle_request)
 
-        self['xep_0050'].add_command(node='get_daily',
+        self['xep_0050'].add_command(node=self.daily_handler.node,
                                      name='Get daily data',
                                      handler=self.daily_handler.handle_request)
 
+        self['xep_0050'].add_command(node=self.load_curve_batch_handler.node,
+                                     name='Get load curve of several usage points',
+                                     handler=self.load_curve_batch_handler.handle_request)
+
+        self['xep_0050'].add_command(node=self.daily_batch_handler.node,
+                                     name='Get daily data of several usage points',
+                                     handler=self.daily_batch_handler.handle_request)
+
+        if self.subscribers_handler is not None:
+            self['xep_0050'].add_command(node=self.subscribers_handler.node,
+                                         name='Get subscribers of a usage point (admin)',
+                                         handler=self.subscribers_handler.handle_request)
+
+        self['xep_0050'].add_command(node=self.job_status_handler.node,
+                                     name='Get status of a data job',
+                                     handler=self.job_status_handler.handle_request)
+
+        self['xep_0050'].add_command(node=self.profiler_handler.node,
+                                     name='Start or stop the profiler (admin)',
+                                     handler=self.profiler_handler.handle_request)
+
+    def send(self, data, use_filters=True):
+
+        if tracing.current() is None:
+            return ClientXMPP.send(self, data, use_filters)
+
+        with tracing.span('xml_send'):
+            ClientXMPP.send(self, data, use_filters)
+
+        # Response of a traced command
+        if isinstance(data, Iq) and data['type'] in ('result', 'error'):
+            tracing.finish()
+
+    def command_complete(self, iq):
+        # Run before the XEP-0050 plugin handles the action, which ends the
+        # session with the next response whatever the handler returns
+        session = self['xep_0050'].sessions.get(iq['command']['sessionid'])
+        if session is not None:
+            session['complete'] = True
+
+    def check_admin(self, session):
+        if session['from'].bare not in self.admins:
+            raise XMPPError('forbidden', text='This command is restricted to administrators')
+
     def notify_authorize_complete(self, dest, usage_points, state):
 
         msg = self.make_message(mto=dest, mtype="chat")
@@ -88,6 +239,62 @@ class XmppInterface(ClientXMPP):
         msg.append(x)
         msg.send()
 
+    def make_job_form(self, job):
+
+        form = self['xep_0004'].make_form(ftype='result', title=f'Job {job.id}')
+
+        form.addField(var='job_id',
+                      ftype='text-single',
+                      label='Job id',
+                      value=job.id)
+
+        form.addField(var='status',
+                      ftype='fixed',
+                      label='Status',
+                      value=job.status)
+
+        form.addField(var='progress',
+                      ftype='fixed',
+                      label=f'Requests done, {job.failures} failed',
+                      value=job.progress())
+
+        if job.error is not None:
+            form.addField(var='error',
+                          ftype='fixed',
+                          label='Error',
+                          value=job.error)
+
+        return form
+
+    def send_job_message(self, job, body, payload=()):
+        # Messages of a job share its id as thread
+        msg = self.make_message(mto=job.jid, mtype='normal', msubject=f'Job {job.id}', mbody=body)
+        msg['thread'] = job.id
+        for item in payload:
+            msg.append(item)
+        job.messages += 1
+        msg.send()
+
+    def send_job_pages(self, job, pages):
+        """ Send readings of pages, split in messages with a <set/> giving their indexes """
+
+        pages.max = self.JOB_MESSAGE_MAX_READINGS
+        has_next = True
+        while has_next:
+            quoalise, result, has_next = pages.page()
+            self.send_job_message(job, f'Data for {pages.usage_point_id}', [quoalise, result])
+
+    def send_job_error(self, job, usage_point_id, direction, error):
+        quoalise = Quoalise()
+        append_error(quoalise, usage_point_id, [('business', {'direction': direction})], error.message, error.code)
+        self.send_job_message(job, f'No data for {usage_point_id}: {error}', [quoalise])
+
+    def notify_job_finished(self, job):
+        body = f'Job {job.status}, {job.total} requests, {job.failures} failed'
+        if job.error is not None:
+            body += f': {job.error}'
+        self.send_job_message(job, body)
+
     def message(self, msg):
         if not msg['type'] in ('chat', 'normal'):
             print(msg)
@@ -108,6 +315,8 @@ class XmppInterface(ClientXMPP):
 
 class AuthorizeUriCommandHandler:
 
+    node = 'get_authorize_uri'
+
     def __init__(self, xmpp_client, make_authorize_uri):
 
         self.xmpp = xmpp_client
@@ -155,6 +364,7 @@ class AuthorizeUriCommandHandler:
 
         return session
 
+    @timed_command
     def handle_submit(self, payload, session):
 
         name = payload['values'].get('name', session['from'].bare)
@@ -177,18 +387,409 @@ class AuthorizeUriCommandHandler:
 
         return session
 
-class LoadCurveCommandHandler:
+class SubscribersCommandHandler:
 
-    def __init__(self, xmpp_client, get_load_curve):
+    node = 'get_subscribers'
+
+    def __init__(self, xmpp_client, get_subscribers):
 
         self.xmpp = xmpp_client
-        self.get_load_curve = get_load_curve
+        self.get_subscribers = get_subscribers
 
     def handle_request(self, iq, session):
 
+        self.xmpp.check_admin(session)
+
         if iq['command'].xml: # has subelements
             return self.handle_submit(session['payload'], session)
 
+        form = self.xmpp['xep_0004'].make_form(ftype='form', title='Get subscribers of a usage point')
+
+        form.addField(var='usage_point_id',
+                      ftype='text-single',
+                      label='Usage point id',
+                      required=True)
+
+        session['payload'] = form
+        session['next'] = self.handle_submit
+
+        return session
+
+    @timed_command
+    def handle_submit(self, payload, session):
+
+        self.xmpp.check_admin(session)
+
+        usage_point_id = payload['values'].get('usage_point_id', '')
+        subscribers = self.get_subscribers(usage_point_id)
+
+        form = self.xmpp['xep_0004'].make_form(ftype='result', title=f"Subscribers of {usage_point_id}")
+
+        form.addField(var='subscribers',
+                      ftype='text-multi',
+                      label=f'{len(subscribers)} JIDs, with their token id',
+                      value='\n'.join(f'{jid} {token_id}' for jid, token_id in sorted(subscribers.items())))
+
+        session['payload'] = form
+        session['next'] = None
+
+        return session
+
+class JobStatusCommandHandler:
+
+    node = 'get_job_status'
+
+    def __init__(self, xmpp_client):
+
+        self.xmpp = xmpp_client
+
+    def handle_request(self, iq, session):
+
+        if iq['command'].xml: # has subelements
+            return self.handle_submit(session['payload'], session)
+
+        form = self.xmpp['xep_0004'].make_form(ftype='form', title='Get status of a data job')
+
+        form.addField(var='job_id',
+                      ftype='text-single',
+                      label='Job id',
+                      required=True)
+
+        session['payload'] = form
+        session['next'] = self.handle_submit
+
+        return session
+
+    @timed_command
+    def handle_submit(self, payload, session):
+
+        job_id = payload['values'].get('job_id', '')
+        # Jobs of other users are not disclosed
+        job = self.xmpp.jobs.get(session['from'], job_id)
+        if job is None:
+            raise XMPPError('item-not-found', text=f'Unknown job {job_id}')
+
+        session['payload'] = self.xmpp.make_job_form(job)
+        session['next'] = None
+
+        return session
+
+class ProfilerCommandHandler:
+
+    # Samples the event loop until stopped, the samples are then written to
+    # tracing.PROFILES_PATH and the busiest functions returned
+
+    node = 'profiler'
+
+    def __init__(self, xmpp_client):
+
+        self.xmpp = xmpp_client
+
+    def handle_request(self, iq, session):
+
+        self.xmpp.check_admin(session)
+
+        if iq['command'].xml: # has subelements
+            return self.handle_submit(session['payload'], session)
+
+        form = self.xmpp['xep_0004'].make_form(ftype='form', title='Start or stop the profiler')
+
+        form.addField(var='action',
+                      ftype='list-single',
+                      label='Action',
+                      options=[{'label': 'Start', 'value': 'start'},
+                               {'label': 'Stop', 'value': 'stop'}],
+                      required=True,
+                      value='stop' if tracing.profiler.running else 'start')
+
+        session['payload'] = form
+        session['next'] = self.handle_submit
+
+        return session
+
+    @timed_command
+    def handle_submit(self, payload, session):
+
+        self.xmpp.check_admin(session)
+
+        action = payload['values'].get('action')
+        if action not in ['start', 'stop']:
+            raise XMPPError('bad-request', text='action should be start or stop')
+
+        form = self.xmpp['xep_0004'].make_form(ftype='result', title='Profiler')
+
+        try:
+            if action == 'start':
+                tracing.profiler.start()
+                logging.warning(f"Profiler started by {session['from'].bare}")
+            else:
+                path = tracing.stop_profiler()
+        except RuntimeError as e:
+            raise XMPPError('bad-request', text=str(e))
+
+        form.addField(var='status',
+                      ftype='fixed',
+                      label='Status',
+                      value='running' if tracing.profiler.running else 'stopped')
+
+        if action == 'stop':
+            form.addField(var='path',
+                          ftype='text-single',
+                          label=f'{tracing.profiler.samples} samples, collapsed stacks',
+                          value=path)
+
+            form.addField(var='top',
+                          ftype='text-multi',
+                          label='Own samples, total samples, function',
+                          value='\n'.join(f'{own} {total} {function}' for function, own, total in tracing.profiler.top()))
+
+        session['payload'] = form
+        session['next'] = None
+
+        return session
+
+class Pages:
+
+    # Items of a data command response, kept in the ad-hoc command session
+    # so that they can be sent page by page (XEP-0059). RSM item ids are
+    # item indexes. Subclasses append the items of a range to a <quoalise/>.
+
+    def __init__(self):
+        # Everything in a single page unless set
+        self.max = None
+        self.next_index = 0
+
+    def page(self, rsm=None):
+        """ Next page as a <quoalise/> and a <set/> result, and whether there are more pages """
+
+        index = self.next_index
+        count = len(self)
+
+        if rsm is not None:
+            try:
+                if rsm['max']:
+                    self.max = max(1, int(rsm['max']))
+                if rsm['after']:
+                    index = int(rsm['after']) + 1
+                elif rsm['index']:
+                    index = int(rsm['index'])
+            except ValueError:
+                raise XMPPError('bad-request', text='Invalid result set parameters')
+
+        index = max(0, index)
+        end = min(index + (count if self.max is None else self.max), count)
+
+        quoalise = Quoalise()
+        with tracing.span('xml_build'):
+            self.append_range(quoalise, index, end)
+
+        result = Set()
+        if index < end:
+            result['first'] = str(index)
+            result['first_index'] = str(index)
+            result['last'] = str(end - 1)
+        result['count'] = str(count)
+
+        self.next_index = end
+
+        return quoalise, result, end < count
+
+class DataPages(Pages):
+
+    # Readings of a usage point, items are readings
+
+    def __init__(self, usage_point_id, measurement, bn, bu, bt, times, values):
+        Pages.__init__(self)
+        self.usage_point_id = usage_point_id
+        self.measurement = measurement
+        self.bn = bn
+        self.bu = bu
+        self.bt = bt
+        self.times = times
+        self.values = values
+        self.encoding = 'xml'
+
+    def __len__(self):
+        return len(self.times)
+
+    def append_range(self, quoalise, index, end):
+        return append_data(quoalise, self.usage_point_id, self.measurement, self.bn, self.bu,
+                           self.bt, self.times[index:end], self.values[index:end], self.encoding)
+
+class BatchPages(Pages):
+
+    # Readings and errors of several usage points, in request order. Items
+    # are the readings of each one, or its error. A usage point without
+    # readings still counts as an item, so that its empty <data/> is sent.
+
+    def __init__(self):
+        Pages.__init__(self)
+        # (first item index, DataPages or (usage_point_id, direction, DataConnectError))
+        self.parts = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add_pages(self, pages):
+        self.parts.append((self.count, pages))
+        self.count += max(1, len(pages))
+
+    def add_error(self, usage_point_id, direction, error):
+        self.parts.append((self.count, (usage_point_id, direction, error)))
+        self.count += 1
+
+    def append_range(self, quoalise, index, end):
+        for first, part in self.parts:
+            if first >= end:
+                break
+            if isinstance(part, DataPages):
+                if first + max(1, len(part)) <= index:
+                    continue
+                part.append_range(quoalise, max(0, index - first), end - first)
+            elif first >= index:
+                usage_point_id, direction, error = part
+                append_error(quoalise, usage_point_id, [('business', {'direction': direction})], error.message, error.code)
+
+class DataCommandHandler:
+
+    def respond_with_form(self, session, form):
+
+        # The response to the form may be paged, next is advertised so that
+        # clients do not complete the session after the first page
+        session['payload'] = form
+        session['next'] = self.handle_submit
+        session['has_next'] = True
+        session['interfaces'].add('rsm')
+
+        return session
+
+    def respond_with_data(self, session, form, pages, rsm):
+
+        if rsm is None or not rsm['max'] or session.get('complete'):
+            # Everything in a single response
+            quoalise, _, _ = pages.page()
+            session['payload'] = [form, quoalise]
+            session['next'] = None
+            return session
+
+        session['pages'] = pages
+        return self.respond_with_page(session, [form], rsm)
+
+    def respond_with_job(self, session, requests, get_pages):
+        """ Respond with a job sending the pages of each (usage_point_id, direction) request as messages """
+
+        jid = session['from']
+        if self.xmpp.jobs.running(jid) >= Jobs.MAX_RUNNING_PER_JID:
+            raise XMPPError('resource-constraint', text=f'At most {Jobs.MAX_RUNNING_PER_JID} jobs can run at once')
+
+        async def run_request(job, usage_point_id, direction):
+            try:
+                pages = await get_pages(usage_point_id, direction)
+            except DataConnectError as e:
+                job.failures += 1
+                self.xmpp.send_job_error(job, usage_point_id, direction, e)
+            else:
+                self.xmpp.send_job_pages(job, pages)
+            job.done += 1
+
+        async def run(job):
+            await asyncio.gather(*[run_request(job, usage_point_id, direction) for usage_point_id, direction in requests])
+
+        job = self.xmpp.jobs.start(jid, self.node, len(requests), run)
+
+        session['payload'] = self.xmpp.make_job_form(job)
+        session['next'] = None
+
+        return session
+
+    def handle_next_page(self, payload, session):
+        _, rsm = split_payload(payload)
+        return self.respond_with_page(session, [], rsm)
+
+    def respond_with_page(self, session, payload, rsm):
+
+        pages = session['pages']
+        if session.get('complete'):
+            # Last response of the session, with all the remaining readings
+            pages.max = None
+            rsm = None
+
+        quoalise, result, has_next = pages.page(rsm)
+        session['payload'] = payload + [quoalise, result]
+
+        if has_next:
+            session['has_next'] = True
+            session['next'] = self.handle_next_page
+        else:
+            session['has_next'] = False
+            session['next'] = None
+            del session['pages']
+
+        return session
+
+class LoadCurveCommandHandler(DataCommandHandler):
+
+    node = 'get_load_curve'
+
+    def __init__(self, xmpp_client, get_load_curve):
+
+        self.xmpp = xmpp_client
+        self.get_load_curve = get_load_curve
+
+    @staticmethod
+    def make_pages(usage_point_id, direction, start_date, data, end_date=None, resample=None, aggregate='mean'):
+
+        meter_reading = data["meter_reading"]
+        readings = meter_reading["interval_reading"]
+
+        bt = DataConnect.timestamps([start_date])[0]
+        # Readings are dated at the end of their interval, they are sent
+        # with the start of it, as resampled periods
+        try:
+            durations = [resampling.interval_seconds(reading['interval_length']) for reading in readings]
+        except (KeyError, ValueError) as e:
+            raise DataConnectError(f'Invalid interval length: {e}')
+        ends = DataConnect.timestamps([reading['date'] for reading in readings])
+        starts = [end - duration for end, duration in zip(ends, durations)]
+        values = [reading['value'] for reading in readings]
+
+        if resample is None:
+            measurement = [('physical', {'quantity': "power", 'type': "electrical", 'unit': "W"}),
+                           ('business', {'graph': "load-profile", 'direction': direction}),
+                           ('aggregate', {'type': "average"})]
+            if readings:
+                measurement.append(('sampling', {'interval': readings[0]['interval_length']}))
+
+            return DataPages(usage_point_id, measurement,
+                             f"urn:dev:prm:{usage_point_id}_{direction}_load", 'W',
+                             bt, starts, values)
+
+        boundaries = resampling.period_boundaries(resample,
+                                                  dt.date.fromisoformat(DataConnect.date_to_isostring(start_date)),
+                                                  dt.date.fromisoformat(DataConnect.date_to_isostring(end_date)))
+        times, values = resampling.resample(starts, [float(value) for value in values], durations, boundaries, aggregate)
+        values = [resampling.format_value(value) for value in values]
+
+        if aggregate == 'sum':
+            physical, unit = {'quantity': "energy", 'type': "electrical", 'unit': "Wh"}, 'Wh'
+        else:
+            physical, unit = {'quantity': "power", 'type': "electrical", 'unit': "W"}, 'W'
+
+        measurement = [('physical', physical),
+                       ('business', {'graph': "load-profile", 'direction': direction}),
+                       ('aggregate', {'type': resampling.AGGREGATES[aggregate]}),
+                       ('sampling', {'interval': resample})]
+
+        return DataPages(usage_point_id, measurement,
+                         f"urn:dev:prm:{usage_point_id}_{direction}_load", unit,
+                         bt, times, values)
+
+    async def handle_request(self, iq, session):
+
+        if iq['command'].xml: # has subelements
+            return await self.handle_submit(session['payload'], session)
+
         form = self.xmpp['xep_0004'].make_form(ftype='form', title=f'Get load curve data')
 
         form.addField(var='usage_point_id',
@@ -222,12 +823,36 @@ class LoadCurveCommandHandler:
                       required=True,
                       value=end_date)
 
-        session['payload'] = form
-        session['next'] = self.handle_submit
+        form.addField(var='resample',
+                      ftype='list-single',
+                      label='Resample',
+                      options=[{'label': 'No resampling', 'value': 'none'},
+                               {'label': 'Hourly', 'value': 'PT1H'},
+                               {'label': 'Daily', 'value': 'P1D'},
+                               {'label': 'Monthly', 'value': 'P1M'}],
+                      required=False,
+                      value='none')
 
-        return session
+        form.addField(var='aggregate',
+                      ftype='list-single',
+                      label='Aggregate',
+                      desc='sum gives an energy in Wh',
+                      options=[{'label': 'Mean', 'value': 'mean'},
+                               {'label': 'Sum', 'value': 'sum'},
+                               {'label': 'Max', 'value': 'max'},
+                               {'label': 'Min', 'value': 'min'}],
+                      required=False,
+                      value='mean')
 
-    def handle_submit(self, payload, session):
+        add_encoding_field(form)
+        add_delivery_field(form)
+
+        return self.respond_with_form(session, form)
+
+    @timed_command
+    async def handle_submit(self, payload, session):
+
+        payload, rsm = split_payload(payload)
 
         usage_point_id = payload['values']['usage_point_id']
         start_date = payload['values']['start_date']
@@ -238,12 +863,36 @@ class LoadCurveCommandHandler:
         else:
             direction = 'consumption'
 
+        resample = payload['values'].get('resample') or 'none'
+        if resample == 'none':
+            resample = None
+        elif resample not in resampling.PERIODS:
+            raise XMPPError('bad-request', text=f'resample should be one of {", ".join(resampling.PERIODS)}')
+
+        aggregate = payload['values'].get('aggregate') or 'mean'
+        if aggregate not in resampling.AGGREGATES:
+            raise XMPPError('bad-request', text=f'aggregate should be one of {", ".join(resampling.AGGREGATES)}')
+
+        encoding = get_encoding(payload)
+        delivery = get_delivery(payload)
+
+        async def get_pages(usage_point_id, direction):
+            data = await self.get_load_curve(direction, session['from'].bare, usage_point_id, start_date, end_date)
+            try:
+                pages = self.make_pages(usage_point_id, direction, start_date, data, end_date, resample, aggregate)
+            except ValueError as e:
+                raise DataConnectError(f'Unable to resample: {e}')
+            pages.encoding = encoding
+            return pages
+
+        if delivery == 'message':
+            return self.respond_with_job(session, [(usage_point_id, direction)], get_pages)
+
         try:
-            data = self.get_load_curve(direction, session['from'].bare, usage_point_id, start_date, end_date)
+            pages = await get_pages(usage_point_id, direction)
         except DataConnectError as e:
             # TODO does session needs cleanup?
             return fail_with(e.message, e.code)
-        # print(data)
 
         form = self.xmpp['xep_0004'].make_form(ftype='result', title=f"Get {direction} load curve data")
 
@@ -257,101 +906,40 @@ class LoadCurveCommandHandler:
                       label=f'{direction} load curve for {usage_point_id}',
                       value=f"Success")
 
-        session['next'] = None
-
-        # <quoalise xmlns="urn:quoalise:0">
-        #   <!-- On peut éventuellement mettre plusieurs élements data -->
-        #   <data>
-        #     <meta>
-        #       <!-- Les meta données utilisables pour tout type de données, à determiner -->
-        #       <device type="electricity-meter">
-        #         <identifier authority="enedis" type="prm" value="22516914714270"/>
-        #       </device>
-        #       <app id="https://datahub-enedis.fr/data-connect/">
-        #         <!-- Les meta données propres à cette application ajoutées sous forme d’extension -->
-        #         <data-connect xmlns="urn:consometers:dataconnect:0">
-        #           <start>2020-06-01</start>
-        #           <end>2020-06-02</end>
-        #         </data-connect>
-        #       </app>
-        #       <measurement>
-        #         <physical quantity="power" type="electrical" unit="W">
-        #         <business graph="load-profile" direction="consumption"/>
-        #         <aggregate type="average" />
-        #         <sampling interval="1800" />
-        #       </measurement>
-        #     </meta>
-        #     <senml></senml>
-        #   </data>
-        # </quoalise>
-
-        class Quoalise(ElementBase):
-          name = 'quoalise'
-          namespace = 'urn:quoalise:0'
-
-        quoalise = Quoalise()
+        return self.respond_with_data(session, form, pages, rsm)
 
-        xmldata = ET.Element('data')
-        quoalise.xml.append(xmldata)
+class DailyCommandHandler(DataCommandHandler):
 
-        meta = ET.Element('meta')
-        xmldata.append(meta)
+    node = 'get_daily'
 
-        device = ET.Element('device', attrib={'type': "electricity-meter"})
-        meta.append(device)
-        device.append(ET.Element('identifier', attrib={'authority': "enedis", 'type': "prm", 'value': usage_point_id}))
+    def __init__(self, xmpp_client, get_daily):
 
-        measurement_meta = ET.Element('measurement')
-        meta.append(measurement_meta)
-        measurement_meta.append(ET.Element('physical', attrib={'quantity': "power", 'type': "electrical", 'unit': "W"}))
-        measurement_meta.append(ET.Element('business', graph="load-profile", direction=direction))
-        measurement_meta.append(ET.Element('aggregate', attrib={'type': "average"}))
+        self.xmpp = xmpp_client
+        self.get_daily = get_daily
 
-        sensml = ET.Element('sensml', xmlns="urn:ietf:params:xml:ns:senml")
-        xmldata.append(sensml)
+    @staticmethod
+    def make_pages(usage_point_id, direction, start_date, data):
 
         meter_reading = data["meter_reading"]
-        bt = DataConnect.date(payload['values']['start_date'])
-        bt = int(bt.astimezone(pytz.utc).timestamp())
-
-        measurements = meter_reading["interval_reading"]
-        first = True
-        for measurement in measurements:
-            v = str(measurement['value'])
-            t = DataConnect.datetime(measurement["date"])
-            t = int(t.astimezone(pytz.utc).timestamp())
-            t = t - bt
-            if first:
-                senml = ET.Element('senml',
-                                   bn=f"urn:dev:prm:{usage_point_id}_{direction}_load",
-                                   bt=str(bt), t=str(t), v=str(v), bu='W')
-                measurement_meta.append(ET.Element('sampling', interval=measurement['interval_length']))
-                first = False
-            else:
-                senml = ET.Element('senml', t=str(t), v=str(v))
-            sensml.append(senml)
-
-        # TODO keep a way, like a checkbox to get a message instead of embedding data in the iq response
-        # msg = self.xmpp.make_message(mto=session['from'].bare,
-        #                             msubject=f"Consumption load curve for {usage_point_id}")
-        # msg.append(quoalise)
-        #msg.send()
-
-        session['payload'] = [form, quoalise]
-
-        return session
+        readings = meter_reading["interval_reading"]
 
-class DailyCommandHandler:
+        bt = DataConnect.timestamps([start_date])[0]
+        times = DataConnect.timestamps([reading['date'] for reading in readings])
+        values = [reading['value'] for reading in readings]
 
-    def __init__(self, xmpp_client, get_daily):
+        measurement = [('physical', {'quantity': "energy", 'type': "electrical", 'unit': "Wh"}),
+                       ('business', {'direction': direction}),
+                       ('aggregate', {'type': "sum"}),
+                       ('sampling', {'interval': "P1D"})]
 
-        self.xmpp = xmpp_client
-        self.get_daily = get_daily
+        return DataPages(usage_point_id, measurement,
+                         f"urn:dev:prm:{usage_point_id}_daily_{direction}", 'Wh',
+                         bt, times, values)
 
-    def handle_request(self, iq, session):
+    async def handle_request(self, iq, session):
 
         if iq['command'].xml: # has subelements
-            return self.handle_submit(session['payload'], session)
+            return await self.handle_submit(session['payload'], session)
 
         form = self.xmpp['xep_0004'].make_form(ftype='form', title=f'Get daily data')
 
@@ -386,23 +974,37 @@ class DailyCommandHandler:
                       required=True,
                       value=end_date)
 
-        session['payload'] = form
-        session['next'] = self.handle_submit
+        add_encoding_field(form)
+        add_delivery_field(form)
 
-        return session
+        return self.respond_with_form(session, form)
 
-    def handle_submit(self, payload, session):
+    @timed_command
+    async def handle_submit(self, payload, session):
+
+        payload, rsm = split_payload(payload)
 
         usage_point_id = payload['values']['usage_point_id']
         start_date = payload['values']['start_date']
         end_date = payload['values']['end_date']
         direction = payload['values']['direction']
 
+        encoding = get_encoding(payload)
+        delivery = get_delivery(payload)
+
+        async def get_pages(usage_point_id, direction):
+            data = await self.get_daily(direction, session['from'].bare, usage_point_id, start_date, end_date)
+            pages = self.make_pages(usage_point_id, direction, start_date, data)
+            pages.encoding = encoding
+            return pages
+
+        if delivery == 'message':
+            return self.respond_with_job(session, [(usage_point_id, direction)], get_pages)
+
         try:
-            data = self.get_daily(direction, session['from'].bare, usage_point_id, start_date, end_date)
+            pages = await get_pages(usage_point_id, direction)
         except DataConnectError as e:
             return fail_with(e.message, e.code)
-        print(data)
 
         form = self.xmpp['xep_0004'].make_form(ftype='result', title=f"Get daily {direction}")
 
@@ -416,59 +1018,461 @@ class DailyCommandHandler:
                       label=f'{direction} load curve for {usage_point_id}',
                       value=f"Success")
 
-        session['next'] = None
+        return self.respond_with_data(session, form, pages, rsm)
 
-        class Quoalise(ElementBase):
-          name = 'quoalise'
-          namespace = 'urn:quoalise:0'
+class BatchCommandHandler(DataCommandHandler):
 
-        quoalise = Quoalise()
+    # Same data as get_load_curve or get_daily, for several usage points and
+    # directions at once. Upstream calls are made concurrently, scheduled by
+    # the Data Connect rate limiter, and a failure only affects its own
+    # <data> element. Responses are paged as a whole, see BatchPages.
+
+    MAX_USAGE_POINTS = 1000
 
-        xmldata = ET.Element('data')
-        quoalise.xml.append(xmldata)
+    def __init__(self, xmpp_client, node, title, get_data, make_pages):
 
-        meta = ET.Element('meta')
-        xmldata.append(meta)
+        self.xmpp = xmpp_client
+        self.node = node
+        self.title = title
+        self.get_data = get_data
+        self.make_pages = make_pages
 
-        device = ET.Element('device', attrib={'type': "electricity-meter"})
-        meta.append(device)
-        device.append(ET.Element('identifier', attrib={'authority': "enedis", 'type': "prm", 'value': usage_point_id}))
+    async def handle_request(self, iq, session):
 
-        measurement = ET.Element('measurement')
-        meta.append(measurement)
-        measurement.append(ET.Element('physical', attrib={'quantity': "energy", 'type': "electrical", 'unit': "Wh"}))
-        measurement.append(ET.Element('business', direction=direction))
-        measurement.append(ET.Element('aggregate', attrib={'type': "sum"}))
-        measurement.append(ET.Element('sampling', interval="P1D"))
+        if iq['command'].xml: # has subelements
+            return await self.handle_submit(session['payload'], session)
 
-        sensml = ET.Element('sensml', xmlns="urn:ietf:params:xml:ns:senml")
-        xmldata.append(sensml)
+        form = self.xmpp['xep_0004'].make_form(ftype='form', title=self.title)
 
-        meter_reading = data["meter_reading"]
-        bt = DataConnect.date(payload['values']['start_date'])
-        bt = int(bt.astimezone(pytz.utc).timestamp())
-        measurements = meter_reading["interval_reading"]
-        first = True
-        for measurement in measurements:
-            v = str(measurement['value'])
-            t = DataConnect.date(measurement["date"])
-            t = int(t.astimezone(pytz.utc).timestamp())
-            t = t - bt
-            if first:
-                senml = ET.Element('senml',
-                                   bn=f"urn:dev:prm:{usage_point_id}_daily_{direction}",
-                                   bt=str(bt), t=str(t), v=str(v), bu='Wh')
-                first = False
+        form.addField(var='usage_point_ids',
+                      ftype='text-multi',
+                      label='Usage points',
+                      desc='Un PRM par ligne',
+                      required=True,
+                      value='')
+
+        form.addField(var='directions',
+                      ftype='list-multi',
+                      label='Directions',
+                      options=[{'label': 'Consumption', 'value': 'consumption'},
+                               {'label': 'Production', 'value': 'production'}],
+                      required=True,
+                      value=['consumption'])
+
+        start_date = DataConnect.date_to_isostring(dt.datetime.today() - dt.timedelta(days=1))
+        end_date = DataConnect.date_to_isostring(dt.datetime.today())
+
+        form.addField(var='start_date',
+                      ftype='text-single',
+                      label='Start date',
+                      desc=' Au format YYYY-MM-DD',
+                      required=True,
+                      value=start_date)
+
+        form.addField(var='end_date',
+                      ftype='text-single',
+                      label='End date',
+                      desc=' Au format YYYY-MM-DD',
+                      required=True,
+                      value=end_date)
+
+        add_encoding_field(form)
+        add_delivery_field(form)
+
+        return self.respond_with_form(session, form)
+
+    @staticmethod
+    def parse_usage_point_ids(value):
+        # text-multi values are lists of lines, also accept separators on a line
+        if isinstance(value, list):
+            value = '\n'.join(value)
+        usage_point_ids = []
+        for usage_point_id in value.replace(',', ' ').split():
+            if usage_point_id not in usage_point_ids:
+                usage_point_ids.append(usage_point_id)
+        return usage_point_ids
+
+    @timed_command
+    async def handle_submit(self, payload, session):
+
+        payload, rsm = split_payload(payload)
+
+        usage_point_ids = self.parse_usage_point_ids(payload['values'].get('usage_point_ids') or '')
+        directions = payload['values'].get('directions') or ['consumption']
+        if isinstance(directions, str):
+            directions = [directions]
+        start_date = payload['values']['start_date']
+        end_date = payload['values']['end_date']
+
+        if not usage_point_ids:
+            raise XMPPError('bad-request', text='At least one usage point is required')
+        if len(usage_point_ids) > self.MAX_USAGE_POINTS:
+            raise XMPPError('bad-request', text=f'At most {self.MAX_USAGE_POINTS} usage points can be requested at once')
+        if not set(directions) <= {'consumption', 'production'}:
+            raise XMPPError('bad-request', text='directions should be consumption or production')
+
+        encoding = get_encoding(payload)
+        delivery = get_delivery(payload)
+
+        jid = session['from'].bare
+        requests = [(usage_point_id, direction) for usage_point_id in usage_point_ids for direction in directions]
+
+        async def get_pages(usage_point_id, direction):
+            data = await self.get_data(direction, jid, usage_point_id, start_date, end_date)
+            pages = self.make_pages(usage_point_id, direction, start_date, data)
+            pages.encoding = encoding
+            return pages
+
+        if delivery == 'message':
+            return self.respond_with_job(session, requests, get_pages)
+
+        async def get_pages_or_error(usage_point_id, direction):
+            try:
+                return await get_pages(usage_point_id, direction)
+            except DataConnectError as e:
+                return e
+
+        results = await asyncio.gather(*[get_pages_or_error(usage_point_id, direction) for usage_point_id, direction in requests])
+
+        pages = BatchPages()
+        failures = 0
+        for (usage_point_id, direction), result in zip(requests, results):
+            if isinstance(result, DataConnectError):
+                failures += 1
+                pages.add_error(usage_point_id, direction, result)
             else:
-                senml = ET.Element('senml', t=str(t), v=str(v))
-            sensml.append(senml)
+                pages.add_pages(result)
 
-        # TODO keep a way, like a checkbox to get a message instead of embedding data in the iq response
-        # msg = self.xmpp.make_message(mto=session['from'].bare,
-        #                             msubject=f"Consumption load curve for {usage_point_id}")
-        # msg.append(quoalise)
-        #msg.send()
+        form = self.xmpp['xep_0004'].make_form(ftype='result', title=self.title)
 
-        session['payload'] = [form, quoalise]
+        if failures == 0:
+            result = "Success"
+        elif failures < len(requests):
+            result = "Partial success"
+        else:
+            result = "Failure"
 
-        return session
+        form.addField(var='result',
+                      ftype='fixed',
+                      label=f'{len(requests)} requests, {failures} failed',
+                      value=result)
+
+        return self.respond_with_data(session, form, pages, rsm)
+
+if __name__ == '__main__':
+
+    import unittest
+
+    class TestDataPages(unittest.TestCase):
+
+        def make_pages(self, count):
+            times = [1590962400 + 1800 * i for i in range(count)]
+            return DataPages('22516914714270', [], 'bn', 'W', times[0], times, [str(i) for i in range(count)])
+
+        def make_rsm(self, **values):
+            rsm = Set()
+            for key, value in values.items():
+                rsm[key] = value
+            return rsm
+
+        def senml(self, quoalise):
+            return [(e.get('t'), e.get('v')) for e in quoalise.xml.find('data/sensml')]
+
+        def test_whole_data_without_paging(self):
+            quoalise, _, has_next = self.make_pages(48).page()
+            self.assertEqual(len(self.senml(quoalise)), 48)
+            self.assertFalse(has_next)
+
+        def test_pages_follow_each_other(self):
+            pages = self.make_pages(48)
+            quoalise, result, has_next = pages.page(self.make_rsm(max='20'))
+            self.assertEqual(self.senml(quoalise)[0], ('0', '0'))
+            self.assertEqual((result['first'], result['last'], result['count']), ('0', '19', '48'))
+            self.assertTrue(has_next)
+            quoalise, result, has_next = pages.page()
+            self.assertEqual(self.senml(quoalise)[0], ('36000', '20'))
+            self.assertEqual((result['first'], result['last']), ('20', '39'))
+            self.assertTrue(has_next)
+            quoalise, result, has_next = pages.page()
+            self.assertEqual(len(self.senml(quoalise)), 8)
+            self.assertFalse(has_next)
+
+        def test_page_after_item(self):
+            pages = self.make_pages(48)
+            pages.page(self.make_rsm(max='10'))
+            quoalise, result, has_next = pages.page(self.make_rsm(after='42'))
+            self.assertEqual((result['first'], result['last']), ('43', '47'))
+            self.assertFalse(has_next)
+
+        def test_invalid_parameters(self):
+            with self.assertRaises(XMPPError):
+                self.make_pages(48).page(self.make_rsm(max='ten'))
+
+    class TestPagedCommand(unittest.IsolatedAsyncioTestCase):
+
+        async def get_load_curve(self, direction, jid, usage_point_id, start_date, end_date):
+            return TestLoadCurveResampling.data(dt.date(2020, 6, 1), 1)
+
+        async def test_set_of_a_command_request_limits_the_first_page(self):
+            from slixmpp import Iq
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, self.get_load_curve, None)
+            iq = Iq(xml=ET.fromstring(
+                '<iq xmlns="jabber:client" type="set" from="client@example.com/res" to="proxy@example.com/proxy" id="1">'
+                '<command xmlns="http://jabber.org/protocol/commands" node="get_load_curve" action="execute">'
+                '<x xmlns="jabber:x:data" type="submit">'
+                '<field var="usage_point_id"><value>22516914714270</value></field>'
+                '<field var="direction"><value>consumption</value></field>'
+                '<field var="start_date"><value>2020-06-01</value></field>'
+                '<field var="end_date"><value>2020-06-02</value></field>'
+                '</x>'
+                '<set xmlns="http://jabber.org/protocol/rsm"><max>10</max></set>'
+                '</command></iq>'))
+            session = await xmpp.load_curve_handler.handle_submit(iq['command']['substanzas'],
+                                                                  {'from': iq['from'], 'interfaces': set()})
+            _, quoalise, result = session['payload']
+            self.assertEqual(len(quoalise.xml.find('data/sensml')), 10)
+            self.assertEqual((result['first'], result['last'], result['count']), ('0', '9', '48'))
+            self.assertTrue(session['has_next'])
+
+        async def test_complete_action_gets_all_readings(self):
+            from slixmpp import Iq
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, self.get_load_curve, None)
+            xmpp.plugin['xep_0050'].add_command(jid='proxy@example.com/proxy', node='get_load_curve', name='Get load curve',
+                                                handler=xmpp.load_curve_handler.handle_request)
+            sent = []
+            xmpp.send = sent.append
+
+            async def command(xml):
+                count = len(sent)
+                xmpp.plugin['xep_0050']._handle_command(Iq(xmpp, xml=ET.fromstring(
+                    '<iq xmlns="jabber:client" type="set" from="client@example.com/res" to="proxy@example.com/proxy" id="1">'
+                    f'<command xmlns="http://jabber.org/protocol/commands" node="get_load_curve" {xml}</command></iq>')))
+                for _ in range(100):
+                    if len(sent) > count:
+                        return sent[-1]['command']
+                    await asyncio.sleep(0.01)
+                self.fail('No response')
+
+            response = await command('action="execute">')
+            self.assertEqual(response['actions'], {'next'})
+
+            response = await command(
+                f'sessionid="{response["sessionid"]}" action="complete">'
+                '<x xmlns="jabber:x:data" type="submit">'
+                '<field var="usage_point_id"><value>22516914714270</value></field>'
+                '<field var="direction"><value>consumption</value></field>'
+                '<field var="start_date"><value>2020-06-01</value></field>'
+                '<field var="end_date"><value>2020-06-02</value></field>'
+                '</x>'
+                '<set xmlns="http://jabber.org/protocol/rsm"><max>10</max></set>')
+            self.assertEqual(response['status'], 'completed')
+            self.assertEqual(len(response.xml.find('{urn:quoalise:0}quoalise/data/sensml')), 48)
+
+    class TestLoadCurveResampling(unittest.TestCase):
+
+        @staticmethod
+        def data(start, days):
+            readings = []
+            date = dt.datetime.combine(start, dt.time())
+            for i in range(days * 48):
+                date += dt.timedelta(minutes=30)
+                readings.append({'value': '1000' if i < 48 else '2000', 'date': date.strftime('%Y-%m-%d %H:%M:%S'),
+                                 'interval_length': 'PT30M'})
+            return {'meter_reading': {'interval_reading': readings}}
+
+        def test_readings_are_dated_at_interval_start(self):
+            pages = LoadCurveCommandHandler.make_pages('22516914714270', 'consumption', '2020-06-01', self.data(dt.date(2020, 6, 1), 1))
+            quoalise, _, _ = pages.page()
+            senml = quoalise.xml.find('data/sensml')
+            self.assertEqual((senml[0].get('bt'), senml[0].get('t')), ('1590962400', '0'))
+            self.assertEqual(senml[-1].get('t'), '84600')
+
+        def test_daily_energy(self):
+            pages = LoadCurveCommandHandler.make_pages('22516914714270', 'consumption', '2020-06-01', self.data(dt.date(2020, 6, 1), 2),
+                                                       '2020-06-03', 'P1D', 'sum')
+            quoalise, _, _ = pages.page()
+            measurement = quoalise.xml.find('data/meta/measurement')
+            self.assertEqual(measurement.find('physical').get('unit'), 'Wh')
+            self.assertEqual(measurement.find('aggregate').get('type'), 'sum')
+            self.assertEqual(measurement.find('sampling').get('interval'), 'P1D')
+            senml = quoalise.xml.find('data/sensml')
+            self.assertEqual([(e.get('t'), e.get('v')) for e in senml], [('0', '24000'), ('86400', '48000')])
+            self.assertEqual(senml[0].get('bu'), 'Wh')
+
+        def test_hourly_max(self):
+            pages = LoadCurveCommandHandler.make_pages('22516914714270', 'consumption', '2020-06-01', self.data(dt.date(2020, 6, 1), 1),
+                                                       '2020-06-02', 'PT1H', 'max')
+            quoalise, _, _ = pages.page()
+            self.assertEqual(len(quoalise.xml.find('data/sensml')), 24)
+            self.assertEqual(quoalise.xml.find('data/meta/measurement/aggregate').get('type'), 'maximum')
+
+    class TestSubscribersCommand(unittest.IsolatedAsyncioTestCase):
+
+        def get_subscribers(self, usage_point_id):
+            return {'a@example.com': '0', 'b@example.com': '3'}
+
+        async def test_only_admins_get_subscribers(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, None,
+                                 self.get_subscribers, admins=['admin@example.com'])
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='usage_point_id', value='22516914714270')
+            session = await xmpp.subscribers_handler.handle_submit(payload, {'from': JID('admin@example.com/res')})
+            self.assertEqual(session['payload']['values']['subscribers'], ['a@example.com 0', 'b@example.com 3'])
+            with self.assertRaises(XMPPError):
+                await xmpp.subscribers_handler.handle_submit(payload, {'from': JID('a@example.com/res')})
+
+    class TestTracing(unittest.IsolatedAsyncioTestCase):
+
+        async def get_daily(self, direction, jid, usage_point_id, start_date, end_date):
+            return {'meter_reading': {'interval_reading': [{'value': '1000', 'date': '2020-06-01'}]}}
+
+        async def test_trace_is_finished_once_the_response_is_sent(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, self.get_daily)
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            for var, value in [('usage_point_id', '22516914714270'), ('direction', 'consumption'),
+                               ('start_date', '2020-06-01'), ('end_date', '2020-06-02')]:
+                payload.add_field(var=var, value=value)
+            await xmpp.daily_handler.handle_submit(payload, {'id': 'session-1', 'from': JID('client@example.com/res')})
+            trace = tracing.current()
+            self.assertEqual((trace.node, trace.id), ('get_daily', 'session-1'))
+            self.assertIn('timestamps', trace.stages)
+            self.assertIn('xml_build', trace.stages)
+            xmpp.send(xmpp.make_iq_result(ito='client@example.com/res'))
+            self.assertIn('xml_send', trace.stages)
+            self.assertIsNotNone(trace.duration)
+            self.assertIsNone(tracing.current())
+
+        async def test_only_admins_run_the_profiler(self):
+            import tempfile
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, None, admins=['admin@example.com'])
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='action', value='start')
+            with self.assertRaises(XMPPError):
+                await xmpp.profiler_handler.handle_submit(payload, {'from': JID('a@example.com/res')})
+            await xmpp.profiler_handler.handle_submit(payload, {'from': JID('admin@example.com/res')})
+            self.assertTrue(tracing.profiler.running)
+            await asyncio.sleep(0.05)
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='action', value='stop')
+            with tempfile.TemporaryDirectory() as directory:
+                tracing.PROFILES_PATH = directory
+                with self.assertLogs(level='WARNING'):
+                    session = await xmpp.profiler_handler.handle_submit(payload, {'from': JID('admin@example.com/res')})
+                self.assertTrue(session['payload']['values']['path'].startswith(directory))
+            self.assertFalse(tracing.profiler.running)
+
+    class TestBatchCommand(unittest.IsolatedAsyncioTestCase):
+
+        async def get_daily(self, direction, jid, usage_point_id, start_date, end_date):
+            if usage_point_id == '22516914714271':
+                raise DataConnectError(f'User {jid} is not allowed to access {usage_point_id}')
+            return {'meter_reading': {'interval_reading': [{'value': '1000', 'date': '2020-06-01'},
+                                                           {'value': '1100', 'date': '2020-06-02'}]}}
+
+        async def test_errors_are_reported_per_usage_point(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, self.get_daily)
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='usage_point_ids', ftype='text-multi', value='22516914714270\n22516914714271')
+            payload.add_field(var='directions', ftype='list-multi', value=['consumption', 'production'])
+            payload.add_field(var='start_date', value='2020-06-01')
+            payload.add_field(var='end_date', value='2020-06-03')
+            session = await xmpp.daily_batch_handler.handle_submit(payload, {'from': JID('client@example.com/res')})
+            form, quoalise = session['payload']
+            self.assertEqual(form['values']['result'], 'Partial success')
+            data = quoalise.xml.findall('data')
+            self.assertEqual([d.find('meta/device/identifier').get('value') for d in data],
+                             ['22516914714270', '22516914714270', '22516914714271', '22516914714271'])
+            self.assertEqual(len(data[1].find('sensml')), 2)
+            self.assertIsNotNone(data[2].find('upstream-error'))
+
+        async def test_batch_is_paged(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, self.get_daily)
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='usage_point_ids', ftype='text-multi', value='22516914714270\n22516914714271')
+            payload.add_field(var='directions', ftype='list-multi', value=['consumption', 'production'])
+            payload.add_field(var='start_date', value='2020-06-01')
+            payload.add_field(var='end_date', value='2020-06-03')
+            rsm = Set()
+            rsm['max'] = '3'
+            session = await xmpp.daily_batch_handler.handle_submit([payload, rsm], {'from': JID('client@example.com/res')})
+
+            # 2 readings of each direction of the first usage point, an error of each of the second one
+            form, quoalise, result = session['payload']
+            self.assertEqual(form['values']['result'], 'Partial success')
+            self.assertEqual((result['first'], result['last'], result['count']), ('0', '2', '6'))
+            self.assertEqual([len(data.find('sensml')) for data in quoalise.xml.findall('data')], [2, 1])
+            self.assertTrue(session['has_next'])
+
+            session = session['next'](Set(), session)
+            quoalise, result = session['payload']
+            self.assertEqual((result['first'], result['last']), ('3', '5'))
+            data = quoalise.xml.findall('data')
+            self.assertEqual([d.find('meta/device/identifier').get('value') for d in data],
+                             ['22516914714270', '22516914714271', '22516914714271'])
+            self.assertEqual(data[0].find('sensml')[0].get('v'), '1100')
+            self.assertIsNotNone(data[2].find('upstream-error'))
+            self.assertFalse(session['has_next'])
+
+        async def test_unknown_direction_is_a_bad_request(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, self.get_daily)
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='usage_point_ids', ftype='text-multi', value='22516914714270')
+            payload.add_field(var='directions', ftype='list-multi', value=['consumption', 'injection'])
+            payload.add_field(var='start_date', value='2020-06-01')
+            payload.add_field(var='end_date', value='2020-06-03')
+            with self.assertRaises(XMPPError) as cm:
+                await xmpp.daily_batch_handler.handle_submit(payload, {'from': JID('client@example.com/res')})
+            self.assertEqual(cm.exception.condition, 'bad-request')
+
+        async def test_cbor_encoding(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, self.get_daily)
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='usage_point_ids', ftype='text-multi', value='22516914714270')
+            payload.add_field(var='directions', ftype='list-multi', value=['consumption'])
+            payload.add_field(var='start_date', value='2020-06-01')
+            payload.add_field(var='end_date', value='2020-06-03')
+            payload.add_field(var='encoding', value='cbor')
+            session = await xmpp.daily_batch_handler.handle_submit(payload, {'from': JID('client@example.com/res')})
+            _, quoalise = session['payload']
+            data, = quoalise.xml.findall('data')
+            self.assertIsNone(data.find('sensml'))
+            self.assertTrue(data.find('senml-cbor').text)
+
+        async def test_job_mode(self):
+            from slixmpp import JID
+            xmpp = XmppInterface('proxy@example.com/proxy', 'password', None, None, self.get_daily)
+            xmpp.JOB_MESSAGE_MAX_READINGS = 1
+            sent = []
+            xmpp.send = sent.append
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='usage_point_ids', ftype='text-multi', value='22516914714270\n22516914714271')
+            payload.add_field(var='directions', ftype='list-multi', value=['consumption'])
+            payload.add_field(var='start_date', value='2020-06-01')
+            payload.add_field(var='end_date', value='2020-06-03')
+            payload.add_field(var='delivery', value='message')
+            session = await xmpp.daily_batch_handler.handle_submit(payload, {'from': JID('client@example.com/res')})
+            job_id = session['payload']['values']['job_id']
+            self.assertEqual(session['payload']['values']['status'], 'running')
+            await xmpp.jobs.data[job_id].task
+
+            self.assertEqual([(msg['to'], msg['thread']) for msg in sent], [('client@example.com/res', job_id)] * 4)
+            readings = [msg.xml.find('{urn:quoalise:0}quoalise/data/sensml') for msg in sent[:2]]
+            self.assertEqual([senml[0].get('v') for senml in readings], ['1000', '1100'])
+            self.assertIsNotNone(sent[2].xml.find('{urn:quoalise:0}quoalise/data/upstream-error'))
+            self.assertEqual(sent[3]['body'], 'Job completed, 2 requests, 1 failed')
+
+            payload = xmpp.plugin['xep_0004'].make_form(ftype='submit')
+            payload.add_field(var='job_id', value=job_id)
+            session = await xmpp.job_status_handler.handle_submit(payload, {'from': JID('client@example.com/other')})
+            self.assertEqual((session['payload']['values']['status'], session['payload']['values']['progress']), ('completed', '2/2'))
+            with self.assertRaises(XMPPError):
+                await xmpp.job_status_handler.handle_submit(payload, {'from': JID('other@example.com/res')})
+
+    unittest.main()